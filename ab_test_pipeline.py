@@ -1,8 +1,60 @@
-from itertools import combinations
+import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import combinations, product
 import pandas as pd
 from core.stat_test import *
 import numpy as np
 from core.bayes import BayesTest
+from core.suff_stats import SufficientStatistics
+from core.segments import SegmentIndex
+
+
+class ResultBuilder:
+    """
+    Накопитель таблицы результатов: значения добавляются в буферы столбцов, а датафрейм собирается
+    один раз в build. В отличие от вставок через .loc, добавление строки не перестраивает индекс датафрейма
+    :param index: (iterable), Названия столбцов, которые станут индексом итоговой таблицы
+    """
+
+    def __init__(self, index):
+        self.index = list(index)
+        self.columns = {name: [] for name in self.index}
+        self.n_rows = 0
+
+    def _extend(self, values, n):
+        for name in values:
+            if name not in self.columns:
+                # Столбец, которого не было в предыдущих строках, заполняем пропусками
+                self.columns[name] = [None] * self.n_rows
+        for name, buf in self.columns.items():
+            if name in values:
+                buf.extend(values[name])
+            else:
+                buf.extend([None] * n)
+        self.n_rows += n
+
+    def append(self, **values):
+        """
+        Добавляет строку, недостающие столбцы заполняются пропусками
+        """
+        self._extend({name: [val] for name, val in values.items()}, 1)
+
+    def extend(self, df, **constants):
+        """
+        Добавляет все строки датафрейма df и столбцы с постоянными значениями constants
+        """
+        values = {col: df[col].tolist() for col in df.columns}
+        values.update({name: [val] * len(df) for name, val in constants.items()})
+        self._extend(values, len(df))
+
+    def build(self):
+        """
+        :return: (pandas.DataFrame), Таблица с индексом self.index
+        """
+        res = pd.DataFrame(self.columns)
+        if self.index:
+            res = res.set_index(self.index)
+        return res
 
 
 class Pipeline:
@@ -14,6 +66,34 @@ class Pipeline:
         :param verbose:
         """
         self.df = df
+        self.verbose = verbose
+        # Кол-во срезов, пропущенных при последнем запуске pipeline из-за недостаточного кол-ва строк
+        self.skipped_slices = 0
+        self._suff_stats = {}
+        self._segment_index = {}
+        self._slice_counts = {}
+        # Предагрегированные данные, см. from_aggregates
+        self._aggregates = None
+
+    @classmethod
+    def from_aggregates(cls, df, metrics=None, verbose=0):
+        """
+        Pipeline по предагрегированным данным: вместо строки на каждый сеанс - кол-во, сумма и сумма квадратов
+        метрик по комбинациям ключей (например полученные при помощи core.get_data.query(aggregate=True)).
+        В pipeline в этом случае поддерживаются только агрегации из SufficientStatistics.AGGREGATIONS
+        :param df: (pandas.DataFrame), Данные в формате core.suff_stats.SufficientStatistics
+        :param metrics: (list, optional, default=None), См. SufficientStatistics.from_aggregates
+        :param verbose:
+        :return: (Pipeline)
+        """
+        pipeline = cls(None, verbose=verbose)
+        pipeline._aggregates = SufficientStatistics.from_aggregates(df, metrics=metrics)
+        return pipeline
+
+    def _frame_statistics(self, keys, metrics):
+        if self._aggregates is not None:
+            return self._aggregates.subcube(keys, metrics)
+        return SufficientStatistics.from_frame(self.df, keys, metrics)
 
     @staticmethod
     def compute_combinations(values_, max_len):
@@ -34,18 +114,128 @@ class Pipeline:
 
         return _unique_vals, _dict
 
-    def grouper(self, groupby_col, experiment_variant_col, group_comb, metric_aggregations):
-        _unique_vals, _group_val_dict = self.get_unique_values(self.df, group_comb)
-        val_combinations = self.compute_combinations(_unique_vals, len(group_comb))
+    @staticmethod
+    def compute_value_combinations(counts, group_comb, min_rows=1):
+        """
+        Комбинации значений срезов для набора столбцов group_comb: ровно одно значение из каждого столбца
+        (декартово произведение), комбинации с кол-вом строк меньше min_rows пропускаются
+        :param counts: (pandas.Series), Кол-во строк по всем столбцам срезов, см. compute_slice_counts
+        :param group_comb: (tuple), Столбцы, значения которых комбинируются
+        :param min_rows: (int, optional, default=1), Минимальное кол-во строк в срезе
+        :return: (tuple), Список комбинаций значений и кол-во пропущенных комбинаций
+        """
+        _counts = counts.groupby(level=list(group_comb), sort=False).sum()
+        if len(group_comb) == 1:
+            _counts.index = [(val,) for val in _counts.index]
+        _counts = dict(zip(_counts.index, _counts.to_numpy()))
+
+        # Порядок значений - порядок их появления в данных
+        uniques = [counts.index.get_level_values(col).dropna().unique() for col in group_comb]
 
-        for comb in val_combinations:
-            query_string = ""
-            for i, val in enumerate(comb):
-                if i != 0:
-                    query_string += " and "
-                query_string += f"{_group_val_dict[val]} == '{val}'"
+        val_combinations, skipped = [], 0
+        for comb in product(*uniques):
+            if _counts.get(comb, 0) < min_rows:
+                skipped += 1
+            else:
+                val_combinations.append(comb)
+
+        return val_combinations, skipped
+
+    @staticmethod
+    def compute_slice_counts(df, groups):
+        """
+        Кол-во строк df для каждой комбинации значений столбцов groups, считается одной группировкой
+        """
+        return df.groupby(list(groups), sort=False, dropna=False, observed=True).size()
+
+    def slice_counts(self, groups):
+        _key = tuple(groups)
+        if _key not in self._slice_counts:
+            self._slice_counts[_key] = self.compute_slice_counts(self.df, _key)
+        return self._slice_counts[_key]
+
+    def sufficient_statistics(self, keys, metrics):
+        """
+        Куб достаточных статистик (кол-во, сумма, сумма квадратов) по self.df или по предагрегированным данным
+        (см. from_aggregates), см. core.suff_stats. Строится один раз для набора ключей и метрик и переиспользуется
+        всеми срезами
+        :param keys: (list), Названия столбцов, по которым будет идти группировка
+        :param metrics: (list), Названия метрик
+        :return: (SufficientStatistics)
+        """
+        _key = (tuple(keys), tuple(metrics))
+        if _key not in self._suff_stats:
+            self._suff_stats[_key] = self._frame_statistics(keys, metrics)
+        return self._suff_stats[_key]
 
-            temp = self.df.query(query_string)
+    def segment_index(self, columns):
+        """
+        Индекс срезов self.df по столбцам columns (см. core.segments), строится один раз
+        :param columns: (iterable), Столбцы срезов
+        :return: (SegmentIndex)
+        """
+        _key = tuple(columns)
+        if _key not in self._segment_index:
+            self._segment_index[_key] = SegmentIndex(self.df, _key)
+        return self._segment_index[_key]
+
+    def update_state(self, path, keys, metrics, key, overwrite=False, metric_aggregations=None):
+        """
+        Инкрементальное обновление куба достаточных статистик (см. core.suff_stats): загружает куб предыдущего
+        запуска из path, добавляет к нему данные self.df по значениям key (например датам), которых в нем еще нет,
+        и сохраняет результат обратно. Все срезы в pipeline после этого считаются по обновленному кубу,
+        поэтому стоимость ежедневного перезапуска зависит только от объема новых данных
+        :param path: (str), Путь к Parquet-файлу с кубом (см. SufficientStatistics.save), если файла нет,
+        он будет создан
+        :param keys: (list), Названия столбцов, по которым группируется куб
+        :param metrics: (list), Названия метрик
+        :param key: (str), Столбец, по которому определяются новые данные, обычно дата
+        :param overwrite: (bool, optional, default=False), Если True, значения key из self.df заменяют сохраненные,
+        например для досчитывающихся данных за последние дни
+        :param metric_aggregations: (dict, optional, default=None), Если задан, проверяется, что агрегации
+        восстанавливаются по кубу
+        :return: (SufficientStatistics)
+        """
+        if metric_aggregations is not None and not SufficientStatistics.supports(metric_aggregations):
+            raise ValueError(f"Incremental mode supports only {SufficientStatistics.AGGREGATIONS} aggregations")
+
+        stats = self._frame_statistics(keys, metrics)
+        if os.path.exists(path):
+            stats = SufficientStatistics.load(path).append(stats, key, overwrite=overwrite)
+        stats.save(path)
+
+        self._suff_stats[(tuple(keys), tuple(metrics))] = stats
+        return stats
+
+    def grouper(self, groupby_col, experiment_variant_col, group_comb, metric_aggregations, groups=None,
+                min_rows=1):
+        # Если агрегации восстанавливаются по сумме и кол-ву, срезы считаются по кубу достаточных статистик,
+        # построенному один раз по всем столбцам groups, а не по исходным строкам
+        if SufficientStatistics.supports(metric_aggregations):
+            _by = [groupby_col, experiment_variant_col]
+            stats = self.sufficient_statistics(_by + list(groups or group_comb), list(metric_aggregations))
+            val_combinations, skipped = self.compute_value_combinations(stats.rows(groups or group_comb),
+                                                                        group_comb, min_rows=min_rows)
+            self.skipped_slices += skipped
+            rolled = stats.rollup(list(group_comb) + _by)
+            rolled_index = SegmentIndex(rolled, group_comb)
+
+            for comb in val_combinations:
+                temp = rolled_index.take(rolled, list(zip(group_comb, comb)))
+                temp = stats.aggregate(_by, metric_aggregations, cube=temp)
+
+                yield comb, temp
+            return
+
+        val_combinations, skipped = self.compute_value_combinations(self.slice_counts(groups or group_comb),
+                                                                    group_comb, min_rows=min_rows)
+        self.skipped_slices += skipped
+
+        # Строки среза находятся пересечением заранее посчитанных позиций, а не через self.df.query
+        index = self.segment_index(groups or group_comb)
+
+        for comb in val_combinations:
+            temp = index.take(self.df, list(zip(group_comb, comb)))
             temp = temp.groupby([groupby_col, experiment_variant_col], as_index=False).agg(metric_aggregations)
 
             yield comb, temp
@@ -69,8 +259,7 @@ class Pipeline:
         for var in variants:
             dfs_vars[f'df_{var}'] = grouped_data.query(f"{experiment_var_col} == @var")
 
-        res = pd.DataFrame(columns=['cnt', 'first', 'second', 'metric'])
-        res = res.set_index(['cnt', 'first', 'second', 'metric'])
+        res = ResultBuilder(['cnt', 'first', 'second', 'metric'])
 
         keys_comb = combinations(dfs_vars, 2)
         vals_comb = combinations(dfs_vars.values(), 2)
@@ -87,27 +276,145 @@ class Pipeline:
 
                 # Дополнительный индекс, для того, чтобы разные тесты записывались в разные строки DF
                 _cnt = 0
-                col_name = tuple([_cnt]) + names + tuple([cur_metric])
-                res.loc[col_name, 'mean_lift'] = lift(df_1[cur_metric], df_2[cur_metric])
 
                 # Z-test
-                res.loc[col_name, "test_type"] = "z-test"
-                res.loc[col_name, "p_value"] = z_test_ratio(df_2[succ].sum(), df_1[succ].sum(),
-                                                            df_2[trial].sum(), df_1[trial].sum())
+                res.append(cnt=_cnt, first=names[0], second=names[1], metric=cur_metric,
+                           mean_lift=lift(df_1[cur_metric], df_2[cur_metric]),
+                           test_type="z-test",
+                           p_value=z_test_ratio(df_2[succ].sum(), df_1[succ].sum(),
+                                                df_2[trial].sum(), df_1[trial].sum()))
 
                 _cnt += 1
-                col_name = tuple([_cnt]) + names + tuple([cur_metric])
 
                 # Bayes A/B statistics
                 bayes_res = BayesTest(df_1[succ].sum(), df_2[succ].sum(),
                                                             df_1[trial].sum(), df_2[trial].sum())
                 bayes_prob, bayes_lift = bayes_res.bayes_prob()
-                res.loc[col_name, "test_type"] = "bayes_test"
-                res.loc[col_name, "mean_lift"] = bayes_lift
-                res.loc[col_name, "p_value"] = 1 - bayes_prob
+                res.append(cnt=_cnt, first=names[0], second=names[1], metric=cur_metric,
+                           mean_lift=bayes_lift, test_type="bayes_test", p_value=1 - bayes_prob)
+
+        return res.build()
+
+    @staticmethod
+    def compute_results_binary_batch(df, groupby_col, experiment_var_col, metric_aggregations, metrics,
+                                     groups=None, alpha=0.05, stats=None, min_rows=1, counts=None):
+        """
+        Векторизованный аналог compute_results_binary сразу для всех комбинаций срезов. Суммы успехов и попыток для
+        каждой тройки (срез, пара вариантов, метрика) собираются в массивы numpy, после чего z-test и Байесовский
+        тест считаются за один проход по этим массивам
+        :param df: (pandas.DataFrame), Исходный (не сгруппированный) датафрейм
+        :param groupby_col: (str), Название столбца по которму будет идти группировка данных, например по дате
+        :param experiment_var_col: (str), Имя столбца с вариантом эксперимента
+        :param metric_aggregations: (dict), См. описание метода pipeline, должен содержать все столбцы из metrics
+        :param metrics: (dict), См. описание метода compute_results_binary
+        :param groups: (iterable, optional, default=None), Список с названиями столбцов, по которым будет идти срез
+        :param alpha: (float, optional, default=0.05), alpha-value для статистических тестов
+        :param stats: (SufficientStatistics, optional, default=None), Куб достаточных статистик по df, если задан,
+        суммы по срезам считаются по нему
+        :param min_rows: (int, optional, default=1), Минимальное кол-во строк в срезе, см. compute_value_combinations
+        :param counts: (pandas.Series, optional, default=None), Кол-во строк по срезам, см. compute_slice_counts
+        :return: (pandas.DataFrame), Таблица в long-формате, как у метода pipeline: cnt (0 - z-test, 1 - bayes_test),
+            group_0, ..., group_n, first, second, metric, mean_lift, test_type, p_value
+        """
+        groups = [] if groups is None else list(groups)
+        max_comb_len = len(groups)
+        group_combs = Pipeline.compute_combinations(groups, max_comb_len) if groups else [()]
+        if groups and counts is None:
+            counts = Pipeline.compute_slice_counts(df, groups)
+
+        _cols = list(dict.fromkeys(list(metrics.keys()) + list(metrics.values())))
+        _aggs = {col: metric_aggregations[col] for col in _cols}
+        cr_names = [f"{succ}_{trial}_CR" for succ, trial in metrics.items()]
+
+        # Суммы успехов, попыток и CR по строкам (срез, вариант) и позиции строк, образующих пары для сравнения
+        succ_blocks, trial_blocks, cr_blocks = [], [], []
+        pos_first, pos_second, pair_names, pair_slices = [], [], [], []
+        offset = 0
+
+        for group_comb in group_combs:
+            _by = list(group_comb)
+            if stats is not None and SufficientStatistics.supports(_aggs):
+                temp = stats.aggregate(_by + [groupby_col, experiment_var_col], _aggs).dropna(subset=_by)
+            else:
+                temp = df.groupby(_by + [groupby_col, experiment_var_col], as_index=False).agg(_aggs)
+            for (succ, trial), cur_metric in zip(metrics.items(), cr_names):
+                temp[cur_metric] = temp[succ] / temp[trial]
+
+            # sort=False сохраняет порядок появления вариантов внутри среза, как в compute_results_binary
+            sums = temp.groupby(_by + [experiment_var_col], sort=False)[_cols + cr_names].sum().reset_index()
+            succ_blocks.append(sums[list(metrics.keys())].to_numpy(dtype=float))
+            trial_blocks.append(sums[list(metrics.values())].to_numpy(dtype=float))
+            cr_blocks.append(sums[cr_names].to_numpy(dtype=float))
+
+            _positions = {}
+            for pos, row in enumerate(sums[_by + [experiment_var_col]].itertuples(index=False, name=None)):
+                _positions.setdefault(row[:-1], []).append((row[-1], offset + pos))
+
+            # Порядок срезов такой же, как при последовательном обходе Pipeline.grouper
+            val_combinations = Pipeline.compute_value_combinations(counts, group_comb, min_rows)[0] if _by else [()]
+            for val_comb in val_combinations:
+                for (var_1, pos_1), (var_2, pos_2) in combinations(_positions.get(val_comb, []), 2):
+                    pos_first.append(pos_1)
+                    pos_second.append(pos_2)
+                    pair_names.append((f'df_{var_1}', f'df_{var_2}'))
+                    pair_slices.append(val_comb + ("No group",) * (max_comb_len - len(val_comb)))
+
+            offset += len(sums)
+
+        succ_arr, trial_arr, cr_arr = np.vstack(succ_blocks), np.vstack(trial_blocks), np.vstack(cr_blocks)
+        pos_first, pos_second = np.asarray(pos_first, dtype=int), np.asarray(pos_second, dtype=int)
+
+        # Массивы формы (кол-во пар, кол-во метрик)
+        succ_1, succ_2 = succ_arr[pos_first], succ_arr[pos_second]
+        trial_1, trial_2 = trial_arr[pos_first], trial_arr[pos_second]
+        mean_lift = (cr_arr[pos_second] - cr_arr[pos_first]) / cr_arr[pos_first]
+        p_value = z_test_ratio_batch(succ_2, succ_1, trial_2, trial_1)
+
+        bayes_prob, bayes_lift = BayesTest.batch_prob(succ_1, succ_2, trial_1, trial_2)
+
+        # Для каждой пары и метрики две строки: z-test и bayes_test
+        n_pairs, n_metrics = p_value.shape
+        _rows_per_pair = 2 * n_metrics
+        res = pd.DataFrame(np.repeat(np.asarray(pair_slices, dtype=object).reshape(n_pairs, max_comb_len),
+                                     _rows_per_pair, axis=0),
+                           columns=[f'group_{i}' for i in range(max_comb_len)])
+        res.insert(0, 'cnt', np.tile([0, 1], n_pairs * n_metrics))
+        res['first'] = np.repeat([names[0] for names in pair_names], _rows_per_pair)
+        res['second'] = np.repeat([names[1] for names in pair_names], _rows_per_pair)
+        res['metric'] = np.tile(np.repeat(cr_names, 2), n_pairs)
+        res['mean_lift'] = np.stack([mean_lift, bayes_lift], axis=-1).ravel()
+        res['test_type'] = np.tile(["z-test", "bayes_test"], n_pairs * n_metrics)
+        res['p_value'] = np.stack([p_value, 1 - bayes_prob], axis=-1).ravel()
 
         return res
 
+    @staticmethod
+    def compute_test_plan(grouped_data, experiment_var_col, metrics, show_plots=False):
+        """
+        Подготовительный этап для compute_results_continuous: для каждой пары (вариант, метрика) один раз считаются
+        массив значений, отсортированный массив (ранговые тесты не зависят от порядка наблюдений, а на
+        отсортированных данных считаются быстрее) и результат проверки на нормальность. Попарные сравнения
+        используют эти значения повторно, grouped_data при этом не изменяется
+        :param grouped_data: (pandas.DataFrame), Сгруппированный датафрейм
+        :param experiment_var_col: (str), Имя столбца с вариантом эксперимента
+        :param metrics: (iterable), Названия столбцов с метриками
+        :param show_plots: (bool, optional, default=False), Выводить ли QQ plot для нормального распределения
+        :return: (dict), {(variant, metric): {'values': ..., 'sorted': ..., 'normal': ...}} в порядке появления
+        вариантов в данных
+        """
+        plan = {}
+
+        for var, df in grouped_data.groupby(experiment_var_col, sort=False):
+            for metric in metrics:
+                # pandas.Series, как и раньше: lift по Series пропускает NaN
+                values = df[metric]
+                if show_plots:
+                    qq_plot(values, metric)
+                plan[(var, metric)] = {'values': values, 'sorted': np.sort(values.to_numpy()),
+                                       'normal': normality_test(values)}
+
+        return plan
+
     @staticmethod
     def compute_results_continuous(grouped_data, experiment_var_col, metrics, alpha=0.05,
                                    show_total=True, show_plots=False):
@@ -124,55 +431,46 @@ class Pipeline:
         :return: При show_total=True, возвращает tuple из двух датафреймов: res и tot, res - с результатами
         эксперимента, при show_total=False возвращает только res
         """
-        variants = grouped_data[experiment_var_col].unique()
-        dfs_vars = {}
-
-        for i, var in enumerate(variants):
-            dfs_vars[f'df_{var}'] = grouped_data.query(f"{experiment_var_col} == @var")
+        plan = Pipeline.compute_test_plan(grouped_data, experiment_var_col, metrics, show_plots=show_plots)
+        variants = list(dict.fromkeys(var for var, _ in plan))
 
-        res = pd.DataFrame(columns=['first', 'second', 'metric'])
-        res = res.set_index(['first', 'second', 'metric'])
+        res = ResultBuilder(['first', 'second', 'metric'])
 
-        keys_comb = combinations(dfs_vars, 2)
-        vals_comb = combinations(dfs_vars.values(), 2)
-
-        for df in dfs_vars.values():
+        for var_1, var_2 in combinations(variants, 2):
             for metric in metrics:
-                if show_plots:
-                    qq_plot(df[metric], metric)
-                df[metric+'_normal'] = normality_test(df[metric])
+                d_1 = plan[(var_1, metric)]
+                d_2 = plan[(var_2, metric)]
 
-        for names, values in zip(keys_comb, vals_comb):
-            df_1 = values[0]
-            df_2 = values[1]
+                mean_lift = lift(d_1['values'], d_2['values'])
+                # Ранговые тесты (Манна-Уитни, Краскела-Уоллиса, Муда) по общим рангам пары, см. rank_tests
+                ranks = rank_tests(d_1['sorted'], d_2['sorted'])
+                # Те же решения, что у kruskal_wallis и mood_var
+                equal_median = ranks['kruskal'][1] < alpha
 
-            for metric in metrics:
-                col_name = names + tuple([metric])
-                res.loc[col_name, 'mean_lift'] = lift(df_1[metric], df_2[metric])
                 # Если оба распределения нормальные
-                if df_1[metric+'_normal'].min() and df_2[metric+'_normal'].min():
-                    equal_var = levene_var(df_1[metric], df_2[metric], alpha=alpha)
-                    equal_median = kruskal_wallis(df_1[metric], df_2[metric])
-                    res.loc[col_name, 'equal_variance'] = equal_var
-                    res.loc[col_name, 'equal_median'] = equal_median
+                if d_1['normal'] and d_2['normal']:
+                    equal_var = levene_var(d_1['values'], d_2['values'], alpha=alpha)
 
                     # Если дисперсии равны
                     if equal_var:
-                        res.loc[col_name, "test_type"] = "independent ttest"
-                        res.loc[col_name, "p_value"] = independent_ttest(df_1[metric], df_2[metric], alpha=alpha)
+                        test_type = "independent ttest"
+                        p_value = independent_ttest(d_1['values'], d_2['values'], alpha=alpha)
 
                     else:
-                        res.loc[col_name, "test_type"] = "mann_whitneyu"
-                        res.loc[col_name, 'p_value'] = mann_whitneyu_test(df_1[metric], df_2[metric], alpha=alpha)
+                        test_type = "mann_whitneyu"
+                        p_value = ranks['mannwhitneyu'][1]
 
                 else:
-                    equal_var = mood_var(df_1[metric], df_2[metric], alpha=alpha)
-                    res.loc[col_name, 'equal_variance'] = equal_var
-                    equal_median = kruskal_wallis(df_1[metric], df_2[metric])
-                    res.loc[col_name, 'equal_median'] = equal_median
+                    equal_var = not ranks['mood'][1] < alpha
+
+                    test_type = "mann_whitneyu"
+                    p_value = ranks['mannwhitneyu'][1]
 
-                    res.loc[col_name, "test_type"] = "mann_whitneyu"
-                    res.loc[col_name, 'p_value'] = mann_whitneyu_test(df_1[metric], df_2[metric], alpha=alpha)
+                res.append(first=f'df_{var_1}', second=f'df_{var_2}', metric=metric, mean_lift=mean_lift,
+                           equal_variance=equal_var, equal_median=equal_median,
+                           test_type=test_type, p_value=p_value)
+
+        res = res.build()
 
         if show_total:
             total_sum = grouped_data.groupby(experiment_var_col, as_index=False)[metrics].sum()\
@@ -184,8 +482,34 @@ class Pipeline:
 
         return res
 
+    @staticmethod
+    def compute_slice(df_gr, experiment_var_col, metrics, metrics_for_binary=None):
+        """
+        Результаты A/B теста по одному срезу. Срезы независимы друг от друга, поэтому метод может выполняться
+        в отдельном процессе - ему нужны только сгруппированные данные среза
+        :param df_gr: (pandas.DataFrame), Сгруппированный датафрейм среза
+        :param experiment_var_col: (str), Имя столбца с вариантом эксперимента
+        :param metrics: (iterable), Названия столбцов с метриками, см. compute_results_continuous
+        :param metrics_for_binary: (dict, optional, default=None), См. compute_results_binary, если None -
+        бинарные метрики не считаются
+        :return: (tuple), Результаты по непрерывным метрикам, общие показатели и результаты по бинарным метрикам
+        (None, если metrics_for_binary не задан)
+        """
+        # Continuous metrics
+        res, total = Pipeline.compute_results_continuous(df_gr, experiment_var_col, metrics)
+        res = res.reset_index()
+
+        # Binary metrics
+        bin_res = None
+        if metrics_for_binary is not None:
+            bin_res = Pipeline.compute_results_binary(df_gr, experiment_var_col, metrics_for_binary)
+            bin_res = bin_res.reset_index().drop("cnt", axis=1)
+
+        return res, total, bin_res
+
     def pipeline(self, groupby_col, metric_aggregations, experiment_var_col, groups=None, show_total=True,
-                 experiment_id=None, metrics_for_binary=None):
+                 experiment_id=None, metrics_for_binary=None, batch_binary=False, min_slice_rows=1,
+                 n_jobs=1, executor=None, state_path=None, state_overwrite=False):
         """
         Метод с пайплайном анализа результатов всего A/B теста. Выполняет предобработку и группировку данных.
         Возможно посмотреть результаты A/B теста в определенных разрезах (например отдельно по новым пользователям)
@@ -202,6 +526,18 @@ class Pipeline:
             Словарь с названиями столбцов датафрейма, для расчета CR следующей структуры:
             {"success_col_1": "tries_col_1", "success_col_2": "tries_col_2", ...}
             где success и tries столбцы по которым будет считаться отношение успехи/попытки
+        :param batch_binary: (bool, optional, default=False), Если True, бинарные метрики считаются сразу для всех
+        срезов одним векторизованным проходом (см. compute_results_binary_batch), а не отдельно для каждого среза
+        :param min_slice_rows: (int, optional, default=1), Срезы, в которых строк меньше min_slice_rows, пропускаются.
+        Кол-во пропущенных срезов сохраняется в self.skipped_slices
+        :param n_jobs: (int, optional, default=1), Кол-во процессов, по которым распределяются срезы,
+        -1 - по числу ядер. Учитывается только при groups != None
+        :param executor: (concurrent.futures.Executor, optional, default=None), Готовый пул, в котором будут
+        считаться срезы, имеет приоритет над n_jobs
+        :param state_path: (str, optional, default=None), Инкрементальный режим для регулярного перезапуска по
+        идущему эксперименту: путь к файлу с кубом достаточных статистик предыдущего запуска (см. update_state).
+        В self.df достаточно передать только данные за новые дни, результаты считаются по всей истории
+        :param state_overwrite: (bool, optional, default=False), См. описание метода update_state
 
         :return: При groups = None возвращаются общие результаты для групп.
         При show_total = True к результатам будет добавлен датафрейм с общими показателями теста
@@ -212,9 +548,25 @@ class Pipeline:
         results = None
         bin_results = None
         res = []
+        self.skipped_slices = 0
+
+        if self._aggregates is not None and not SufficientStatistics.supports(metric_aggregations):
+            raise ValueError(f"Pre-aggregated data supports only {SufficientStatistics.AGGREGATIONS} aggregations")
+
+        stats = None
+        _keys = [groupby_col, experiment_var_col] + list(groups or [])
+        if state_path is not None:
+            stats = self.update_state(state_path, _keys, list(metric_aggregations), groupby_col,
+                                      overwrite=state_overwrite, metric_aggregations=metric_aggregations)
+        elif SufficientStatistics.supports(metric_aggregations):
+            stats = self.sufficient_statistics(_keys, list(metric_aggregations))
 
         if groups is None:
-            _df_gr = self.df.groupby([groupby_col, experiment_var_col], as_index=False).agg(metric_aggregations)
+            if stats is not None:
+                _df_gr = stats.aggregate([groupby_col, experiment_var_col], metric_aggregations)
+            else:
+                _df_gr = self.df.groupby([groupby_col, experiment_var_col], as_index=False)\
+                    .agg(metric_aggregations)
             _res, total = self.compute_results_continuous(_df_gr, experiment_var_col, list(metric_aggregations.keys()))
 
             if experiment_id is not None:
@@ -230,7 +582,13 @@ class Pipeline:
             res.extend([_res, total])
 
             if metrics_for_binary is not None:
-                bin_res = self.compute_results_binary(_df_gr, experiment_var_col, metrics_for_binary)
+                if batch_binary:
+                    bin_res = self.compute_results_binary_batch(self.df, groupby_col, experiment_var_col,
+                                                                metric_aggregations, metrics_for_binary,
+                                                                stats=stats)
+                    bin_res = bin_res.set_index(['cnt', 'first', 'second', 'metric'])
+                else:
+                    bin_res = self.compute_results_binary(_df_gr, experiment_var_col, metrics_for_binary)
                 if experiment_id is not None:
                     bin_res['experiment_id'] = experiment_id
 
@@ -240,60 +598,73 @@ class Pipeline:
 
         # Кол-во срезов в комбинации не может быть больше чем кол-во групп
         max_comb_len = len(groups)
+        binary_per_slice = metrics_for_binary is not None and not batch_binary
+
+        # Зададим в индексы максимально возможное кол-во срезов в одной группе
+        _indx = ['cnt'] + [f'group_{i}' for i in range(max_comb_len)]
+        results = ResultBuilder(_indx)
+        totals = ResultBuilder(_indx)
+        if binary_per_slice:
+            bin_results = ResultBuilder(_indx)
 
         # Считаем разультаты для каждой возможной комбинации срезов по длинам от 1 до len(groups)
         # Это сделано для того, чтобы итоговые результаты анализа тестов было возможно посмотреть
         # Во всех возможных комбинациях разрезов
-        for group_comb in self.compute_combinations(groups, max_len=max_comb_len):
-            for val_comb, df_gr in self.grouper(groupby_col, experiment_var_col, group_comb, metric_aggregations):
-
-                # Continuous metrics
-                res, total = self.compute_results_continuous(df_gr, experiment_var_col, list(metric_aggregations.keys()))
-                res = res.reset_index()
-
-                # Binary metrics
-                if metrics_for_binary is not None:
-                    bin_res = self.compute_results_binary(df_gr, experiment_var_col, metrics_for_binary)
-                    bin_res = bin_res.reset_index().drop("cnt", axis=1)
-
-                if results is None:
-                    # Зададим в индексы максимально возможное кол-во срезов в одной группе
-                    _indx = ['cnt'] + [f'group_{i}' for i in range(max_comb_len)]
-
-                    results = pd.DataFrame(columns=np.append(_indx, res.columns))
-                    results = results.set_index(_indx)
-                    totals = pd.DataFrame(columns=np.append(_indx, total.columns))
-                    totals = totals.set_index(_indx)
-                    if metrics_for_binary is not None:
-                        bin_results = pd.DataFrame(columns=np.append(_indx, bin_res.columns))
-                        bin_results = bin_results.set_index(_indx)
-
-                for i, _r in enumerate(res.values):
-                    try:
-                        # Дополним пустые индексы групп как "No group"
-                        # Таких max_comb_len - len(val_com)
-                        _new_index = tuple([str(i)] + [name for name in val_comb] +
-                                         ["No group"] * (max_comb_len - len(val_comb)))
-                        results.loc[_new_index, :] = _r
-                    except:
-                        print(results, val_comb, _r)
-                        raise
-
-                for i, _t in enumerate(total.values):
-                    _new_index = tuple([str(i)] + [name for name in val_comb] +
-                                         ["No group"] * (max_comb_len - len(val_comb)))
-                    totals.loc[_new_index, :] = _t
-
-                if metrics_for_binary is not None:
-                    for i, _bin in enumerate(bin_res.values):
-                        _new_index = tuple([str(i)] + [name for name in val_comb] +
-                                             ["No group"] * (max_comb_len - len(val_comb)))
-                        bin_results.loc[_new_index, :] = _bin
+        slices = ((val_comb, df_gr)
+                  for group_comb in self.compute_combinations(groups, max_len=max_comb_len)
+                  for val_comb, df_gr in self.grouper(groupby_col, experiment_var_col, group_comb,
+                                                      metric_aggregations, groups=groups, min_rows=min_slice_rows))
+        _slice_args = (experiment_var_col, list(metric_aggregations.keys()),
+                       metrics_for_binary if binary_per_slice else None)
+
+        _own_executor = None
+        if executor is None and n_jobs != 1:
+            _own_executor = executor = ProcessPoolExecutor(max_workers=None if n_jobs == -1 else n_jobs)
+
+        try:
+            if executor is None:
+                slice_results = ((val_comb, self.compute_slice(df_gr, *_slice_args)) for val_comb, df_gr in slices)
+            else:
+                # В процессы передаются только агрегированные данные среза, результаты собираются
+                # в порядке срезов, поэтому не зависят от порядка завершения задач
+                futures = [(val_comb, executor.submit(Pipeline.compute_slice, df_gr, *_slice_args))
+                           for val_comb, df_gr in slices]
+                slice_results = ((val_comb, future.result()) for val_comb, future in futures)
+
+            for val_comb, (res, total, bin_res) in slice_results:
+                # Дополним пустые индексы групп как "No group"
+                # Таких max_comb_len - len(val_com)
+                _slice = dict(zip(_indx[1:], list(val_comb) + ["No group"] * (max_comb_len - len(val_comb))))
+
+                results.extend(res.assign(cnt=[str(i) for i in range(len(res))]), **_slice)
+                totals.extend(total.assign(cnt=[str(i) for i in range(len(total))]), **_slice)
+
+                if binary_per_slice:
+                    bin_results.extend(bin_res.assign(cnt=[str(i) for i in range(len(bin_res))]), **_slice)
+        finally:
+            if _own_executor is not None:
+                _own_executor.shutdown()
+
+        results = results.build()
+        totals = totals.build()
+        if binary_per_slice:
+            bin_results = bin_results.build()
+
+        if self.verbose > 0:
+            print(f"Skipped {self.skipped_slices} slices with less than {min_slice_rows} rows")
+
+        if metrics_for_binary is not None and batch_binary:
+            bin_results = self.compute_results_binary_batch(self.df, groupby_col, experiment_var_col,
+                                                            metric_aggregations, metrics_for_binary, groups=groups,
+                                                            stats=stats, min_rows=min_slice_rows,
+                                                            counts=self.slice_counts(groups) if stats is None
+                                                            else stats.rows(groups))
+            bin_results = bin_results.set_index(_indx)
 
         if experiment_id is not None:
             results['experiment_id'] = experiment_id
             totals['experiment_id'] = experiment_id
-            if bin_results:
+            if bin_results is not None:
                 bin_results['experiment_id'] = experiment_id
 
         # Приводим нейминг таблиц с groups и без groups к единому виду
@@ -314,3 +685,97 @@ class Pipeline:
             return results, totals, bin_results
 
         return results
+
+
+def stat_results_table(pipeline_results, groups=None, experiment_col='experimentId'):
+    """
+    Собирает результаты Pipeline.pipeline по одному эксперименту в одну таблицу в формате, который использует
+    дашборд (см. visual.data_processing.process_stat_res_table): group_0, ..., first, second, metric, mean_lift,
+    test_type, p_value, experimentId. Результаты по непрерывным и бинарным метрикам идут друг за другом
+    :param pipeline_results: (tuple), Результат Pipeline.pipeline с show_total=True и заданным experiment_id
+    :param groups: (iterable, optional, default=None), Значение groups, с которым был вызван pipeline
+    :param experiment_col: (str, optional, default='experimentId'), Название столбца с ID эксперимента
+    :return: (pandas.DataFrame)
+    """
+    if groups is None:
+        tables = [pipeline_results[0].rename(columns={'group': 'group_0'})]
+        if len(pipeline_results) > 2:
+            tables.append(pipeline_results[2].reset_index().drop('cnt', axis=1).assign(group_0="No group"))
+    else:
+        tables = [pipeline_results[0]] + list(pipeline_results[2:])
+
+    res = pd.concat(tables, ignore_index=True)
+    return res.rename(columns={'experiment_id': experiment_col})
+
+
+def _run_experiment(experiment_id, df, groupby_col, metric_aggregations, experiment_var_col, groups,
+                    metrics_for_binary, experiment_col, pipeline_kwargs):
+    pipeline_results = Pipeline(df).pipeline(groupby_col, metric_aggregations, experiment_var_col, groups=groups,
+                                             show_total=True, experiment_id=experiment_id,
+                                             metrics_for_binary=metrics_for_binary, **pipeline_kwargs)
+    return stat_results_table(pipeline_results, groups=groups, experiment_col=experiment_col)
+
+
+def run_experiments(df, groupby_col, metric_aggregations, experiment_var_col, experiment_col='experimentId',
+                    groups=None, metrics_for_binary=None, n_jobs=1, executor=None, output_path=None,
+                    errors='raise', **pipeline_kwargs):
+    """
+    Пересчет результатов сразу для многих экспериментов, например для всего бэклога из выгрузки
+    core.get_data.query. Данные один раз группируются по ID эксперимента, Pipeline.pipeline по каждому
+    эксперименту запускается в пуле процессов, а результаты собираются в одну таблицу в формате
+    stat_results_table в порядке появления экспериментов в данных
+    :param df: (pandas.DataFrame), Данные по всем экспериментам в long-формате
+    :param groupby_col: (str), См. описание метода Pipeline.pipeline
+    :param metric_aggregations: (dict), См. описание метода Pipeline.pipeline
+    :param experiment_var_col: (str), См. описание метода Pipeline.pipeline
+    :param experiment_col: (str, optional, default='experimentId'), Название столбца с ID эксперимента
+    :param groups: (iterable, optional, default=None), См. описание метода Pipeline.pipeline
+    :param metrics_for_binary: (dict, optional, default=None), См. описание метода Pipeline.pipeline
+    :param n_jobs: (int, optional, default=1), Кол-во процессов, -1 - по числу ядер
+    :param executor: (concurrent.futures.Executor, optional, default=None), Готовый пул, имеет приоритет над n_jobs
+    :param output_path: (str, optional, default=None), Если задан, итоговая таблица сохраняется в csv,
+    который читает дашборд
+    :param errors: (str, optional, default='raise'), 'raise' - прервать расчет при ошибке в одном из экспериментов,
+    'skip' - пропустить такой эксперимент и вывести сообщение об ошибке
+    :param pipeline_kwargs: Остальные параметры Pipeline.pipeline, например min_slice_rows
+    :return: (pandas.DataFrame)
+    """
+    if errors not in ('raise', 'skip'):
+        raise ValueError("errors must be 'raise' or 'skip'")
+
+    _args = (groupby_col, metric_aggregations, experiment_var_col, groups, metrics_for_binary, experiment_col,
+             pipeline_kwargs)
+    experiments = df.groupby(experiment_col, sort=False)
+
+    _own_executor = None
+    if executor is None and n_jobs != 1:
+        _own_executor = executor = ProcessPoolExecutor(max_workers=None if n_jobs == -1 else n_jobs)
+
+    tables = []
+    try:
+        if executor is None:
+            tasks = [(experiment_id, None, part) for experiment_id, part in experiments]
+        else:
+            # В процесс передаются только данные его эксперимента
+            tasks = [(experiment_id, executor.submit(_run_experiment, experiment_id, part, *_args), None)
+                     for experiment_id, part in experiments]
+
+        for experiment_id, future, part in tasks:
+            try:
+                table = _run_experiment(experiment_id, part, *_args) if future is None else future.result()
+            except Exception as e:
+                if errors == 'raise':
+                    raise
+                print(f"Experiment {experiment_id} was skipped: {e!r}")
+                continue
+            tables.append(table)
+    finally:
+        if _own_executor is not None:
+            _own_executor.shutdown()
+
+    res = pd.concat(tables, ignore_index=True) if tables else pd.DataFrame()
+
+    if output_path is not None:
+        res.to_csv(output_path, index=False)
+
+    return res
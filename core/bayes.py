@@ -1,6 +1,7 @@
 import numpy as np
 from math import lgamma
-from scipy.stats import beta as beta_distr
+from scipy.special import gammaln
+from scipy.stats import beta as beta_distr, norm
 
 
 class BayesTest:
@@ -37,7 +38,104 @@ class BayesTest:
             yield self.h(a, b, c, d) / d
 
     def g(self, a, b, c, d):
-        return self.g0(a, b, c) + sum(self.calc(a, b, c, d))
+        return float(np.exp(self.log_g_batch([a], [b], [c], [d])[0]))
+
+    @staticmethod
+    def log_g_batch(a, b, c, d, block_size=2 ** 20):
+        """
+        Векторизованный логарифм g(a, b, c, d) = P(Beta(a, b) > Beta(c, d)) для массивов параметров.
+        Слагаемые h(a, b, c, k) / k считаются через gammaln сразу на numpy-диапазоне k и суммируются в log-пространстве.
+        Т.к. g(a, b, c, d) = g(d, c, b, a), сумма всегда берется по меньшему из a и d, т.е. по min(конверсии,
+        не-конверсии) слагаемых
+
+        :param a, b, c, d: (array-like), Параметры бета-распределений
+        :param block_size: (int, optional, default=2**20), Примерное кол-во слагаемых, обрабатываемых за один проход,
+            ограничивает потребление памяти
+        :return: (numpy.ndarray), log g(a, b, c, d)
+        """
+        a, b, c, d = np.broadcast_arrays(*(np.asarray(x, dtype=float).ravel() for x in (a, b, c, d)))
+        swap = a < d
+        a, b, c, d = np.where(swap, d, a), np.where(swap, c, b), np.where(swap, b, c), np.where(swap, a, d)
+
+        log_g0 = gammaln(a + b) + gammaln(a + c) - gammaln(a + b + c) - gammaln(a)
+        # Часть логарифма слагаемых, не зависящая от k
+        log_const = (gammaln(a + c) + gammaln(a + b) - gammaln(a) - gammaln(b) - gammaln(c))
+        n_terms = np.maximum(np.ceil(d) - 1, 0).astype(np.int64)
+
+        res = np.empty_like(a)
+        starts = np.cumsum(n_terms) - n_terms
+        for block in np.unique(starts // block_size):
+            idx = np.flatnonzero(starts // block_size == block)
+            n = n_terms[idx]
+            seg = np.repeat(np.arange(len(idx)), n)
+            k = d[idx][seg] - 1 - (np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n))
+
+            log_terms = (log_const[idx][seg] + gammaln(b[idx][seg] + k) + gammaln(c[idx][seg] + k)
+                         - gammaln(k) - gammaln(a[idx][seg] + b[idx][seg] + c[idx][seg] + k) - np.log(k))
+
+            # logsumexp по сегментам: сдвигаем на максимум сегмента, чтобы не было переполнения
+            seg_max = log_g0[idx].copy()
+            non_empty = n > 0
+            if non_empty.any():
+                seg_max[non_empty] = np.maximum(seg_max[non_empty],
+                                                np.maximum.reduceat(log_terms, (np.cumsum(n) - n)[non_empty]))
+            seg_sum = np.bincount(seg, weights=np.exp(log_terms - seg_max[seg]), minlength=len(idx))
+            res[idx] = np.log(np.exp(log_g0[idx] - seg_max) + seg_sum) + seg_max
+
+        return res
+
+    @staticmethod
+    def prob_normal_approx(a, b, c, d):
+        """
+        Нормальная аппроксимация P(Beta(a, b) > Beta(c, d)), применяется при очень больших кол-вах наблюдений
+        :param a, b, c, d: (array-like), Параметры бета-распределений
+        :return: (numpy.ndarray)
+        """
+        a, b, c, d = (np.asarray(x, dtype=float) for x in (a, b, c, d))
+        mean_1, mean_2 = a / (a + b), c / (c + d)
+        var_1 = a * b / ((a + b) ** 2 * (a + b + 1))
+        var_2 = c * d / ((c + d) ** 2 * (c + d + 1))
+
+        return norm.cdf((mean_1 - mean_2) / np.sqrt(var_1 + var_2))
+
+    @classmethod
+    def batch_prob(cls, conversions_ctrl, conversions_test, impressions_ctrl, impressions_test, max_terms=10 ** 6):
+        """
+        Векторизованный аналог bayes_prob сразу для многих экспериментов (например, для всех срезов теста).
+        Если кол-во слагаемых точной формулы для эксперимента больше max_terms, для него используется нормальная
+        аппроксимация
+
+        :param conversions_ctrl: (array-like), Кол-во конверсий в контрольной группе
+        :param conversions_test: (array-like), Кол-во конверсий в экспериментальной группе
+        :param impressions_ctrl: (array-like), Кол-во показов в контрольной группе
+        :param impressions_test: (array-like), Кол-во показов в экспериментальной группе
+        :param max_terms: (int, optional, default=10**6), Порог кол-ва слагаемых для перехода к нормальной аппроксимации
+        :return: (tuple), два numpy.ndarray - вероятности и лифты, как в bayes_prob
+        """
+        conv_c, conv_t, imp_c, imp_t = np.broadcast_arrays(
+            *(np.asarray(x, dtype=float) for x in (conversions_ctrl, conversions_test,
+                                                     impressions_ctrl, impressions_test))
+        )
+        shape = conv_c.shape
+        a, b = conv_c.ravel() + 1, imp_c.ravel() - conv_c.ravel() + 1
+        c, d = conv_t.ravel() + 1, imp_t.ravel() - conv_t.ravel() + 1
+
+        def _prob(a, b, c, d):
+            prob = np.empty_like(a)
+            exact = np.minimum(a, d) - 1 <= max_terms
+            prob[exact] = np.exp(cls.log_g_batch(a[exact], b[exact], c[exact], d[exact]))
+            prob[~exact] = cls.prob_normal_approx(a[~exact], b[~exact], c[~exact], d[~exact])
+            return prob
+
+        mean_c, mean_t = a / (a + b), c / (c + d)
+        prob = _prob(a, b, c, d)
+        lift = (mean_t - mean_c) / mean_t
+
+        flip = prob < 0.3
+        prob[flip] = _prob(c[flip], d[flip], a[flip], b[flip])
+        lift[flip] = (mean_c[flip] - mean_t[flip]) / mean_c[flip]
+
+        return prob.reshape(shape), lift.reshape(shape)
 
     def calc_prob(self, beta1, beta2):
         return self.g(beta1.args[0], beta1.args[1], beta2.args[0], beta2.args[1])
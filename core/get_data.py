@@ -1,11 +1,29 @@
+import os
+import json
+import shutil
+import hashlib
+import datetime
+from itertools import chain
+from concurrent.futures import ThreadPoolExecutor
 from google.cloud import bigquery
 from google.oauth2 import service_account
+import pyarrow as pa
+import pyarrow.compute
+import pyarrow.dataset as ds
+import pyarrow.parquet
+import pandas as pd
 from core.exceptions import InvalidDataType, InvalidInput
+from core.suff_stats import SufficientStatistics
 import re
 
+try:
+    from google.cloud import bigquery_storage
+except ImportError:
+    bigquery_storage = None
+
 
 def query(table_name, start_date, end_date, experiment_id, events=None, custom_dimensions=None, source='ga',
-          additional_dimensions=None, additional_metrics_query=None):
+          additional_dimensions=None, additional_metrics_query=None, aggregate=False, aggregate_metrics=None):
     """
     Функция получения данных в дефолтных разрезах из данных стриминга GA в BQ.
     Подробнее про схему читайте в https://github.com/realweb-msk/RwAB
@@ -14,7 +32,9 @@ def query(table_name, start_date, end_date, experiment_id, events=None, custom_d
     :param table_name: (str), Название таблицы BQ в формате: projectID.datasetID
     :param start_date: (str), Начальная дата в формате YYYYmmdd
     :param end_date:(str), Конечная дата в формате YYYYmmdd
-    :param experiment_id: (str), ID эксперимента
+    :param experiment_id: (str or list), ID эксперимента или список ID. Для списка данные всех экспериментов
+        выбираются за одно сканирование таблицы, а в результат добавляется столбец experimentId
+        (см. get_experiments_from_bq)
     :param events: (dict, optional, default=None), Словарь с дополнительными событиями. Словарь формата:
         {'field_name': ['eventAction', 'eventCategory']}, например: {'pep': ['Ecom', 'Click']}
     :param custom_dimensions: (dict, optional, default=None), Словарь с пользовательскими параметрами. Словарь формата:
@@ -27,11 +47,34 @@ def query(table_name, start_date, end_date, experiment_id, events=None, custom_d
             geoNetwork.*
     :param additional_metrics_query: (str, optional, default=None), Строка с частью SQL запроса, в которой
         агрегируются метрики
+    :param aggregate: (bool, optional, default=False), Если True, вместо строки на каждый сеанс запрос возвращает
+        по строке на каждую комбинацию date, experimentVariant, device, region, visitor_type (а также
+        additional_dimensions и custom_dimensions) с кол-вом сеансов n_rows и кол-вом, суммой и суммой квадратов
+        отклонений от среднего каждой метрики: {metric}_count, {metric}_sum, {metric}_m2. Результат можно сразу
+        передать в ab_test_pipeline.Pipeline.from_aggregates
+    :param aggregate_metrics: (list, optional, default=None), Названия метрик из additional_metrics_query,
+        которые нужно агрегировать при aggregate=True
     :return: query - строка с запросом для BQ
     """
 
     additional_metrics_query = '' if additional_metrics_query is None else additional_metrics_query
 
+    # Несколько экспериментов: один проход по таблице с фильтром по массиву ID
+    multi = isinstance(experiment_id, (list, tuple, set))
+    if multi:
+        ids_string = ', '.join(f"'{_id}'" for _id in experiment_id)
+        declare_string = f'''DECLARE start_date, end_date STRING; DECLARE experiment_ids ARRAY<STRING>;
+    SET start_date = '{start_date}'; SET end_date = '{end_date}'; SET experiment_ids = [{ids_string}];'''
+        experiment_filter = 'experimentId IN UNNEST(experiment_ids)'
+        experiment_string = 'experimentId,'
+        experiment_groupby = ', experimentId'
+    else:
+        declare_string = f'''DECLARE start_date, end_date, experiment_id STRING;
+    SET start_date = '{start_date}'; SET end_date = '{end_date}'; SET experiment_id = '{experiment_id}';'''
+        experiment_filter = 'experimentId = experiment_id'
+        experiment_string = ''
+        experiment_groupby = ''
+
     event_string = ''''''
     if events is not None:
         for event, list_ in events.items():
@@ -40,44 +83,41 @@ def query(table_name, start_date, end_date, experiment_id, events=None, custom_d
             event_string += f"""COUNTIF(hits.eventInfo.eventCategory = '{event_category}' 
             AND hits.eventinfo.eventAction = '{event_action}') AS {event},"""
 
-    cd_query = ''''''
+    # Пользовательские параметры извлекаются в том же проходе по таблице, что и метрики: подзапросы читают
+    # массивы строки ga_sessions (все хиты сеанса, а не только хиты эксперимента), поэтому не нужны
+    # ни повторное сканирование таблицы, ни JOIN по session_id. Подзапросы считаются один раз на сеанс
+    # в проекции до UNNEST(hits), иначе подзапрос по всем хитам повторялся бы для каждого хита сеанса
+    cd_string = ''''''
+    cd_projection = ''''''
     if custom_dimensions is not None:
-        cd_string = ''''''
         for cd, list_ in custom_dimensions.items():
             cd_index = list_[0]
             cd_lvl = list_[1]
             if cd_lvl == 'hits':
-                cd_string += f'''MAX((SELECT MAX(value) AS rrr FROM UNNEST(hits.customDimensions) 
-                WHERE index={cd_index})) AS {cd},'''
+                cd_projection += f'''(SELECT MAX(cd.value) FROM UNNEST(hits) AS h, UNNEST(h.customDimensions) AS cd 
+                WHERE cd.index={cd_index}) AS _cd_{cd},'''
 
             elif cd_lvl in ('session', 'user'):
-                cd_string += f'''MAX((SELECT MAX(value) AS rrr FROM UNNEST(ga.customDimensions) 
-                WHERE index={cd_index})) AS {cd},'''
-
-        cd_query = f'''
-        ,custom_dim AS(
-        SELECT
-        
-        CONCAT(fullvisitorid, CAST(visitstarttime AS STRING)) AS session_id,
-        
-        {cd_string}
-        
-        FROM `{table_name}.ga_sessions_*` ga, UNNEST(hits) AS hits
+                cd_projection += f'''(SELECT MAX(value) FROM UNNEST(customDimensions) 
+                WHERE index={cd_index}) AS _cd_{cd},'''
+
+            else:
+                continue
+
+            cd_string += f'''MAX(_cd_{cd}) AS {cd},'''
+
+    sessions_string = f'''`{table_name}.ga_sessions_*`'''
+    filter_string = f'''_TABLE_SUFFIX BETWEEN start_date AND end_date
+    AND {experiment_filter}'''
+    if cd_projection:
+        sessions_string = f'''(
+        SELECT *, {cd_projection.rstrip(',')}
+        FROM {sessions_string}
         WHERE _TABLE_SUFFIX BETWEEN start_date AND end_date
-        GROUP BY 1
     )'''
+        filter_string = experiment_filter
 
-    if custom_dimensions is None:
-        total_query = '''SELECT * FROM main'''
-    else:
-        total_query = '''
-            SELECT 
-            main.*,
-            custom_dim.* EXCEPT(session_id)
-            FROM main
-            LEFT JOIN custom_dim
-            ON main.session_id = custom_dim.session_id
-            '''
+    total_query = '''SELECT * FROM main'''
 
     dim_string = ''''''
     groupby_string = ''''''
@@ -91,11 +131,33 @@ def query(table_name, start_date, end_date, experiment_id, events=None, custom_d
                 raise InvalidDataType(f"""Dimensions must be one of the following: 
                 visitNumber, trafficSource.*, trafficSource.adwordsClickInfo.*, device.*, geoNetwork.*, got {dim}""")
 
+    if aggregate:
+        # Агрегация на стороне BQ: по сеансам считаются только достаточные статистики (см. core.suff_stats)
+        keys = ['experimentId'] if multi else []
+        keys += ['date', 'experimentVariant', 'device', 'region', 'visitor_type']
+        keys += [dim.split('.')[-1] for dim in additional_dimensions or []]
+        keys += list(custom_dimensions or {})
+        metrics = ['transactions', 'transactionRevenue', 'duration', 'pageviews']
+        metrics += list(events or {}) + list(aggregate_metrics or [])
+
+        metric_string = ','.join(f'''
+            COUNT({metric}) AS {metric}_count,
+            COALESCE(SUM({metric}), 0) AS {metric}_sum,
+            COALESCE(VAR_POP({metric}) * COUNT({metric}), 0) AS {metric}_m2''' for metric in metrics)
+
+        total_query = f'''
+            SELECT
+            {', '.join(keys)},
+            COUNT(*) AS {SufficientStatistics.ROWS},
+            {metric_string}
+            FROM ({total_query})
+            GROUP BY {', '.join(keys)}
+            '''
+
 
     ########### total query ###########
     query_string = f"""
-    DECLARE start_date, end_date, experiment_id STRING;
-    SET start_date = '{start_date}'; SET end_date = '{end_date}'; SET experiment_id = '{experiment_id}';
+    {declare_string}
     
     WITH main AS(
     SELECT 
@@ -104,6 +166,7 @@ def query(table_name, start_date, end_date, experiment_id, events=None, custom_d
     clientid AS client_id,
     device.deviceCategory AS device,
     geoNetwork.region AS region,
+    {experiment_string}
     {dim_string}
     
     -- Метрики
@@ -116,21 +179,96 @@ def query(table_name, start_date, end_date, experiment_id, events=None, custom_d
     COUNTIF(hits.type = 'PAGE') AS pageviews,
     {additional_metrics_query}
     {event_string}
+    {cd_string}
     
-    FROM `{table_name}.ga_sessions_*` ga, UNNEST(hits) AS hits, UNNEST(hits.experiment)
-    WHERE _TABLE_SUFFIX BETWEEN start_date AND end_date
-    AND experimentId = experiment_id
-    GROUP BY date, client_id, device, visitor_type, session_id, geoNetwork.region{groupby_string}
+    FROM {sessions_string} ga, UNNEST(hits) AS hits, UNNEST(hits.experiment)
+    WHERE {filter_string}
+    GROUP BY date, client_id, device, visitor_type, session_id, geoNetwork.region{experiment_groupby}{groupby_string}
     )
     
-    {cd_query}
-    
     {total_query}
     """
 
     return query_string
 
 
+# Поля верхнего уровня схемы экспорта GA в BQ и поля хитов/экспериментов, к которым запросы из query обращаются
+# без префикса (через UNNEST(hits) AS hits, UNNEST(hits.experiment))
+GA_SESSION_FIELDS = ('visitorId', 'visitNumber', 'visitId', 'visitStartTime', 'date', 'totals', 'trafficSource',
+                     'device', 'geoNetwork', 'customDimensions', 'hits', 'fullVisitorId', 'userId', 'clientId',
+                     'channelGrouping', 'socialEngagementType')
+GA_HIT_FIELDS = ('hitNumber', 'time', 'hour', 'minute', 'isInteraction', 'isEntrance', 'isExit', 'referer', 'page',
+                 'transaction', 'item', 'contentInfo', 'appInfo', 'exceptionInfo', 'eventInfo', 'product',
+                 'promotion', 'eCommerceAction', 'experiment', 'publisher', 'customVariables', 'customDimensions',
+                 'customMetrics', 'type', 'social', 'latencyTracking', 'sourcePropertyInfo', 'contentGroup',
+                 'dataSource')
+GA_EXPERIMENT_FIELDS = ('experimentId', 'experimentVariant')
+
+
+def explain_query(query_string):
+    """
+    Офлайн-разбор запроса, построенного функцией query: какие таблицы и сколько раз сканируются и какие столбцы
+    схемы GA читаются. Стоимость запроса в BQ определяется объемом прочитанных столбцов за все сканирования,
+    поэтому по результату можно сравнить варианты запроса, не отправляя их в BQ
+
+    :param query_string: (str), SQL запрос
+    :return: (dict), {'tables': {table_name: кол-во сканирований}, 'scans': общее кол-во сканирований,
+        'joins': кол-во JOIN, 'columns': отсортированный список прочитанных столбцов}
+    """
+    # Комментарии и строковые литералы не содержат обращений к столбцам
+    sql = re.sub(r'--[^\n]*', ' ', query_string)
+    sql = re.sub(r"'[^']*'|\"[^\"]*\"", ' ', sql)
+
+    tables = {}
+    for table in re.findall(r'`([^`]+)`', sql):
+        tables[table] = tables.get(table, 0) + 1
+    sql = re.sub(r'`[^`]+`', ' ', sql)
+
+    # Псевдонимы массивов: UNNEST(ga.hits) AS h -> h.time означает hits.time
+    aliases = {alias.lower(): path for path, alias in
+               re.findall(r'UNNEST\(\s*([\w.]+)\s*\)\s+AS\s+(\w+)', sql, flags=re.IGNORECASE)
+               if alias.lower() != path.split('.')[-1].lower()}
+    # Псевдонимы столбцов и типы в CAST
+    sql = re.sub(r'\bAS\s+\w+', ' ', sql, flags=re.IGNORECASE)
+
+    session_fields = {f.lower(): f for f in GA_SESSION_FIELDS}
+    hit_fields = {f.lower(): f for f in GA_HIT_FIELDS}
+    experiment_fields = {f.lower(): f for f in GA_EXPERIMENT_FIELDS}
+
+    paths = set()
+    for ref in re.findall(r'\b[A-Za-z_]\w*(?:\.[A-Za-z_]\w*)*', sql):
+        parts = ref.split('.')
+        for _ in range(len(aliases)):
+            if parts[0].lower() not in aliases:
+                break
+            parts = aliases[parts[0].lower()].split('.') + parts[1:]
+        if parts[0].lower() == 'ga':
+            parts = parts[1:]
+        if not parts:
+            continue
+
+        root = parts[0].lower()
+        if root == 'hits' and len(parts) > 1 and parts[1].lower() in hit_fields:
+            parts = ['hits', hit_fields[parts[1].lower()]] + parts[2:]
+        elif root in session_fields:
+            parts = [session_fields[root]] + parts[1:]
+        elif root in hit_fields:
+            parts = ['hits', hit_fields[root]] + parts[1:]
+        elif root in experiment_fields:
+            parts = ['hits', 'experiment', experiment_fields[root]]
+        else:
+            continue
+
+        paths.add('.'.join(parts))
+
+    # Оставляем только самые вложенные пути: hits и hits.time -> hits.time
+    columns = sorted(path for path in paths
+                     if not any(other.lower().startswith(path.lower() + '.') for other in paths))
+
+    return {'tables': tables, 'scans': sum(tables.values()),
+            'joins': len(re.findall(r'\bJOIN\b', sql, flags=re.IGNORECASE)), 'columns': columns}
+
+
 def to_bq_type(type):
     """
     Функция для специализации BQ типов
@@ -225,20 +363,369 @@ def to_bq(df, path_to_json_creds, project_id, bq_dataset_name, bq_table_name, cr
     return f"Add {bq_table_name} to {project_id}.{bq_dataset_name} with {write_disposition}"
 
 
-def get_from_bq(path_to_json_creds, project_id, sql_query):
+class BigQueryFetcher:
+    """
+    Загружает результат запроса BQ в виде Arrow record batches. Если установлен google-cloud-bigquery-storage,
+    данные читаются через BigQuery Storage Read API, иначе - постранично через REST, но тоже сразу в Arrow,
+    без промежуточных python-объектов.
+
+    Любой объект с методом iter_batches(sql_query, columns=None), возвращающим итератор pyarrow.RecordBatch,
+    может использоваться вместо BigQueryFetcher в stream_from_bq, bq_to_parquet и get_from_bq
+    (см. ArrowTableFetcher)
+
+    :param path_to_json_creds: (str), Путь до JSON ключа из GCS
+    :param project_id: (str), Имя проекта BQ
+    :param use_storage_api: (bool, optional, default=True), Использовать ли BigQuery Storage Read API
+    :param page_size: (int, optional, default=None), Кол-во строк на страницу при чтении через REST
+    """
+
+    def __init__(self, path_to_json_creds, project_id, use_storage_api=True, page_size=None):
+        creds = service_account.Credentials.from_service_account_file(path_to_json_creds)
+        self.client = bigquery.Client(credentials=creds, project=project_id)
+        self.page_size = page_size
+
+        if use_storage_api and bigquery_storage is not None:
+            self.bqstorage_client = bigquery_storage.BigQueryReadClient(credentials=creds)
+        else:
+            self.bqstorage_client = None
+
+    def _destination(self, query_job):
+        """
+        Таблица с результатом запроса. Для запросов с DECLARE/SET (см. query) результат лежит в таблице
+        последнего дочернего задания
+        """
+        if query_job.destination is not None:
+            return query_job.destination
+
+        children = list(self.client.list_jobs(parent_job=query_job))
+        return children[0].destination if children else None
+
+    def iter_batches(self, sql_query, columns=None):
+        """
+        :param sql_query: (str), SQL запрос в стандартном диалекте
+        :param columns: (list, optional, default=None), Столбцы, которые нужно загрузить. При чтении через
+        Storage Read API остальные столбцы не передаются по сети
+        :return: (generator), pyarrow.RecordBatch с результатом запроса
+        """
+        query_job = self.client.query(sql_query)
+        rows = query_job.result(page_size=self.page_size)
+
+        if columns is not None:
+            destination = self._destination(query_job)
+            if destination is not None:
+                table = self.client.get_table(destination)
+                fields = [field for field in table.schema if field.name in columns]
+                rows = self.client.list_rows(table, selected_fields=fields, page_size=self.page_size)
+
+        for batch in rows.to_arrow_iterable(bqstorage_client=self.bqstorage_client):
+            yield batch if columns is None else batch.select(columns)
+
+
+class ArrowTableFetcher:
+    """
+    Отдает заранее подготовленные Arrow таблицы вместо результатов запросов к BQ, например для тестов
+    или для работы с локальными выгрузками
+
+    :param tables: (pyarrow.Table or dict), Таблица, которая возвращается на любой запрос, или словарь
+    {sql_query: pyarrow.Table}
+    :param batch_size: (int, optional, default=65536), Максимальное кол-во строк в одном record batch
+    """
+
+    def __init__(self, tables, batch_size=65536):
+        self.tables = tables
+        self.batch_size = batch_size
+
+    def iter_batches(self, sql_query, columns=None):
+        table = self.tables[sql_query] if isinstance(self.tables, dict) else self.tables
+        if columns is not None:
+            table = table.select(columns)
+
+        yield from table.to_batches(max_chunksize=self.batch_size)
+
+
+def _get_fetcher(path_to_json_creds, project_id, fetcher):
+    if fetcher is not None:
+        return fetcher
+
+    if path_to_json_creds is None or project_id is None:
+        raise InvalidInput("Either fetcher or path_to_json_creds and project_id must be passed")
+
+    return BigQueryFetcher(path_to_json_creds, project_id)
+
+
+def stream_from_bq(sql_query, path_to_json_creds=None, project_id=None, columns=None, fetcher=None):
+    """
+    Функция для потокового получения данных с указанным запросом: в памяти одновременно находится только
+    текущий record batch
+
+    :param sql_query: (str), SQL запрос в стандартном диалекте
+    :param path_to_json_creds: (str, optional, default=None), Путь до JSON ключа из GCS
+    :param project_id: (str, optional, default=None), Имя проекта BQ
+    :param columns: (list, optional, default=None), Столбцы, которые нужно загрузить, по умолчанию - все
+    :param fetcher: (object, optional, default=None), Источник данных, см. BigQueryFetcher. По умолчанию
+    BigQueryFetcher(path_to_json_creds, project_id)
+
+    :return: (generator), pyarrow.RecordBatch с результатом запроса
+    """
+    fetcher = _get_fetcher(path_to_json_creds, project_id, fetcher)
+    yield from fetcher.iter_batches(sql_query, columns=columns)
+
+
+# Файл-метка датасета, записанного bq_to_parquet. Файлы с префиксом '_' pyarrow при чтении датасета пропускает
+DATASET_MARKER = '_RWAB_DATASET'
+
+
+def _reset_dataset_dir(output_path):
+    """
+    Очищает директорию датасета перед перезаписью. Удаляется только директория, записанная bq_to_parquet
+    (с файлом DATASET_MARKER), для любой другой непустой директории - исключение
+    """
+    if os.path.isdir(output_path) and os.listdir(output_path):
+        if not os.path.exists(os.path.join(output_path, DATASET_MARKER)):
+            raise ValueError(f"{output_path} is not empty and is not a dataset written by bq_to_parquet")
+        shutil.rmtree(output_path)
+
+    os.makedirs(output_path, exist_ok=True)
+    open(os.path.join(output_path, DATASET_MARKER), 'w').close()
+
+
+def bq_to_parquet(sql_query, output_path, path_to_json_creds=None, project_id=None, columns=None, fetcher=None,
+                  partitioning=None, max_rows_per_file=1000000):
+    """
+    Функция для записи результата запроса в локальный Parquet датасет без загрузки всего результата в память
+
+    :param sql_query: (str), SQL запрос в стандартном диалекте
+    :param output_path: (str), Директория датасета. Должна быть пустой или датасетом, который ранее записала
+    эта функция: его прежнее содержимое удаляется, чтобы не оставались файлы и партиции предыдущих запусков
+    :param path_to_json_creds: (str, optional, default=None), См. stream_from_bq
+    :param project_id: (str, optional, default=None), См. stream_from_bq
+    :param columns: (list, optional, default=None), См. stream_from_bq
+    :param fetcher: (object, optional, default=None), См. stream_from_bq
+    :param partitioning: (list, optional, default=None), Столбцы для hive-партиционирования датасета,
+    например ['date']
+    :param max_rows_per_file: (int, optional, default=1000000), Максимальное кол-во строк в одном файле
+
+    :return: (int), Кол-во записанных строк
+    """
+    batches = stream_from_bq(sql_query, path_to_json_creds, project_id, columns=columns, fetcher=fetcher)
+    first = next(batches, None)
+    # Директория очищается только после получения первого батча, чтобы при ошибке запроса данные сохранились
+    _reset_dataset_dir(output_path)
+    if first is None:
+        return 0
+
+    n_rows = 0
+
+    def counted(it):
+        nonlocal n_rows
+        for batch in it:
+            n_rows += batch.num_rows
+            yield batch
+
+    ds.write_dataset(counted(chain([first], batches)), output_path, schema=first.schema, format='parquet',
+                     partitioning=partitioning, partitioning_flavor='hive' if partitioning else None,
+                     max_rows_per_file=max_rows_per_file, max_rows_per_group=min(max_rows_per_file, 1 << 20),
+                     existing_data_behavior='overwrite_or_ignore')
+
+    return n_rows
+
+
+def get_from_bq(path_to_json_creds, project_id, sql_query, columns=None, fetcher=None):
     """
     Функция для получения данных с указанным запросом
     :param path_to_json_creds: (str), Путь до JSON ключа из GCS
     :param project_id: (str), Имя проекта BQ
     :param sql_query: (str), SQL запрос в стандартном диалекте
+    :param columns: (list, optional, default=None), См. stream_from_bq
+    :param fetcher: (object, optional, default=None), См. stream_from_bq
 
     :return: results (pandas.DataFrame), Таблица с результатом запроса
     """
-    creds = service_account.Credentials.from_service_account_file(path_to_json_creds)
-    client = bigquery.Client(credentials=creds,project=project_id)
-    query_job = client.query(sql_query)
-    results = query_job.result().to_dataframe()
+    batches = list(stream_from_bq(sql_query, path_to_json_creds, project_id, columns=columns, fetcher=fetcher))
+    if not batches:
+        return pd.DataFrame(columns=columns)
+
+    results = pa.Table.from_batches(batches).to_pandas()
 
     return results
 
 
+def get_experiments_from_bq(path_to_json_creds, project_id, sql_query, experiment_col='experimentId',
+                            output_path=None, columns=None, fetcher=None):
+    """
+    Функция для получения данных сразу по нескольким экспериментам, например с запросом
+    query(..., experiment_id=[id_1, id_2, ...]): таблица сканируется один раз, а результат разбивается
+    по экспериментам
+
+    :param path_to_json_creds: (str), Путь до JSON ключа из GCS
+    :param project_id: (str), Имя проекта BQ
+    :param sql_query: (str), SQL запрос в стандартном диалекте
+    :param experiment_col: (str, optional, default='experimentId'), Столбец с ID эксперимента
+    :param output_path: (str, optional, default=None), Если задан, результат записывается в Parquet датасет,
+    партиционированный по experiment_col (см. bq_to_parquet), без загрузки в память
+    :param columns: (list, optional, default=None), См. stream_from_bq, experiment_col добавляется автоматически
+    :param fetcher: (object, optional, default=None), См. stream_from_bq
+
+    :return: (dict or int), Словарь {ID эксперимента: pandas.DataFrame} или, при заданном output_path,
+    кол-во записанных строк
+    """
+    if columns is not None and experiment_col not in columns:
+        columns = [experiment_col] + list(columns)
+
+    if output_path is not None:
+        return bq_to_parquet(sql_query, output_path, path_to_json_creds, project_id, columns=columns,
+                             fetcher=fetcher, partitioning=[experiment_col])
+
+    results = get_from_bq(path_to_json_creds, project_id, sql_query, columns=columns, fetcher=fetcher)
+    if results.empty:
+        return {}
+
+    return {experiment_id: df.reset_index(drop=True)
+            for experiment_id, df in results.groupby(experiment_col, sort=False)}
+
+
+class BigQueryDayCache:
+    """
+    Локальный кэш выгрузок query/get_from_bq с партициями по дням: для каждого эксперимента и дня хранится
+    отдельный Parquet файл. Таблицы экспорта GA шардированы по дням, и данные за прошедшие дни не меняются,
+    поэтому при повторных запусках из BQ загружаются только отсутствующие в кэше дни и последние settling_days
+    дней, данные за которые еще могут досчитываться. Полный диапазон дат собирается с диска.
+
+    Каждый день загружается отдельным запросом по одному шарду ga_sessions_YYYYmmdd, поэтому объем сканируемых
+    данных такой же, как у одного запроса за весь диапазон, а дни можно загружать параллельно.
+
+    Структура кэша: path/<хэш параметров запроса>/experimentId=<ID>/date=<YYYYmmdd>/part-0.parquet
+
+    :param path: (str), Директория кэша
+    :param settling_days: (int, optional, default=2), Кол-во последних дней (включая сегодняшний), которые
+    всегда загружаются заново
+    :param n_jobs: (int, optional, default=1), Кол-во дней, загружаемых одновременно
+    """
+
+    EXPERIMENT_COL = 'experimentId'
+    DONE = '_SUCCESS'
+
+    def __init__(self, path, settling_days=2, n_jobs=1):
+        self.path = path
+        self.settling_days = settling_days
+        self.n_jobs = n_jobs
+        # Дни, загруженные из BQ при последнем вызове get
+        self.fetched_days = []
+
+        os.makedirs(path, exist_ok=True)
+
+    @staticmethod
+    def query_key(table_name, columns=None, **query_kwargs):
+        """
+        Хэш параметров запроса, от которых зависит схема и содержание выгрузки (кроме дат и ID эксперимента)
+        """
+        payload = json.dumps({'table_name': table_name, 'columns': columns, **query_kwargs},
+                             sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode()).hexdigest()[:16]
+
+    def _day_dir(self, key, experiment_id, day):
+        return os.path.join(self.path, key, f'{self.EXPERIMENT_COL}={experiment_id}', f'date={day}')
+
+    def _is_cached(self, key, experiment_id, day):
+        return os.path.exists(os.path.join(self._day_dir(key, experiment_id, day), self.DONE))
+
+    def _write_day(self, key, experiment_id, day, table):
+        day_dir = self._day_dir(key, experiment_id, day)
+        # Сначала пишем во временную директорию, чтобы при сбое в кэше не оставалось неполных дней
+        tmp = f'{day_dir}.{os.getpid()}.tmp'
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+
+        if table is not None and table.num_rows:
+            pa.parquet.write_table(table, os.path.join(tmp, 'part-0.parquet'))
+        open(os.path.join(tmp, self.DONE), 'w').close()
+
+        shutil.rmtree(day_dir, ignore_errors=True)
+        os.replace(tmp, day_dir)
+
+    def _fetch_day(self, fetcher, key, table_name, experiment_ids, day, columns, query_kwargs):
+        sql_query = query(table_name, day, day, list(experiment_ids), **query_kwargs)
+        if columns is not None and self.EXPERIMENT_COL not in columns:
+            columns = [self.EXPERIMENT_COL] + list(columns)
+
+        batches = list(fetcher.iter_batches(sql_query, columns=columns))
+        table = pa.Table.from_batches(batches) if batches else None
+
+        for experiment_id in experiment_ids:
+            part = None
+            if table is not None:
+                mask = pa.compute.equal(table[self.EXPERIMENT_COL], experiment_id)
+                part = table.filter(mask)
+            self._write_day(key, experiment_id, day, part)
+
+        return day
+
+    def invalidate(self, experiment_id=None):
+        """
+        Удаляет кэш эксперимента experiment_id или, если он не задан, весь кэш
+        """
+        for key in os.listdir(self.path):
+            if experiment_id is None:
+                shutil.rmtree(os.path.join(self.path, key), ignore_errors=True)
+            else:
+                shutil.rmtree(os.path.join(self.path, key, f'{self.EXPERIMENT_COL}={experiment_id}'),
+                              ignore_errors=True)
+
+    def get(self, table_name, start_date, end_date, experiment_id, path_to_json_creds=None, project_id=None,
+            columns=None, fetcher=None, today=None, **query_kwargs):
+        """
+        Данные запроса query(table_name, start_date, end_date, experiment_id, **query_kwargs) за весь диапазон дат
+
+        :param table_name: (str), См. query
+        :param start_date: (str), Начальная дата в формате YYYYmmdd
+        :param end_date: (str), Конечная дата в формате YYYYmmdd
+        :param experiment_id: (str or list), ID эксперимента или список ID, см. query
+        :param path_to_json_creds: (str, optional, default=None), См. stream_from_bq
+        :param project_id: (str, optional, default=None), См. stream_from_bq
+        :param columns: (list, optional, default=None), См. stream_from_bq
+        :param fetcher: (object, optional, default=None), См. stream_from_bq
+        :param today: (datetime.date, optional, default=None), Дата, от которой отсчитываются settling_days,
+        по умолчанию - сегодняшняя
+        :param query_kwargs: Остальные параметры query (events, custom_dimensions, aggregate и т.д.)
+
+        :return: (pandas.DataFrame), Для списка ID - с дополнительным столбцом experimentId
+        """
+        multi = isinstance(experiment_id, (list, tuple, set))
+        experiment_ids = list(experiment_id) if multi else [experiment_id]
+        key = self.query_key(table_name, columns=columns, **query_kwargs)
+
+        days = pd.date_range(pd.to_datetime(start_date, format='%Y%m%d'),
+                             pd.to_datetime(end_date, format='%Y%m%d')).strftime('%Y%m%d').tolist()
+        today = datetime.date.today() if today is None else today
+        settled = (today - datetime.timedelta(days=self.settling_days)).strftime('%Y%m%d')
+
+        # Для каждого дня загружаются только эксперименты, которых нет в кэше
+        to_fetch = []
+        for day in days:
+            missing = [_id for _id in experiment_ids if day > settled or not self._is_cached(key, _id, day)]
+            if missing:
+                to_fetch.append((day, missing))
+
+        if to_fetch:
+            fetcher = _get_fetcher(path_to_json_creds, project_id, fetcher)
+            args = [(fetcher, key, table_name, missing, day, columns, query_kwargs) for day, missing in to_fetch]
+
+            if self.n_jobs == 1:
+                self.fetched_days = [self._fetch_day(*a) for a in args]
+            else:
+                with ThreadPoolExecutor(max_workers=None if self.n_jobs == -1 else self.n_jobs) as executor:
+                    self.fetched_days = list(executor.map(lambda a: self._fetch_day(*a), args))
+        else:
+            self.fetched_days = []
+
+        files = [os.path.join(self._day_dir(key, _id, day), 'part-0.parquet')
+                 for day in days for _id in experiment_ids]
+        tables = [pa.parquet.read_table(f) for f in files if os.path.exists(f)]
+        if not tables:
+            return pd.DataFrame(columns=columns)
+
+        results = pa.concat_tables(tables, promote_options='default').to_pandas()
+        if not multi:
+            results = results.drop(columns=self.EXPERIMENT_COL)
+
+        return results
@@ -8,10 +8,16 @@ if (float(s_v[1])==12 and float(s_v[2])<1) or (float(s_v[1])<12):
     if (float(s_v[1])==12 and float(s_v[2])<1) or (float(s_v[1])<12):
         print('statsmodels needs to be at least v0.12.1')
 """
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import pandas as pd
-import statsmodels.stats.proportion as stp
 import statsmodels.stats.power as power
+from scipy import stats as st
 from statsmodels.stats.weightstats import ttest_ind
 from sklearn.linear_model import LinearRegression
 from core import stat_test
@@ -53,6 +59,10 @@ def monte_carlo_power_2(baseline_data, weekly_sessions, effect_size, N,
                                     alternative=alternative, usevar='unequal')
             # Test for significance
             significance_results.append(test_result[1] <= alpha)
+        elif method == 'CR z-test':
+            p_value = _cr_ztest_moments(control_data.mean(), N, variant_data.mean(), N, alternative=alternative)
+            # Test for significance
+            significance_results.append(p_value <= alpha)
         elif method == 'Kruskal-Wallis':
             test_result = stat_test.kruskal_wallis(control_data, variant_data, alpha=alpha,
                                                    verbose=0)
@@ -78,12 +88,327 @@ def monte_carlo_power_2(baseline_data, weekly_sessions, effect_size, N,
     return np.mean(significance_results)
 
 
+# Max number of elements in one (chunk_size, 2N) matrix of the simulation engine
+MC_CHUNK_ELEMENTS = 2 ** 21
+
+
+def _spawn_generators(random_state, n):
+    """
+    Creates n independent np.random.Generator's from a seed, np.random.SeedSequence
+    or np.random.Generator via SeedSequence.spawn
+    """
+    if isinstance(random_state, np.random.Generator):
+        random_state = int(random_state.integers(2 ** 63))
+    if not isinstance(random_state, np.random.SeedSequence):
+        random_state = np.random.SeedSequence(random_state)
+
+    return [np.random.default_rng(s) for s in random_state.spawn(n)]
+
+
+def _welch_ttest_moments(mean_x, var_x, n_x, mean_y, var_y, n_y, alternative='two-sided'):
+    """
+    Welch's t-test from sample means and variances (ddof=1) of two samples of sizes n_x and n_y
+
+    Returns p-values
+    """
+    var_x, var_y = var_x / n_x, var_y / n_y
+    t_stat = (mean_x - mean_y) / np.sqrt(var_x + var_y)
+    df = (var_x + var_y) ** 2 / (var_x ** 2 / (n_x - 1) + var_y ** 2 / (n_y - 1))
+
+    if alternative == 'two-sided':
+        return 2 * st.t.sf(np.abs(t_stat), df)
+    elif alternative == 'larger':
+        return st.t.sf(t_stat, df)
+    elif alternative == 'smaller':
+        return st.t.cdf(t_stat, df)
+    raise ValueError("alternative must be one of: 'two-sided', 'larger', 'smaller'")
+
+
+def _cr_ztest_moments(mean_x, n_x, mean_y, n_y, alternative='two-sided'):
+    """
+    Z-test for two proportions with the pooled variance (see stat_test.z_test_ratio)
+    from sample means of binary data of two samples of sizes n_x and n_y
+
+    Returns p-values
+    """
+    p_combined = np.clip((mean_x * n_x + mean_y * n_y) / (n_x + n_y), 0, 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        z_stat = (mean_x - mean_y) / np.sqrt(p_combined * (1 - p_combined) * (1 / n_x + 1 / n_y))
+
+    if alternative == 'two-sided':
+        return 2 * st.norm.sf(np.abs(z_stat))
+    elif alternative == 'larger':
+        return st.norm.sf(z_stat)
+    elif alternative == 'smaller':
+        return st.norm.cdf(z_stat)
+    raise ValueError("alternative must be one of: 'two-sided', 'larger', 'smaller'")
+
+
+def _welch_ttest_rows(x, y, alternative='two-sided'):
+    """
+    Welch's t-test for every row of x and y (equivalent to
+    ttest_ind(x[i], y[i], alternative=alternative, usevar='unequal'))
+
+    Returns p-values, shape (n_rows,)
+    """
+    return _welch_ttest_moments(x.mean(axis=1), x.var(axis=1, ddof=1), x.shape[1],
+                                y.mean(axis=1), y.var(axis=1, ddof=1), y.shape[1],
+                                alternative=alternative)
+
+
+def _rank_sums_rows(x, y):
+    """
+    Ranks pooled rows of x and y with ties averaged (a single sort per row)
+
+    Returns rank sums of x, shape (n_rows,), and tie terms sum(t^3 - t), shape (n_rows,)
+    """
+    n_rows, n_x = x.shape
+    pooled = np.concatenate([x, y], axis=1)
+    n = pooled.shape[1]
+
+    order = np.argsort(pooled, axis=1, kind='mergesort')
+    sorted_ = np.take_along_axis(pooled, order, axis=1)
+
+    # Runs of equal values, numbered globally across rows
+    new_run = np.ones(sorted_.shape, dtype=bool)
+    new_run[:, 1:] = sorted_[:, 1:] != sorted_[:, :-1]
+    run_id = np.cumsum(new_run.ravel()) - 1
+    run_len = np.bincount(run_id)
+    run_start = np.cumsum(run_len) - run_len
+    run_row = run_start // n
+
+    # Average rank of a run is the mean of the positions it spans (ranks start from 1)
+    avg_rank = run_start - run_row * n + (run_len + 1) / 2
+    rank_sum = np.sum(avg_rank[run_id].reshape(n_rows, n) * (order < n_x), axis=1)
+    ties = np.bincount(run_row, weights=run_len ** 3 - run_len, minlength=n_rows)
+
+    return rank_sum, ties
+
+
+def _mann_whitney_rows(x, y, alternative='two-sided'):
+    """
+    Mann-Whitney U test for every row of x and y, normal approximation with tie and continuity corrections
+
+    Returns p-values, shape (n_rows,)
+    """
+    n_x, n_y = x.shape[1], y.shape[1]
+    n = n_x + n_y
+    rank_sum, ties = _rank_sums_rows(x, y)
+
+    u_stat = rank_sum - n_x * (n_x + 1) / 2
+    mu = n_x * n_y / 2
+    sigma = np.sqrt(n_x * n_y / 12 * ((n + 1) - ties / (n * (n - 1))))
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if alternative == 'two-sided':
+            p_value = 2 * st.norm.sf((np.abs(u_stat - mu) - 0.5) / sigma)
+        elif alternative == 'larger':
+            p_value = st.norm.sf((u_stat - mu - 0.5) / sigma)
+        elif alternative == 'smaller':
+            p_value = st.norm.cdf((u_stat - mu + 0.5) / sigma)
+        else:
+            raise ValueError("alternative must be one of: 'two-sided', 'larger', 'smaller'")
+
+    return np.minimum(np.nan_to_num(p_value, nan=1.0), 1.0)
+
+
+def _kruskal_wallis_rows(x, y):
+    """
+    Kruskal-Wallis H test for every row of x and y (two samples)
+
+    Returns p-values, shape (n_rows,)
+    """
+    n_x, n_y = x.shape[1], y.shape[1]
+    n = n_x + n_y
+    rank_sum_x, ties = _rank_sums_rows(x, y)
+    rank_sum_y = n * (n + 1) / 2 - rank_sum_x
+
+    h_stat = 12 / (n * (n + 1)) * (rank_sum_x ** 2 / n_x + rank_sum_y ** 2 / n_y) - 3 * (n + 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        h_stat = h_stat / (1 - ties / (n ** 3 - n))
+
+    return np.nan_to_num(st.chi2.sf(h_stat, 1), nan=1.0)
+
+
+def _resample_chunks(baseline_data, N, num_simulations, random_state=None, chunk_size=None):
+    """
+    Draws control and variant resamples of size N from baseline_data chunk by chunk
+
+    Yields (start, control_data, variant_data) where data are (rows, N) matrices
+    for simulations start, ..., start + rows - 1
+    """
+    if chunk_size is None:
+        chunk_size = max(1, MC_CHUNK_ELEMENTS // (2 * N))
+
+    rng_control, rng_variant = _spawn_generators(random_state, 2)
+
+    for start in range(0, num_simulations, chunk_size):
+        rows = min(chunk_size, num_simulations - start)
+        control_data = baseline_data[rng_control.integers(0, len(baseline_data), size=(rows, N))]
+        variant_data = baseline_data[rng_variant.integers(0, len(baseline_data), size=(rows, N))]
+        yield start, control_data, variant_data
+
+
+def monte_carlo_power_vectorized(baseline_data, effect_size, N,
+                                 alpha=0.05, num_simulations=1000,
+                                 method='t-test', alternative='two-sided',
+                                 random_state=None, chunk_size=None,
+                                 cache=None):
+    """
+    Vectorized version of monte_carlo_power_2.
+
+    All resamples are drawn as (num_simulations, N) index matrices from seeded
+    np.random.Generator's (one for the control and one for the variant group),
+    test statistics are computed along axis 1 for the whole matrix at once.
+    The matrix is processed in chunks of chunk_size simulations, so memory stays
+    bounded for large N. For a given random_state the result doesn't depend on
+    chunk_size.
+
+    Parameters:
+    - baseline_data - baseline data
+    - effect_size - normalised effect size: (mean1 - mean2) / std
+    - N - sample size of each variant
+    - method - 't-test' (Welch's t-test), 'CR z-test' (z-test for proportions,
+      for binary baseline data), 'Mann-Whitney' or 'Kruskal-Wallis'
+    - alternative - 'two-sided', 'larger' or 'smaller' (ignored by Kruskal-Wallis)
+    - random_state - seed, np.random.SeedSequence or np.random.Generator
+    - chunk_size - number of simulations processed at once, by default
+      it is chosen so that a chunk holds about MC_CHUNK_ELEMENTS values
+    - cache - optional dict shared between calls with the same baseline_data.
+      For the 't-test' and 'CR z-test' methods with an integer random_state means
+      and variances of the simulated samples are stored in it and reused for other effect sizes
+      (the lift only shifts the variant mean), so no resampling is needed
+
+    Returns power - share of simulations with a significant result
+    """
+    baseline_data = np.asarray(baseline_data, dtype=float)
+    N = int(N)
+    # lifted_data = control_data - lift
+    shift = effect_size * baseline_data.std()
+
+    if method in ('t-test', 'CR z-test'):
+        key = None
+        if cache is not None and isinstance(random_state, (int, np.integer)):
+            key = ('moments', N, num_simulations, int(random_state))
+
+        if key is not None and key in cache:
+            moments = cache[key]
+        else:
+            moments = np.empty((4, num_simulations))
+            for start, control_data, variant_data in _resample_chunks(baseline_data, N, num_simulations,
+                                                                      random_state, chunk_size):
+                end = start + len(control_data)
+                moments[:, start:end] = (control_data.mean(axis=1), control_data.var(axis=1, ddof=1),
+                                         variant_data.mean(axis=1), variant_data.var(axis=1, ddof=1))
+            if key is not None:
+                cache[key] = moments
+
+        if method == 't-test':
+            p_values = _welch_ttest_moments(moments[0], moments[1], N, moments[2] - shift, moments[3], N,
+                                            alternative=alternative)
+        else:
+            p_values = _cr_ztest_moments(moments[0], N, moments[2] - shift, N, alternative=alternative)
+        return np.mean(p_values <= alpha)
+
+    elif method not in ('Mann-Whitney', 'Kruskal-Wallis'):
+        raise ValueError("method must be one of: 't-test', 'CR z-test', 'Mann-Whitney', 'Kruskal-Wallis'")
+
+    significant = 0
+    for start, control_data, variant_data in _resample_chunks(baseline_data, N, num_simulations,
+                                                              random_state, chunk_size):
+        if method == 'Mann-Whitney':
+            p_values = _mann_whitney_rows(control_data, variant_data - shift, alternative=alternative)
+        else:
+            p_values = _kruskal_wallis_rows(control_data, variant_data - shift)
+
+        significant += np.sum(p_values <= alpha)
+
+    return significant / num_simulations
+
+
+def _analytic_sample_size(effect_size, alpha=0.05, power_=0.8, alternative='two-sided'):
+    """
+    Sample size of one variant from the analytic t-test power formula,
+    used as a warm start for the Monte Carlo search
+    """
+    try:
+        return float(power.tt_ind_solve_power(effect_size=effect_size, nobs1=None, ratio=1,
+                                              alpha=alpha, power=power_, alternative=alternative))
+    except (ValueError, ZeroDivisionError):
+        return np.nan
+
+
+def _bisection_sample_size(is_enough, n_min, n_max, n_start, tol=0.02, confirm=2):
+    """
+    Bisection search of the minimal N in [n_min, n_max] for which
+    is_enough(N) is True.
+
+    N is searched on the geometric lattice n_min * (1 + tol) ** k, so that
+    searches for neighbouring lifts evaluate the same sample sizes. The bracket
+    is found by galloping from n_start with steps of 1, 2, 4, ... lattice points.
+
+    Bisection assumes that is_enough is monotone in N. For Monte Carlo power
+    estimates this holds only approximately: every N is simulated with its own
+    resamples, so the estimate may drop below the target right above the answer.
+    That's why the confirm lattice points above the found N are checked as well,
+    if one of them is not enough, the search continues above it.
+
+    Returns N (n_max if even it is not enough)
+    """
+    k_max = int(np.ceil(np.log(n_max / n_min) / np.log1p(tol))) if n_max > n_min else 0
+
+    def lattice(k):
+        return int(min(n_max, round(n_min * (1 + tol) ** k)))
+
+    k = int(np.clip(np.round(np.log(max(n_start, n_min) / n_min) / np.log1p(tol)), 0, k_max))
+
+    if is_enough(lattice(k)):
+        # lo = -1: all lattice points down to n_min are enough
+        lo, hi, step = -1, k, 1
+        while hi > 0:
+            cand = max(0, hi - step)
+            if not is_enough(lattice(cand)):
+                lo = cand
+                break
+            hi = cand
+            step *= 2
+    else:
+        lo, hi = k, None
+
+    while True:
+        step = 1
+        while hi is None:
+            if lo == k_max:
+                return lattice(k_max)
+            cand = min(k_max, lo + step)
+            if is_enough(lattice(cand)):
+                hi = cand
+            else:
+                lo = cand
+                step *= 2
+
+        while hi - lo > 1:
+            mid = (lo + hi) // 2
+            if is_enough(lattice(mid)):
+                hi = mid
+            else:
+                lo = mid
+
+        failed = [j for j in range(hi + 1, min(k_max, hi + confirm) + 1) if not is_enough(lattice(j))]
+        if not failed:
+            return lattice(hi)
+        lo, hi = failed[-1], None
+
+
 def monte_carlo_sample_size(baseline_data, weekly_sessions, effect_size,
                             method='CR z-test',
                             min_weeks=0.5, max_weeks=4,
                             alpha=0.05, power=0.8,
                             num_simulations=1000,
-                            alternative='two-sided', verbose=0):
+                            alternative='two-sided', verbose=0,
+                            random_state=None, chunk_size=None,
+                            search='scan', n_start=None, tol=0.02,
+                            return_evaluations=False, cache=None):
     """
     Monte Carlo power algorithm:
       Input: baseline data, some lift value
@@ -96,27 +421,202 @@ def monte_carlo_sample_size(baseline_data, weekly_sessions, effect_size,
     1. Set range of lifts
     2. Simulate power calculations for all lifts
     3. See at what sample size each lift value has power=80%
+
+    Power is estimated with monte_carlo_power_vectorized, random_state,
+    chunk_size and cache are passed to it
+
+    Parameters of the search:
+    - search - 'scan' checks sample sizes in 0.5-week steps up to max_weeks,
+      'bisection' runs monotone bisection on N in [min_weeks, max_weeks] weeks
+      warm-started from n_start or from the analytic tt_ind_solve_power estimate.
+      Bisection assumes that power is monotone in N, which holds for the estimates
+      only approximately (see _bisection_sample_size), so the answer is confirmed
+      on a couple of larger sample sizes. It doesn't necessarily need fewer power
+      evaluations than 'scan', but N is found with the precision tol instead of
+      0.5-week steps. Pass the same random_state for neighbouring lifts to reuse
+      simulations across them
+    - n_start - initial guess of N for 'bisection', e.g. result for the previous lift
+    - tol - relative precision of N for 'bisection' (step of the lattice of sample sizes)
+    - return_evaluations - if True, (N, number of power evaluations) is returned
     """
     # for now effect_size is normalised like for the stats.power function
 
-    sample_sizes = np.arange(0.5, max_weeks + 0.5, 0.5) * weekly_sessions  # Sample sizes we will test over
+    # Common random numbers for all sample sizes
+    if random_state is None or isinstance(random_state, np.random.Generator):
+        random_state = int(np.random.default_rng(random_state).integers(2 ** 63))
+
+    powers = {}
+
+    def is_enough(N):
+        N = int(N)
+        if N not in powers:
+            # get power for a given sample size
+            powers[N] = monte_carlo_power_vectorized(baseline_data, effect_size, N=N,
+                                                     alpha=alpha,
+                                                     num_simulations=num_simulations,
+                                                     method=method,
+                                                     alternative=alternative,
+                                                     random_state=random_state,
+                                                     chunk_size=chunk_size,
+                                                     cache=cache)
+        return powers[N] >= power
+
+    if search == 'scan':
+        sample_sizes = np.arange(0.5, max_weeks + 0.5, 0.5) * weekly_sessions  # Sample sizes we will test over
+
+        for i in range(0, len(sample_sizes)):
+            min_sample_size = int(sample_sizes[i])
+            if is_enough(min_sample_size):
+                break
+
+    elif search == 'bisection':
+        n_min = max(2, int(min_weeks * weekly_sessions))
+        n_max = max(n_min, int(max_weeks * weekly_sessions))
+        if n_start is None or np.isnan(n_start):
+            n_start = _analytic_sample_size(effect_size, alpha, power, alternative)
+            n_start = n_max if np.isnan(n_start) else n_start
+
+        min_sample_size = _bisection_sample_size(is_enough, n_min, n_max, n_start, tol=tol)
+
+    else:
+        raise ValueError("search must be one of: 'scan', 'bisection'")
+
+    if return_evaluations:
+        return min_sample_size, len(powers)
 
-    for i in range(0, len(sample_sizes)):
-        N = int(sample_sizes[i])
-        # get power for a given sample size
-        b = monte_carlo_power_2(baseline_data, weekly_sessions, effect_size, N=N,
-                                alpha=alpha, power=power,
-                                num_simulations=num_simulations,
-                                method=method,
-                                alternative=alternative, verbose=verbose)
-        min_sample_size = N
-        if b >= power:
+    return min_sample_size
 
-            break
-        else:
-            continue
 
-    return min_sample_size
+# Number of lifts of the grid processed by one task of monte_carlo_lifts_sample_sizes
+LIFTS_BLOCK_SIZE = 8
+
+
+def _monte_carlo_lifts_block(baseline_data, baseline_sessions, lifts, seeds,
+                             method='t-test', num_simulations=2000,
+                             max_weeks=4, search='scan', cache=None):
+    """
+    Minimal sample sizes for a block of lifts, lifts[i] is simulated with seeds[i].
+    Runs in a worker process of monte_carlo_lifts_sample_sizes.
+
+    Returns list of sample sizes and number of power evaluations
+    """
+    cache = {} if cache is None else cache
+    n = []
+    n_evaluations = 0
+    for i in range(len(lifts)):
+        n_start = None
+        if search == 'bisection' and i > 0:
+            n_start = n[-1] * (_analytic_sample_size(lifts[i]) / _analytic_sample_size(lifts[i - 1]))
+
+        _n, _evaluations = monte_carlo_sample_size(
+            baseline_data, baseline_sessions, lifts[i],
+            num_simulations=num_simulations,
+            method=method, max_weeks=max_weeks,
+            random_state=seeds[i],
+            search=search, n_start=n_start,
+            return_evaluations=True, cache=cache)
+        n.append(_n)
+        n_evaluations += _evaluations
+
+    return n, n_evaluations
+
+
+def monte_carlo_lifts_sample_sizes(baseline_data, baseline_sessions, lifts,
+                                   method='t-test', num_simulations=2000,
+                                   max_weeks=4, random_state=None,
+                                   search='scan',
+                                   n_jobs=1, common_random_numbers=True,
+                                   return_evaluations=False):
+    """
+    Minimal sample sizes from monte_carlo_sample_size for every lift of the grid.
+
+    By default all lifts use the same seed (common random numbers), so for the
+    't-test' method simulations of every sample size are made once and reused
+    for all lifts. With common_random_numbers=False every lift gets its own seed
+    spawned from random_state via SeedSequence.spawn.
+
+    The grid is split into blocks of LIFTS_BLOCK_SIZE lifts, with n_jobs > 1
+    (or -1 for all cores) blocks are processed in a process pool. Seeds are
+    assigned to lifts before the split, so for a given random_state results
+    don't depend on n_jobs. With search='bisection' the search for every next
+    lift of a block is warm-started from the result for the previous one,
+    rescaled by the analytic t-test sample sizes.
+
+    Returns list of sample sizes, with return_evaluations=True also the total
+    number of power evaluations
+    """
+    if isinstance(random_state, np.random.Generator):
+        random_state = int(random_state.integers(2 ** 63))
+    if not isinstance(random_state, np.random.SeedSequence):
+        random_state = np.random.SeedSequence(random_state)
+
+    if common_random_numbers:
+        seeds = [int(random_state.generate_state(1, np.uint64)[0])] * len(lifts)
+    else:
+        seeds = [int(child.generate_state(1, np.uint64)[0]) for child in random_state.spawn(len(lifts))]
+
+    blocks = [(lifts[i:i + LIFTS_BLOCK_SIZE], seeds[i:i + LIFTS_BLOCK_SIZE])
+              for i in range(0, len(lifts), LIFTS_BLOCK_SIZE)]
+    kwargs = dict(method=method, num_simulations=num_simulations, max_weeks=max_weeks, search=search)
+
+    n_jobs = os.cpu_count() if n_jobs == -1 else n_jobs
+    if n_jobs is None or n_jobs <= 1 or len(blocks) <= 1:
+        cache = {}
+        results = [_monte_carlo_lifts_block(baseline_data, baseline_sessions, _lifts, _seeds, cache=cache, **kwargs)
+                   for _lifts, _seeds in blocks]
+    else:
+        with ProcessPoolExecutor(max_workers=min(n_jobs, len(blocks))) as executor:
+            futures = [executor.submit(_monte_carlo_lifts_block, baseline_data, baseline_sessions,
+                                       _lifts, _seeds, **kwargs)
+                       for _lifts, _seeds in blocks]
+            results = [future.result() for future in futures]
+
+    n = [_n for block_n, _ in results for _n in block_n]
+    if return_evaluations:
+        n_evaluations = sum(_evaluations for _, _evaluations in results)
+        return n, n_evaluations
+
+    return n
+
+
+def proportions_sample_size(baseline_cr, lifts, alpha=0.05, power_=0.8, ratio=1, alternative='larger'):
+    """
+    Vectorized closed-form sample size of the first variant for the z-test of two
+    proportions, for every pair of baseline conversion rate and absolute lift.
+    Effect size is Cohen's h (arcsine transformation, as in
+    statsmodels.stats.proportion.proportion_effectsize), the result is the same
+    as of NormalIndPower().solve_power without the root-finding (for 'two-sided'
+    the negligible probability of the opposite tail is ignored).
+
+    Parameters:
+    - baseline_cr - list of baseline conversion rates
+    - lifts - list of absolute lifts
+    - alpha - significance level
+    - power_ - power
+    - ratio - ratio of variants (variant 2 / variant 1)
+    - alternative - 'larger', 'smaller' or 'two-sided'
+
+    Returns np.ndarray of shape (len(baseline_cr), len(lifts))
+    """
+    baseline_cr = np.asarray(baseline_cr, dtype=float).reshape(-1, 1)
+    lifts = np.asarray(lifts, dtype=float).reshape(1, -1)
+
+    effect_size = 2 * np.arcsin(np.sqrt(baseline_cr + lifts)) - 2 * np.arcsin(np.sqrt(baseline_cr))
+    if alternative == 'larger':
+        crit = st.norm.isf(alpha)
+    elif alternative == 'smaller':
+        crit = st.norm.isf(alpha)
+        effect_size = -effect_size
+    elif alternative == 'two-sided':
+        crit = st.norm.isf(alpha / 2)
+        effect_size = np.abs(effect_size)
+    else:
+        raise ValueError("alternative must be one of: 'larger', 'smaller', 'two-sided'")
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        n = ((crit + st.norm.ppf(power_)) / effect_size) ** 2 * (1 + 1 / ratio)
+
+    return np.where(effect_size > 0, n, np.nan)
 
 
 def lifts_n_regression(lifts, sample_sizes, baseline_sessions, max_weeks=4):
@@ -161,7 +661,8 @@ def lifts_weeks_graph(baseline_sessions, cr_name='CR',
                       max_lift=None, max_weeks=4,
                       plot_title='Desktop', plot_width=800,
                       plotly_template='none',
-                      interpolate=True):
+                      interpolate=True,
+                      search='scan', random_state=None, n_jobs=1):
     """
     Creates a plotly.express graph that has number of weeks on the X-axis and
     effect size on the Y-axis
@@ -178,6 +679,7 @@ def lifts_weeks_graph(baseline_sessions, cr_name='CR',
       - 'CR' - for binary data. Performs a z-test (default - one-sided)
       - 'Students t-test formula'
       - 'Monte-Carlo t-test'
+      - 'Monte-Carlo CR z-test' - for binary baseline_data
       - 'Monte-Carlo Kruskal-Wallis'
       - 'Monte-Carlo Mann-Whitney'
       - 'Monte-Carlo Levene'
@@ -195,6 +697,9 @@ def lifts_weeks_graph(baseline_sessions, cr_name='CR',
     Parameters for the 'Monte-Carlo...' methods:
     - num_simulations - number of simulations
     - interpolate - if the results of simulation have to be interpolated
+    - search - 'scan' or 'bisection', see monte_carlo_sample_size
+    - random_state - seed of the simulations
+    - n_jobs - number of worker processes for the grid of lifts, -1 for all cores
     """
 
     # If conversions are a binary variable:
@@ -245,23 +750,8 @@ def lifts_weeks_graph(baseline_sessions, cr_name='CR',
 
             lifts = np.arange(0.0005, max_lift + 0.0005, 0.0005).tolist()
 
-        for j in range(len(baseline_cr)):
-            locals()['p%s' % j] = baseline_cr[j]
-            globals()['n%s' % j] = []
-            # locals()['n_diff_%s' % j] = []
-            for i in range(len(lifts)):
-                eval('n%s' % j).append(power.NormalIndPower().solve_power(
-                    effect_size=stp.proportion_effectsize(eval('p%s' % j) + lifts[i],
-                                                          eval('p%s' % j)),
-                    nobs1=None, alpha=a, power=b, ratio=ratio,
-                    alternative='larger'))
-
-            """for i in range(1,len(lifts)):
-              eval('n_diff_%s' % j).append(
-                  (eval('n%s' % j)[-(i+1)]-eval('n%s' % j)[-i])/eval('n%s' % j)[-i])
-          
-            print(eval('n%s' % j))
-            print(eval('n_diff_%s' % j))"""
+        # n[j, i] - sample size for baseline_cr[j] and lifts[i]
+        n = proportions_sample_size(baseline_cr, lifts, alpha=a, power_=b, ratio=ratio, alternative='larger')
 
         # plot graph
         fig = make_subplots(rows=1, cols=1, subplot_titles=(plot_title, 'lfllf'))
@@ -271,7 +761,7 @@ def lifts_weeks_graph(baseline_sessions, cr_name='CR',
                 type(baseline_sessions) is int):
             for i in range(len(baseline_cr)):
                 fig.add_trace(go.Scatter(
-                    x=[(x / baseline_sessions) for x in eval('n' + str(i))],
+                    x=[(x / baseline_sessions) for x in n[i]],
                     y=[x * 100 for x in lifts],
                     mode='lines',
                     name=cr_name[i] + '=' + str(round(baseline_cr[i] * 100, 2)) + '%',
@@ -296,7 +786,7 @@ def lifts_weeks_graph(baseline_sessions, cr_name='CR',
             for i in range(len(baseline_cr)):
                 if baseline_sessions[i] >= 1000:
                     fig.add_trace(go.Scatter(
-                        x=[(x / baseline_sessions[i]) for x in eval('n' + str(i))],
+                        x=[(x / baseline_sessions[i]) for x in n[i]],
                         y=[x * 100 for x in lifts],
                         mode='lines',
                         name=cr_name[i] + '=' + str(round(baseline_cr[i] * 100, 2)) +
@@ -305,7 +795,7 @@ def lifts_weeks_graph(baseline_sessions, cr_name='CR',
                         legendgroup='group1', showlegend=True), row=1, col=1)
                 else:
                     fig.add_trace(go.Scatter(
-                        x=[(x / baseline_sessions[i]) for x in eval('n' + str(i))],
+                        x=[(x / baseline_sessions[i]) for x in n[i]],
                         y=[x * 100 for x in lifts],
                         mode='lines',
                         name=cr_name[i] + '=' + str(round(baseline_cr[i] * 100, 2)) +
@@ -371,12 +861,12 @@ def lifts_weeks_graph(baseline_sessions, cr_name='CR',
         # TO DO: include max_lift
         lifts = np.arange(0.02, 0.5 + 0.005, 0.005).tolist()
 
-        n = []
-        for i in range(len(lifts)):
-            n.append(monte_carlo_sample_size(
-                baseline_data, baseline_sessions, lifts[i],
-                num_simulations=num_simulations,
-                method=method[12:]))
+        n = monte_carlo_lifts_sample_sizes(baseline_data, baseline_sessions, lifts,
+                                           method=method[12:],
+                                           num_simulations=num_simulations,
+                                           random_state=random_state,
+                                           search=search,
+                                           n_jobs=n_jobs)
 
         if interpolate:
             lifts_n = pd.DataFrame(lifts, columns=['lifts'])
@@ -416,6 +906,218 @@ def lifts_weeks_graph(baseline_sessions, cr_name='CR',
         fig.show()
 
 
+class PrecalcCache:
+    """
+    Memoization store for precalc results, keyed by a content hash of the calculation parameters.
+
+    Results are kept in an in-memory LRU layer bounded by total size in bytes and, if path is given,
+    in an on-disk store that survives restarts and is shared between processes using the same directory.
+
+    Parameters:
+        - max_bytes - memory budget of the in-memory layer, least recently used entries are evicted first
+        - path - directory of the on-disk store, None disables it
+        - disk_format - 'npz' or 'parquet' (the latter requires pyarrow)
+        - max_disk_bytes - size budget of the on-disk store, None means unbounded;
+          files with the oldest access time are removed first
+    """
+
+    def __init__(self, max_bytes=64 * 2 ** 20, path=None, disk_format='npz', max_disk_bytes=None):
+        if disk_format not in ('npz', 'parquet'):
+            raise ValueError("disk_format must be 'npz' or 'parquet'")
+
+        self.max_bytes = max_bytes
+        self.path = path
+        self.disk_format = disk_format
+        self.max_disk_bytes = max_disk_bytes
+
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+
+        self._entries = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+
+    @staticmethod
+    def data_digest(data):
+        """
+        sha256 of array-like data: dtype, shape and raw bytes, so equal samples give equal keys
+        """
+        arr = np.ascontiguousarray(np.asarray(data))
+        h = hashlib.sha256()
+        h.update(str(arr.dtype).encode())
+        h.update(str(arr.shape).encode())
+        h.update(arr.tobytes())
+        return h.hexdigest()
+
+    @classmethod
+    def make_key(cls, **params):
+        """
+        Builds a content-addressed key out of keyword parameters. Arrays, lists of numbers and
+        pandas objects are replaced by their digest, numpy scalars by python ones.
+        """
+        def canonical(value):
+            if isinstance(value, (np.ndarray, pd.Series, pd.Index)):
+                return {'__digest__': cls.data_digest(value)}
+            if isinstance(value, pd.DataFrame):
+                return {'__digest__': cls.data_digest(value.to_numpy()), 'columns': list(map(str, value.columns))}
+            if isinstance(value, (list, tuple)):
+                return [canonical(v) for v in value]
+            if isinstance(value, np.generic):
+                return value.item()
+            if isinstance(value, (str, int, float, bool)) or value is None:
+                return value
+            raise TypeError(f"Can not build a cache key out of {type(value).__name__}")
+
+        payload = json.dumps({k: canonical(v) for k, v in params.items()}, sort_keys=True)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    @property
+    def nbytes(self):
+        return self._nbytes
+
+    def stats(self):
+        """
+        Returns dict with hits, misses, disk_hits, number of entries and size of the in-memory layer
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'disk_hits': self.disk_hits,
+                    'entries': len(self._entries), 'nbytes': self._nbytes}
+
+    def get(self, key):
+        """
+        Returns a copy of the cached pandas.DataFrame or None
+        """
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key][0].copy()
+
+        results = self._disk_load(key)
+
+        with self._lock:
+            if results is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.disk_hits += 1
+            self._remember(key, results)
+        return results.copy()
+
+    def put(self, key, results):
+        results = results.copy()
+        with self._lock:
+            self._remember(key, results)
+        self._disk_save(key, results)
+
+    def clear(self, disk=False):
+        with self._lock:
+            self._entries.clear()
+            self._nbytes = 0
+        if disk and self.path is not None:
+            for f in self._disk_files():
+                os.remove(f)
+
+    def _remember(self, key, results):
+        size = int(results.memory_usage(index=True, deep=True).sum())
+        if key in self._entries:
+            self._nbytes -= self._entries.pop(key)[1]
+        if size > self.max_bytes:
+            return
+        self._entries[key] = (results, size)
+        self._nbytes += size
+        while self._nbytes > self.max_bytes:
+            _, (_, evicted) = self._entries.popitem(last=False)
+            self._nbytes -= evicted
+
+    def _disk_file(self, key):
+        return os.path.join(self.path, f'{key}.{self.disk_format}')
+
+    def _disk_files(self):
+        suffix = '.' + self.disk_format
+        return [os.path.join(self.path, f) for f in os.listdir(self.path) if f.endswith(suffix)]
+
+    def _disk_load(self, key):
+        if self.path is None:
+            return None
+        file = self._disk_file(key)
+        try:
+            if self.disk_format == 'npz':
+                with np.load(file, allow_pickle=False) as f:
+                    columns = f['__columns__'].tolist()
+                    results = pd.DataFrame({c: f[f'c{i}'] for i, c in enumerate(columns)})
+            else:
+                results = pd.read_parquet(file)
+            # refresh access time, it drives eviction of the on-disk store
+            os.utime(file)
+        except (FileNotFoundError, OSError, KeyError, ValueError):
+            return None
+        return results
+
+    def _disk_save(self, key, results):
+        if self.path is None:
+            return
+        file = self._disk_file(key)
+        # write to a temporary file first, so concurrent readers never see a partial file
+        tmp = f'{file}.{os.getpid()}.{threading.get_ident()}.tmp'
+        if self.disk_format == 'npz':
+            with open(tmp, 'wb') as f:
+                np.savez(f, __columns__=np.array([str(c) for c in results.columns]),
+                         **{f'c{i}': results[c].to_numpy() for i, c in enumerate(results.columns)})
+        else:
+            results.to_parquet(tmp, index=False)
+        os.replace(tmp, file)
+
+        if self.max_disk_bytes is not None:
+            files = sorted(self._disk_files(), key=os.path.getmtime)
+            total = sum(os.path.getsize(f) for f in files)
+            for f in files:
+                if total <= self.max_disk_bytes:
+                    break
+                total -= os.path.getsize(f)
+                os.remove(f)
+
+
+def _is_seed(random_state):
+    return isinstance(random_state, (int, np.integer)) and not isinstance(random_state, bool)
+
+
+def precalc_cache_key(baseline_sessions,
+                      baseline_conversions=None, baseline_cr=None,
+                      baseline_mean=None, baseline_std=None,
+                      baseline_data=None,
+                      method='CR', a=0.05, b=0.8, ratio=1,
+                      num_simulations=2000,
+                      max_lift=None, max_weeks=4,
+                      interpolate=False,
+                      search='scan', random_state=None):
+    """
+    Key of precalc results in PrecalcCache. Only parameters that affect the result take part in it:
+    plotting options and n_jobs do not. For Monte-Carlo methods the key includes a digest of
+    baseline_data together with the simulation settings. Monte-Carlo results are reproducible and can be
+    cached only with an integer random_state, otherwise TypeError is raised.
+    """
+    params = dict(method=method, baseline_sessions=baseline_sessions, a=a, b=b, ratio=ratio,
+                  max_weeks=max_weeks, interpolate=interpolate)
+
+    if method == 'CR':
+        params.update(baseline_conversions=baseline_conversions, baseline_cr=baseline_cr, max_lift=max_lift)
+    elif method == 'Students t-test formula':
+        params.update(baseline_mean=baseline_mean, baseline_std=baseline_std,
+                      baseline_data=None if baseline_data is None else PrecalcCache.data_digest(baseline_data))
+    else:
+        if not _is_seed(random_state):
+            raise TypeError("random_state must be an int to cache Monte-Carlo results")
+        params.update(baseline_data=None if baseline_data is None else PrecalcCache.data_digest(baseline_data),
+                      num_simulations=num_simulations, search=search, random_state=random_state)
+
+    return PrecalcCache.make_key(**params)
+
+
 def precalc(baseline_sessions,
             baseline_conversions=None, baseline_cr=None,
             baseline_mean=None, baseline_std=None,
@@ -425,7 +1127,62 @@ def precalc(baseline_sessions,
             max_lift=None, max_weeks=4,
             plot_title='Desktop',
             plotly_template='none',
-            interpolate=False):
+            interpolate=False,
+            search='scan', random_state=None, n_jobs=1,
+            cache=None):
+    """
+    Computes the table of minimal sample sizes for the grid of lifts, see
+    lifts_weeks_graph for the description of parameters
+
+    If cache (PrecalcCache) is given, results are looked up by precalc_cache_key
+    and stored there after computation. Monte-Carlo results without an integer
+    random_state are random and bypass the cache.
+
+    Returns pandas.DataFrame with columns lifts, n0, n1, ...
+    """
+    if method[0:11] == 'Monte-Carlo' and not _is_seed(random_state):
+        cache = None
+
+    key = None
+    if cache is not None:
+        key = precalc_cache_key(baseline_sessions,
+                                baseline_conversions=baseline_conversions, baseline_cr=baseline_cr,
+                                baseline_mean=baseline_mean, baseline_std=baseline_std,
+                                baseline_data=baseline_data,
+                                method=method, a=a, b=b, ratio=ratio,
+                                num_simulations=num_simulations,
+                                max_lift=max_lift, max_weeks=max_weeks,
+                                interpolate=interpolate,
+                                search=search, random_state=random_state)
+        results = cache.get(key)
+        if results is not None:
+            return results
+
+    results = _precalc(baseline_sessions,
+                       baseline_conversions=baseline_conversions, baseline_cr=baseline_cr,
+                       baseline_mean=baseline_mean, baseline_std=baseline_std,
+                       baseline_data=baseline_data,
+                       method=method, a=a, b=b, ratio=ratio,
+                       num_simulations=num_simulations,
+                       max_lift=max_lift, max_weeks=max_weeks,
+                       interpolate=interpolate,
+                       search=search, random_state=random_state, n_jobs=n_jobs)
+
+    if cache is not None:
+        cache.put(key, results)
+
+    return results
+
+
+def _precalc(baseline_sessions,
+             baseline_conversions=None, baseline_cr=None,
+             baseline_mean=None, baseline_std=None,
+             baseline_data=None,
+             method='CR', a=0.05, b=0.8, ratio=1,
+             num_simulations=2000,
+             max_lift=None, max_weeks=4,
+             interpolate=False,
+             search='scan', random_state=None, n_jobs=1):
     # If conversions are a binary variable:
     if method == 'CR':
         # if min(baseline_sessions) <=
@@ -473,20 +1230,11 @@ def precalc(baseline_sessions,
 
             lifts = np.arange(0.0005, max_lift + 0.0005, 0.0005).tolist()
 
-        for j in range(len(baseline_cr)):
-            locals()['p%s' % j] = baseline_cr[j]
-            globals()['n%s' % j] = []
-            # locals()['n_diff_%s' % j] = []
-            for i in range(len(lifts)):
-                eval('n%s' % j).append(power.NormalIndPower().solve_power(
-                    effect_size=stp.proportion_effectsize(eval('p%s' % j) + lifts[i],
-                                                          eval('p%s' % j)),
-                    nobs1=None, alpha=a, power=b, ratio=ratio,
-                    alternative='larger'))
-
-        results = pd.concat([pd.Series(lifts)] + [pd.Series(eval('n' + str(i))) for i in range(len(baseline_cr))],
-                            axis='columns')
-        results.columns = ['lifts'] + ['n' + str(i) for i in range(len(baseline_cr))]
+        # n[j, i] - sample size for baseline_cr[j] and lifts[i]
+        n = proportions_sample_size(baseline_cr, lifts, alpha=a, power_=b, ratio=ratio, alternative='larger')
+
+        results = pd.DataFrame(n.T, columns=['n' + str(i) for i in range(len(baseline_cr))])
+        results.insert(0, 'lifts', lifts)
         return results
 
     #############################################################################
@@ -503,8 +1251,7 @@ def precalc(baseline_sessions,
                 effect_size=lifts[i],
                 nobs1=None, ratio=1, alpha=0.05, power=0.8))
 
-        results = pd.DataFrame([lifts, n],
-                               columns=['lifts', 'n0'])
+        results = pd.DataFrame({'lifts': lifts, 'n0': n})
 
         return results
 
@@ -515,12 +1262,12 @@ def precalc(baseline_sessions,
         # TO DO: include max_lift
         lifts = np.arange(0.02, 0.5 + 0.005, 0.005).tolist()
 
-        n = []
-        for i in range(len(lifts)):
-            n.append(monte_carlo_sample_size(
-                baseline_data, baseline_sessions, lifts[i],
-                num_simulations=num_simulations,
-                method=method[12:]))
+        n = monte_carlo_lifts_sample_sizes(baseline_data, baseline_sessions, lifts,
+                                           method=method[12:],
+                                           num_simulations=num_simulations,
+                                           random_state=random_state,
+                                           search=search,
+                                           n_jobs=n_jobs)
 
         if interpolate:
             lifts_n = pd.DataFrame(lifts, columns=['lifts'])
@@ -531,8 +1278,7 @@ def precalc(baseline_sessions,
                                           baseline_sessions=baseline_sessions,
                                           max_weeks=max_weeks)
 
-        results = pd.DataFrame([lifts, n],
-                               columns=['lifts', 'n0'])
+        results = pd.DataFrame({'lifts': lifts, 'n0': n})
 
         return results
 
@@ -547,7 +1293,9 @@ def plot_precalc(baseline_sessions, cr_name='CR',
                  plot_title='Desktop', plot_width=800,
                  plotly_template='none',
                  interpolate=True,
-                 return_type='graph'):
+                 return_type='graph',
+                 search='scan', random_state=None, n_jobs=1,
+                 cache=None):
     # get precalc results:
     results = precalc(baseline_sessions=baseline_sessions,
                       baseline_conversions=baseline_conversions, baseline_cr=baseline_cr,
@@ -556,14 +1304,16 @@ def plot_precalc(baseline_sessions, cr_name='CR',
                       method=method, a=a, b=b, ratio=ratio,
                       num_simulations=num_simulations,
                       max_lift=max_lift, max_weeks=max_weeks,
-                      interpolate=interpolate)
+                      interpolate=interpolate,
+                      search=search, random_state=random_state,
+                      n_jobs=n_jobs, cache=cache)
 
     if return_type == 'table':
         return results
     elif return_type == 'graph':
         lifts = results['lifts']
-        for i in range(len(results.columns) - 1):
-            globals()['n%s' % i] = results['n' + str(i)]
+        # n[j] - sample sizes for the j-th baseline
+        n = results.drop(columns='lifts').to_numpy().T
 
         # If conversions are a binary variable:
         if method == 'CR':
@@ -588,7 +1338,7 @@ def plot_precalc(baseline_sessions, cr_name='CR',
                     type(baseline_sessions) is int):
                 for i in range(len(baseline_cr)):
                     fig.add_trace(go.Scatter(
-                        x=[(x / baseline_sessions) for x in eval('n' + str(i))],
+                        x=[(x / baseline_sessions) for x in n[i]],
                         y=[x * 100 for x in lifts],
                         mode='lines',
                         name='CR=' + str(round(baseline_cr[i] * 100, 2)) + '%',
@@ -613,7 +1363,7 @@ def plot_precalc(baseline_sessions, cr_name='CR',
                 for i in range(len(baseline_cr)):
                     if baseline_sessions[i] >= 1000:
                         fig.add_trace(go.Scatter(
-                            x=[(x / baseline_sessions[i]) for x in eval('n' + str(i))],
+                            x=[(x / baseline_sessions[i]) for x in n[i]],
                             y=[x * 100 for x in lifts],
                             mode='lines',
                             name='CR=' + str(round(baseline_cr[i] * 100, 2)) +
@@ -622,7 +1372,7 @@ def plot_precalc(baseline_sessions, cr_name='CR',
                             legendgroup='group1', showlegend=True), row=1, col=1)
                     else:
                         fig.add_trace(go.Scatter(
-                            x=[(x / baseline_sessions[i]) for x in eval('n' + str(i))],
+                            x=[(x / baseline_sessions[i]) for x in n[i]],
                             y=[x * 100 for x in lifts],
                             mode='lines',
                             name='CR=' + str(round(baseline_cr[i] * 100, 2)) +
@@ -647,7 +1397,7 @@ def plot_precalc(baseline_sessions, cr_name='CR',
 
             for i in range(len(baseline_mean)):
                 fig.add_trace(go.Scatter(
-                    x=[(x / baseline_sessions) for x in eval('n' + str(i))],
+                    x=[(x / baseline_sessions) for x in n[i]],
                     y=lifts,
                     mode='lines',
                     name='mean=' + str(round(baseline_mean[i], 2)),
@@ -677,7 +1427,7 @@ def plot_precalc(baseline_sessions, cr_name='CR',
             fig = make_subplots(rows=1, cols=1, subplot_titles=(plot_title, 'lfllf'))
 
             fig.add_trace(go.Scatter(
-                x=[(x / baseline_sessions) for x in eval('n' + str(i))],
+                x=[(x / baseline_sessions) for x in n[0]],
                 y=lifts,
                 mode='lines',
                 name='mean=' + str(round(baseline_mean, 2)),
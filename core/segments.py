@@ -0,0 +1,52 @@
+import numpy as np
+import pandas as pd
+
+
+class SegmentIndex:
+    """
+    Индекс срезов датафрейма: для каждого столбца и каждого его значения хранится отсортированный массив позиций
+    строк с этим значением. Строится один раз по кодам pd.factorize, после чего строки среза вида
+    device == 'mobile' and region == 'X' находятся пересечением массивов позиций, без разбора выражения
+    и прохода по всему датафрейму, как в DataFrame.query
+
+    :param df: (pandas.DataFrame), Датафрейм, по которому строится индекс
+    :param columns: (iterable), Столбцы срезов
+    """
+
+    def __init__(self, df, columns):
+        self.columns = list(columns)
+        self.positions = {col: self._build(df[col]) for col in self.columns}
+
+    @staticmethod
+    def _build(values):
+        codes, uniques = pd.factorize(values)
+        order = np.argsort(codes, kind='stable')
+        # Строки с пропусками имеют код -1 и в индекс не попадают, как и в DataFrame.query
+        bounds = np.searchsorted(codes[order], np.arange(len(uniques) + 1))
+        return {val: order[bounds[i]:bounds[i + 1]] for i, val in enumerate(uniques)}
+
+    def lookup(self, conditions):
+        """
+        Позиции строк, удовлетворяющих всем условиям column == value
+
+        :param conditions: (iterable), Пары (column, value)
+        :return: (numpy.ndarray), Отсортированный массив позиций строк
+        """
+        arrays = [self.positions[col].get(val, np.array([], dtype=np.intp)) for col, val in conditions]
+        if not arrays:
+            raise ValueError("At least one condition is required")
+
+        # Пересекаем начиная с самых коротких массивов
+        arrays.sort(key=len)
+        res = arrays[0]
+        for arr in arrays[1:]:
+            if not len(res):
+                break
+            res = np.intersect1d(res, arr, assume_unique=True)
+        return res
+
+    def take(self, df, conditions):
+        """
+        Строки df (того же, по которому построен индекс), удовлетворяющие всем условиям column == value
+        """
+        return df.take(self.lookup(conditions))
@@ -0,0 +1,263 @@
+import numpy as np
+import pandas as pd
+from scipy import stats as st
+from scipy.optimize import brentq
+
+
+class _TwoSampleMoments:
+    """
+    Накопленные кол-во, сумма и сумма квадратов наблюдений по двум вариантам. Обновляются за O(1) по дневным
+    агрегатам
+    """
+
+    def __init__(self):
+        self.n = np.zeros(2)
+        self.s = np.zeros(2)
+        self.ss = np.zeros(2)
+
+    def add(self, count1, sum1, sumsq1, count2, sum2, sumsq2):
+        self.n += (count1, count2)
+        self.s += (sum1, sum2)
+        self.ss += (sumsq1, sumsq2)
+
+    def estimate(self):
+        """
+        :return: (tuple), Разница средних (второй вариант минус первый), ее дисперсия и среднее первого варианта
+        """
+        mean = self.s / self.n
+        var = np.maximum((self.ss - self.n * mean ** 2) / (self.n - 1), 0)
+        return mean[1] - mean[0], var[0] / self.n[0] + var[1] / self.n[1], mean[0]
+
+    @property
+    def ready(self):
+        return bool(np.all(self.n > 1))
+
+
+class MSPRT:
+    """
+    Mixture sequential probability ratio test (mSPRT) для разницы средних двух вариантов:
+    https://arxiv.org/abs/1512.04922
+    Статистика отношения правдоподобий усредняется по нормальному априорному распределению эффекта
+    N(theta0, tau^2), что дает always-valid p-value: на результаты можно смотреть после каждого нового дня
+    и останавливать тест, как только p-value < alpha, без роста доли ложноположительных результатов.
+    Каждое обновление стоит O(1).
+
+    :param alpha: (float, optional, default=0.05), Уровень значимости
+    :param tau: (float, optional, default=None), Стандартное отклонение априорного распределения эффекта,
+    в единицах метрики. Лучше всего задавать порядка ожидаемого эффекта. Если None, при первом обновлении
+    принимается равным relative_tau * |среднее первого варианта|
+    :param relative_tau: (float, optional, default=0.1), См. tau
+    :param theta0: (float, optional, default=0), Разница средних при нулевой гипотезе
+    """
+
+    def __init__(self, alpha=0.05, tau=None, relative_tau=0.1, theta0=0.):
+        self.alpha = alpha
+        self.tau = tau
+        self.relative_tau = relative_tau
+        self.theta0 = theta0
+
+        self.moments = _TwoSampleMoments()
+        self.p_value = 1.
+        self.conf_int = (-np.inf, np.inf)
+        self.history = []
+
+    def update(self, count1, sum1, sumsq1, count2, sum2, sumsq2):
+        """
+        Добавляет новые наблюдения (например за очередной день) в виде агрегатов по каждому варианту
+
+        :param count1, count2: Кол-во наблюдений
+        :param sum1, sum2: Сумма значений метрики
+        :param sumsq1, sumsq2: Сумма квадратов значений метрики
+        :return: (float), always-valid p-value
+        """
+        self.moments.add(count1, sum1, sumsq1, count2, sum2, sumsq2)
+
+        theta = np.nan
+        if self.moments.ready:
+            theta, v, mean_1 = self.moments.estimate()
+
+            if self.tau is None:
+                self.tau = self.relative_tau * abs(mean_1) or 1.
+            tau2 = self.tau ** 2
+
+            if v > 0:
+                log_lr = 0.5 * np.log(v / (v + tau2)) + (theta - self.theta0) ** 2 * tau2 / (2 * v * (v + tau2))
+                self.p_value = min(self.p_value, float(np.exp(-log_lr)))
+
+                # Все theta, для которых отношение правдоподобий не превышает 1 / alpha
+                half_width = np.sqrt(v * (v + tau2) / tau2 * (2 * np.log(1 / self.alpha) + np.log((v + tau2) / v)))
+                self.conf_int = (max(self.conf_int[0], theta - half_width),
+                                 min(self.conf_int[1], theta + half_width))
+
+        self.history.append({'n_1': self.moments.n[0], 'n_2': self.moments.n[1], 'diff': theta,
+                             'p_value': self.p_value,
+                             'ci_lower': self.conf_int[0], 'ci_upper': self.conf_int[1]})
+        return self.p_value
+
+    def update_binary(self, successes1, trials1, successes2, trials2):
+        """
+        Обновление для бинарной метрики (например транзакции / сессии): для 0/1 наблюдений сумма квадратов
+        равна сумме
+        """
+        return self.update(trials1, successes1, successes1, trials2, successes2, successes2)
+
+    @property
+    def rejected(self):
+        return self.p_value < self.alpha
+
+    def to_frame(self):
+        """
+        :return: (pandas.DataFrame), История обновлений: кол-во наблюдений, оценка разницы, always-valid p-value
+        и границы доверительной последовательности
+        """
+        return pd.DataFrame(self.history)
+
+
+def _spending_obrien_fleming(t, alpha):
+    # Двусторонний вариант: alpha / 2 на каждую сторону
+    return 4 * st.norm.sf(st.norm.isf(alpha / 4) / np.sqrt(t))
+
+
+def _spending_pocock(t, alpha):
+    return alpha * np.log(1 + (np.e - 1) * t)
+
+
+class GroupSequential:
+    """
+    Групповой последовательный тест с функцией расходования alpha (Lan-DeMets) для разницы средних двух вариантов.
+    При каждом просмотре результатов тратится часть alpha, соответствующая доле набранной выборки, а граница
+    для z-статистики подбирается так, чтобы общая вероятность ошибки первого рода не превышала alpha.
+    Граница считается рекурсивным численным интегрированием по сетке (Armitage, McPherson, Rowe), поэтому
+    стоимость обновления не зависит от объема данных.
+
+    :param max_n: (int), Планируемый суммарный размер выборки обоих вариантов
+    :param alpha: (float, optional, default=0.05), Уровень значимости двустороннего теста
+    :param spending: (str, optional, default='obrien-fleming'), Функция расходования alpha:
+    'obrien-fleming' (строгие границы на ранних просмотрах) или 'pocock'
+    :param grid_size: (int, optional, default=201), Кол-во узлов сетки интегрирования
+    """
+
+    SPENDING = {'obrien-fleming': _spending_obrien_fleming, 'pocock': _spending_pocock}
+
+    def __init__(self, max_n, alpha=0.05, spending='obrien-fleming', grid_size=201):
+        if spending not in self.SPENDING:
+            raise ValueError(f"spending must be one of {list(self.SPENDING)}")
+
+        self.max_n = max_n
+        self.alpha = alpha
+        self.spending = spending
+        # Для формулы Симпсона нужно нечетное кол-во узлов
+        self.grid_size = grid_size + 1 - grid_size % 2
+
+        self.moments = _TwoSampleMoments()
+        self.spent = 0.
+        self.rejected = False
+        self.history = []
+
+        self._t = 0.
+        self._grid = None
+        self._density = None
+
+    def _weights(self, grid):
+        w = np.ones(len(grid))
+        w[1:-1:2], w[2:-1:2] = 4, 2
+        return w * (grid[1] - grid[0]) / 3
+
+    def _boundary(self, t):
+        """
+        Граница для |z| на просмотре с долей информации t, обновляет плотность B-значения (z * sqrt(t))
+        по траекториям, не пересекшим предыдущие границы
+        """
+        target = self.SPENDING[self.spending](t, self.alpha) - self.spent
+        sqrt_t = np.sqrt(t)
+
+        if self._grid is None:
+            c = st.norm.isf(target / 2) if target > 0 else np.inf
+            crossed = target if target > 0 else 0.
+            grid = np.linspace(-1, 1, self.grid_size) * min(c, 8.) * sqrt_t
+            density = st.norm.pdf(grid / sqrt_t) / sqrt_t
+        else:
+            sd = np.sqrt(t - self._t)
+            mass = self._density * self._weights(self._grid)
+
+            def crossing(c):
+                return np.sum(mass * (st.norm.cdf((-c * sqrt_t - self._grid) / sd) +
+                                      st.norm.sf((c * sqrt_t - self._grid) / sd)))
+
+            if target <= 0 or crossing(8.) >= target:
+                c, crossed = np.inf, 0.
+            else:
+                c = brentq(lambda x: crossing(x) - target, 1e-6, 8.)
+                crossed = target
+
+            grid = np.linspace(-1, 1, self.grid_size) * min(c, 8.) * sqrt_t
+            density = st.norm.pdf((grid[:, np.newaxis] - self._grid[np.newaxis, :]) / sd) @ mass / sd
+
+        self.spent += crossed
+        self._t, self._grid, self._density = t, grid, density
+        return c
+
+    def update(self, count1, sum1, sumsq1, count2, sum2, sumsq2):
+        """
+        Очередной просмотр результатов после добавления новых наблюдений (например за очередной день)
+
+        :param count1, count2: Кол-во наблюдений
+        :param sum1, sum2: Сумма значений метрики
+        :param sumsq1, sumsq2: Сумма квадратов значений метрики
+        :return: (bool), Отвергнута ли нулевая гипотеза на этом или одном из предыдущих просмотров
+        """
+        self.moments.add(count1, sum1, sumsq1, count2, sum2, sumsq2)
+        t = min(self.moments.n.sum() / self.max_n, 1.)
+
+        if not self.moments.ready or t <= self._t or self.rejected:
+            return self.rejected
+
+        theta, v, _ = self.moments.estimate()
+        z = theta / np.sqrt(v) if v > 0 else np.nan
+        c = self._boundary(t)
+        self.rejected = bool(abs(z) >= c)
+
+        # Повторный доверительный интервал, согласованный с границей
+        half_width = c * np.sqrt(v)
+        self.history.append({'n_1': self.moments.n[0], 'n_2': self.moments.n[1], 'information': t,
+                             'diff': theta, 'z': z, 'boundary': c, 'spent_alpha': self.spent,
+                             'ci_lower': theta - half_width, 'ci_upper': theta + half_width,
+                             'rejected': self.rejected})
+        return self.rejected
+
+    def update_binary(self, successes1, trials1, successes2, trials2):
+        """
+        Обновление для бинарной метрики, см. MSPRT.update_binary
+        """
+        return self.update(trials1, successes1, successes1, trials2, successes2, successes2)
+
+    def to_frame(self):
+        """
+        :return: (pandas.DataFrame), История просмотров: доля информации, z-статистика, граница, потраченное alpha
+        и повторный доверительный интервал
+        """
+        return pd.DataFrame(self.history)
+
+
+def msprt_trajectory(a, b, alpha=0.05, tau=None, relative_tau=0.1):
+    """
+    Always-valid p-value и доверительная последовательность mSPRT по мере поступления наблюдений a и b
+    (k-е наблюдение каждого ряда добавляется на k-м шаге), например дневных значений метрики
+
+    :param a: (array-like), First sample, в порядке поступления наблюдений
+    :param b: (array-like), Second sample, в порядке поступления наблюдений
+    :param alpha: (float, optional, default=0.05), Уровень значимости
+    :param tau: (float, optional, default=None), См. MSPRT
+    :param relative_tau: (float, optional, default=0.1), См. MSPRT
+    :return: (pandas.DataFrame), См. MSPRT.to_frame
+    """
+    a = np.asarray(a, dtype=float)
+    b = np.asarray(b, dtype=float)
+    test = MSPRT(alpha=alpha, tau=tau, relative_tau=relative_tau)
+
+    for k in range(max(len(a), len(b))):
+        x = a[k] if k < len(a) else 0.
+        y = b[k] if k < len(b) else 0.
+        test.update(int(k < len(a)), x, x ** 2, int(k < len(b)), y, y ** 2)
+
+    return test.to_frame()
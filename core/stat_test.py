@@ -1,7 +1,11 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import os
 from scipy import stats as st
 import statsmodels.api as sm
 import matplotlib.pyplot as plt
 import numpy as np
+import pandas as pd
 
 
 def qq_plot(data, metric):
@@ -25,15 +29,18 @@ def normality_test(data, alpha=0.05, verbose=0):
     :return: (bool) whether data is distributed normally or not with confidence of alpha
     """
 
-    if verbose > 0:
-        print('p-value of Hypothesis "Input data has normal distribution:"', st.shapiro(data)[1])
-
     if len(data) < 10:
         raise AssertionError(f"For results to be correct data must have at least 10 samples. Provided data has\n"
                              f" {len(data)} samples")
 
     if len(data) < 4000:
-        if st.shapiro(data)[1] > alpha:
+        # Тест Шапиро-Уилка считается один раз и для вывода, и для результата
+        p_shapiro = st.shapiro(data)[1]
+
+        if verbose > 0:
+            print('p-value of Hypothesis "Input data has normal distribution:"', p_shapiro)
+
+        if p_shapiro > alpha:
             if verbose > 0:
                 print("Data is not distributed normally")
             return False
@@ -43,7 +50,12 @@ def normality_test(data, alpha=0.05, verbose=0):
                 print("Data is distributed normally")
             return True
 
-    if st.normaltest(data)[1] < alpha:
+    p_normal = st.normaltest(data)[1]
+
+    if verbose > 0:
+        print('p-value of Hypothesis "Input data has normal distribution:"', p_normal)
+
+    if p_normal < alpha:
         if verbose > 0:
             print("Data is not distributed normally")
         return False
@@ -187,9 +199,11 @@ def mann_whitneyu_test(a, b, alpha=0.05, verbose=0, **kwargs):
     :param a, b: Сравниваемые выборки
     :param alpha: (optional, default=0.05), Уровень статистической значимости
     :param verbose: (optional, default=0), Выводить ли результаты промежуточных вычислений, выводит при verbose > 0
-    :param kwargs:
+    :param kwargs: Параметры scipy.stats.mannwhitneyu. По умолчанию alternative='two-sided': в scipy < 1.7
+    alternative=None давал одностороннее p-value, т.е. вдвое меньше двустороннего
     :return:
     """
+    kwargs.setdefault('alternative', 'two-sided')
     stat, p_value = st.mannwhitneyu(a, b, **kwargs)
 
     if verbose > 0:
@@ -214,24 +228,406 @@ def lift(before, after):
     return (np.sum(after) - np.sum(before)) / np.sum(before)
 
 
-def bootstrap(data, sample_num, sample_size):
+BOOTSTRAP_BLOCK_SIZE = 2 ** 20
+
+_BOOTSTRAP_STATISTICS = {'mean': np.mean, 'median': np.median, 'sum': np.sum}
+
+
+def _as_bootstrap_data(data, statistic):
+    """
+    Приводит данные к виду, с которым работает бутстреп: одномерный массив, а для statistic='ratio' -
+    массив 2 x n из строк числителя и знаменателя
+    """
+    data = np.asarray(data, dtype=float)
+
+    if statistic == 'ratio':
+        if data.ndim != 2 or data.shape[1] != 2:
+            raise ValueError("For statistic='ratio' data must have two columns: numerator and denominator")
+        return np.ascontiguousarray(data.T)
+
+    if not callable(statistic) and statistic not in _BOOTSTRAP_STATISTICS:
+        raise ValueError(f"Unknown statistic {statistic}, use one of {list(_BOOTSTRAP_STATISTICS) + ['ratio']} "
+                         f"or a callable")
+
+    if data.ndim != 1:
+        raise ValueError("Data must be one-dimensional")
+
+    return data
+
+
+def _point_statistic(data, statistic):
+    if statistic == 'ratio':
+        return data[0].sum() / data[1].sum()
+    func = statistic if callable(statistic) else _BOOTSTRAP_STATISTICS[statistic]
+    return float(func(data[np.newaxis, :], axis=1)[0])
+
+
+def _resampled_statistic(data, statistic, idx, buf):
+    """
+    Значения статистики на подвыборках, заданных строками матрицы индексов idx. buf - заранее выделенный
+    буфер той же формы, что и idx, в него собираются значения подвыборок
+    """
+    if statistic == 'ratio':
+        num = np.take(data[0], idx, out=buf).sum(axis=1)
+        den = np.take(data[1], idx, out=buf).sum(axis=1)
+        return num / den
+
+    np.take(data, idx, out=buf)
+    func = statistic if callable(statistic) else _BOOTSTRAP_STATISTICS[statistic]
+    return func(buf, axis=1)
+
+
+def _jackknife(data, statistic):
+    """
+    Значения статистики на выборках без одного наблюдения, нужны для поправки на ускорение в BCa.
+    Для mean, sum, ratio и median считаются за O(n log n), для произвольной функции - перебором за O(n^2)
+    """
+    if statistic == 'ratio':
+        return (data[0].sum() - data[0]) / (data[1].sum() - data[1])
+
+    n = data.shape[0]
+    if statistic == 'mean':
+        return (data.sum() - data) / (n - 1)
+    if statistic == 'sum':
+        return data.sum() - data
+    if statistic == 'median':
+        order = np.argsort(data, kind='stable')
+        s = data[order]
+        # rank of the removed element in the sorted sample
+        r = np.empty(n, dtype=np.intp)
+        r[order] = np.arange(n)
+        lo, hi = (n - 2) // 2, (n - 1) // 2
+        # i-th element of the sorted sample without the r-th element is s[i] if i < r else s[i + 1]
+        lo_val = np.where(lo < r, s[lo], s[min(lo + 1, n - 1)])
+        hi_val = np.where(hi < r, s[hi], s[min(hi + 1, n - 1)])
+        return (lo_val + hi_val) / 2
+
+    return np.array([_point_statistic(np.delete(data, i), statistic) for i in range(n)])
+
+
+def bootstrap(data, sample_num, sample_size=None, statistic='mean', random_state=None,
+              block_size=BOOTSTRAP_BLOCK_SIZE, method='choice'):
     """
     Бутстреппинг для определения устойчивых оценок статистической характеристики выборки
     https://en.wikipedia.org/wiki/Bootstrapping_(statistics)
 
-    :param data: Данные, по которым будет идти бутстреппинг
+    Подвыборки генерируются блоками: за раз создается матрица индексов из нескольких подвыборок, значения
+    собираются в заранее выделенный буфер, а статистика пишется в заранее выделенный массив результатов.
+    Пиковая память ограничена block_size элементами независимо от sample_num.
+
+    :param data: Данные, по которым будет идти бутстреппинг. Для statistic='ratio' - массив n x 2
+    (числитель, знаменатель) для каждого наблюдения, например transactions и sessions
     :param sample_num: Кол-во раз, которое будет происходить семплирование
-    :param sample_size: Размер случайных подвыборок при итерациях
-    :return:
+    :param sample_size: (int, optional, default=None), Размер случайных подвыборок при итерациях,
+    по умолчанию равен размеру данных
+    :param statistic: (str or callable, optional, default='mean'), 'mean', 'median', 'sum', 'ratio' (отношение
+    сумм числителя и знаменателя) или функция вида f(samples, axis=1), считающая статистику по строкам матрицы
+    :param random_state: (int, numpy.random.Generator or None, optional, default=None), Seed генератора
+    :param block_size: (int, optional, default=2**20), Максимальное кол-во элементов в одном блоке подвыборок
+    :param method: (str, optional, default='choice'), 'choice' - семплирование индексов с возвращением,
+    'poisson' - пуассоновский бутстреп, см. poisson_bootstrap (sample_size не поддерживается)
+    :return: (numpy.ndarray), значения статистики на sample_num подвыборках
     """
-    res = np.array([])
-    for i in range(sample_num):
-        sample_mean = np.mean(np.random.choice(data, size=sample_size))
-        res = np.append(res, sample_mean)
+    if method == 'poisson':
+        if sample_size is not None:
+            raise ValueError("sample_size is not supported by Poisson bootstrap")
+        return poisson_bootstrap(data, sample_num, statistic=statistic, random_state=random_state,
+                                 block_size=block_size)
+
+    if method != 'choice':
+        raise ValueError("method must be 'choice' or 'poisson'")
+
+    data = _as_bootstrap_data(data, statistic)
+    n = data.shape[-1]
+
+    if sample_size is None:
+        sample_size = n
+
+    rng = np.random.default_rng(random_state)
+    res = np.empty(sample_num)
+
+    reps = max(1, block_size // sample_size)
+    buf = np.empty((min(reps, sample_num), sample_size))
+
+    for start in range(0, sample_num, reps):
+        stop = min(start + reps, sample_num)
+        idx = rng.integers(0, n, size=(stop - start, sample_size))
+        res[start:stop] = _resampled_statistic(data, statistic, idx, buf[:stop - start])
 
     return res
 
 
+def bootstrap_diff(a, b, sample_num, statistic='mean', relative=False, random_state=None,
+                   block_size=BOOTSTRAP_BLOCK_SIZE):
+    """
+    Бутстреп-распределение разницы статистик двух независимых выборок: statistic(b) - statistic(a),
+    либо относительной разницы (statistic(b) - statistic(a)) / statistic(a), как в lift
+
+    :param a: Выборка до изменений (контрольная группа)
+    :param b: Выборка после изменений (тестовая группа)
+    :param sample_num: Кол-во раз, которое будет происходить семплирование
+    :param statistic: (str or callable, optional, default='mean'), см. bootstrap
+    :param relative: (bool, optional, default=False), Считать ли относительную разницу
+    :param random_state: (int, numpy.random.Generator or None, optional, default=None), Seed генератора
+    :param block_size: (int, optional, default=2**20), см. bootstrap
+    :return: (numpy.ndarray), значения разницы на sample_num парах подвыборок
+    """
+    rng = np.random.default_rng(random_state)
+    boot_a = bootstrap(a, sample_num, statistic=statistic, random_state=rng, block_size=block_size)
+    boot_b = bootstrap(b, sample_num, statistic=statistic, random_state=rng, block_size=block_size)
+
+    if relative:
+        return (boot_b - boot_a) / boot_a
+    return boot_b - boot_a
+
+
+class PoissonBootstrap:
+    """
+    Пуассоновский бутстреп: вместо семплирования индексов каждой строке в каждой из sample_num подвыборок
+    присваивается вес ~ Poisson(1), а статистика считается по взвешенным суммам. Данные не нужно держать
+    в памяти целиком - они обрабатываются по частям за один проход (чанки pandas.read_csv, срезы numpy.memmap),
+    а частичные результаты нескольких процессов объединяются через merge.
+
+    Веса чанка генерируются из seed-а (random_state, chunk_id), поэтому результат воспроизводим и не зависит
+    от того, какой процесс обработал чанк. Процессы, результаты которых объединяются, должны использовать
+    один и тот же целочисленный random_state и разные chunk_id. Если передан numpy.random.Generator, seed
+    берется из него, и результат воспроизводим только вместе с состоянием генератора.
+
+    :param sample_num: Кол-во подвыборок
+    :param statistic: (str, optional, default='mean'), 'mean', 'sum' или 'ratio' (отношение сумм, данные -
+    два столбца: числитель и знаменатель)
+    :param random_state: (int, numpy.random.Generator or None, optional, default=None), Seed генератора
+    :param block_size: (int, optional, default=2**20), Максимальное кол-во весов, генерируемых за раз
+    :param columns: (list, optional, default=None), Столбцы, которые берутся из чанков pandas.DataFrame
+    """
+
+    STATISTICS = ('mean', 'sum', 'ratio')
+
+    def __init__(self, sample_num, statistic='mean', random_state=None, block_size=BOOTSTRAP_BLOCK_SIZE,
+                 columns=None):
+        if statistic not in self.STATISTICS:
+            raise ValueError(f"Poisson bootstrap supports only statistics {self.STATISTICS}")
+
+        self.sample_num = sample_num
+        self.statistic = statistic
+        self.block_size = block_size
+        self.columns = columns
+        if isinstance(random_state, np.random.Generator):
+            random_state = int(random_state.integers(2 ** 63))
+        self.entropy = np.random.SeedSequence(random_state).entropy
+
+        self.num = np.zeros(sample_num)
+        self.den = np.zeros(sample_num)
+        self.n_rows = 0
+        self._next_chunk = 0
+
+    def _chunk_values(self, chunk):
+        if self.columns is not None:
+            chunk = chunk[list(self.columns)]
+        values = np.asarray(chunk, dtype=float)
+
+        if self.statistic == 'ratio':
+            if values.ndim != 2 or values.shape[1] != 2:
+                raise ValueError("For statistic='ratio' data must have two columns: numerator and denominator")
+            return values[:, 0], values[:, 1]
+
+        values = values.reshape(values.shape[0], -1)
+        if values.shape[1] != 1:
+            raise ValueError("Data must be one-dimensional")
+        return values[:, 0], None
+
+    def update(self, chunk, chunk_id=None):
+        """
+        Добавляет чанк данных к накопленным суммам
+
+        :param chunk: Чанк данных (numpy.ndarray, pandas.Series или pandas.DataFrame)
+        :param chunk_id: (int, optional, default=None), Номер чанка, по умолчанию - порядковый номер вызова
+        :return: self
+        """
+        if chunk_id is None:
+            chunk_id = self._next_chunk
+        self._next_chunk = max(self._next_chunk, chunk_id + 1)
+
+        x, y = self._chunk_values(chunk)
+        rng = np.random.default_rng(np.random.SeedSequence(self.entropy, spawn_key=(chunk_id,)))
+
+        # weights are drawn row by row, so the draws do not depend on block_size
+        rows = max(1, self.block_size // self.sample_num)
+        for start in range(0, x.shape[0], rows):
+            weights = rng.poisson(1., size=(min(rows, x.shape[0] - start), self.sample_num)).astype(float)
+            self.num += x[start:start + rows] @ weights
+            if y is not None:
+                self.den += y[start:start + rows] @ weights
+            elif self.statistic == 'mean':
+                self.den += weights.sum(axis=0)
+
+        self.n_rows += x.shape[0]
+        return self
+
+    def merge(self, other):
+        """
+        Объединяет накопленные суммы с результатом другого процесса
+
+        :param other: (PoissonBootstrap), Частичный результат по другим чанкам
+        :return: self
+        """
+        if (self.sample_num, self.statistic, self.entropy) != (other.sample_num, other.statistic, other.entropy):
+            raise ValueError("Only results with the same sample_num, statistic and random_state can be merged")
+
+        self.num += other.num
+        self.den += other.den
+        self.n_rows += other.n_rows
+        self._next_chunk = max(self._next_chunk, other._next_chunk)
+        return self
+
+    def result(self):
+        """
+        :return: (numpy.ndarray), значения статистики на sample_num подвыборках
+        """
+        if self.statistic == 'sum':
+            return self.num.copy()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return self.num / self.den
+
+
+def _poisson_bootstrap_chunk(chunk_id, chunk, sample_num, statistic, entropy, block_size, columns):
+    boot = PoissonBootstrap(sample_num, statistic=statistic, random_state=entropy, block_size=block_size,
+                            columns=columns)
+    return boot.update(chunk, chunk_id=chunk_id)
+
+
+def _iter_chunks(data, chunk_size):
+    if isinstance(data, (np.ndarray, pd.DataFrame, pd.Series)):
+        for start in range(0, len(data), chunk_size):
+            yield data[start:start + chunk_size]
+    else:
+        yield from data
+
+
+def poisson_bootstrap(data, sample_num, statistic='mean', random_state=None, chunk_size=100000,
+                      block_size=BOOTSTRAP_BLOCK_SIZE, columns=None, n_jobs=1):
+    """
+    Пуассоновский бутстреп за один проход по данным, см. PoissonBootstrap
+
+    :param data: numpy.ndarray (в т.ч. numpy.memmap), pandas.DataFrame или итератор по чанкам,
+    например pandas.read_csv(..., chunksize=...)
+    :param sample_num: Кол-во подвыборок
+    :param statistic: (str, optional, default='mean'), 'mean', 'sum' или 'ratio'
+    :param random_state: (int, numpy.random.Generator or None, optional, default=None), Seed генератора
+    :param chunk_size: (int, optional, default=100000), Размер чанка, если data - массив или DataFrame
+    :param block_size: (int, optional, default=2**20), Максимальное кол-во весов, генерируемых за раз
+    :param columns: (list, optional, default=None), Столбцы, которые берутся из чанков pandas.DataFrame
+    :param n_jobs: (int, optional, default=1), Кол-во процессов, по которым распределяются чанки,
+    -1 - все ядра. Одновременно в обработке находится не больше 2 * n_jobs чанков
+    :return: (numpy.ndarray), значения статистики на sample_num подвыборках
+    """
+    boot = PoissonBootstrap(sample_num, statistic=statistic, random_state=random_state, block_size=block_size,
+                            columns=columns)
+    chunks = _iter_chunks(data, chunk_size)
+
+    if n_jobs == 1:
+        for chunk in chunks:
+            boot.update(chunk)
+        return boot.result()
+
+    max_workers = os.cpu_count() if n_jobs == -1 else n_jobs
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        # the window of submitted chunks is bounded, so an iterator over a large file is not read into memory
+        futures = deque()
+        for chunk_id, chunk in enumerate(chunks):
+            futures.append(executor.submit(_poisson_bootstrap_chunk, chunk_id, chunk, sample_num, statistic,
+                                           boot.entropy, block_size, columns))
+            if len(futures) >= 2 * max_workers:
+                boot.merge(futures.popleft().result())
+        # merge in chunk order, so the result does not depend on scheduling
+        while futures:
+            boot.merge(futures.popleft().result())
+
+    return boot.result()
+
+
+def _bootstrap_interval(boot, theta_hat, jack, alpha, ci_method):
+    if ci_method == 'percentile':
+        return tuple(np.quantile(boot, [alpha / 2, 1 - alpha / 2]))
+
+    if ci_method != 'bca':
+        raise ValueError("ci_method must be 'percentile' or 'bca'")
+
+    # bias correction
+    z0 = st.norm.ppf(np.mean(boot < theta_hat))
+    # acceleration
+    u = jack.mean() - jack
+    denominator = 6 * np.sum(u ** 2) ** 1.5
+    acc = np.sum(u ** 3) / denominator if denominator > 0 else 0.
+
+    z = st.norm.ppf([alpha / 2, 1 - alpha / 2])
+    levels = st.norm.cdf(z0 + (z0 + z) / (1 - acc * (z0 + z)))
+    return tuple(np.quantile(boot, levels))
+
+
+def bootstrap_ci(data, sample_num, statistic='mean', alpha=0.05, ci_method='percentile', random_state=None,
+                 block_size=BOOTSTRAP_BLOCK_SIZE):
+    """
+    Бутстреп доверительный интервал статистики выборки
+
+    :param data: Данные, см. bootstrap
+    :param sample_num: Кол-во раз, которое будет происходить семплирование
+    :param statistic: (str or callable, optional, default='mean'), см. bootstrap
+    :param alpha: (float, optional, default=0.05), Уровень значимости, интервал имеет уровень доверия 1 - alpha
+    :param ci_method: (str, optional, default='percentile'), 'percentile' или 'bca' (bias-corrected and
+    accelerated, https://en.wikipedia.org/wiki/Bootstrapping_(statistics)#Methods_for_bootstrap_confidence_intervals)
+    :param random_state: (int, numpy.random.Generator or None, optional, default=None), Seed генератора
+    :param block_size: (int, optional, default=2**20), см. bootstrap
+    :return: (tuple), нижняя и верхняя границы интервала
+    """
+    boot = bootstrap(data, sample_num, statistic=statistic, random_state=random_state, block_size=block_size)
+
+    if ci_method != 'bca':
+        return _bootstrap_interval(boot, None, None, alpha, ci_method)
+
+    data = _as_bootstrap_data(data, statistic)
+    return _bootstrap_interval(boot, _point_statistic(data, statistic), _jackknife(data, statistic),
+                               alpha, ci_method)
+
+
+def bootstrap_diff_ci(a, b, sample_num, statistic='mean', relative=False, alpha=0.05, ci_method='percentile',
+                      random_state=None, block_size=BOOTSTRAP_BLOCK_SIZE):
+    """
+    Бутстреп доверительный интервал разницы статистик двух независимых выборок, см. bootstrap_diff.
+    Если интервал не содержит 0, разница статистически значима на уровне alpha
+
+    :param a: Выборка до изменений (контрольная группа)
+    :param b: Выборка после изменений (тестовая группа)
+    :param sample_num: Кол-во раз, которое будет происходить семплирование
+    :param statistic: (str or callable, optional, default='mean'), см. bootstrap
+    :param relative: (bool, optional, default=False), Считать ли относительную разницу
+    :param alpha: (float, optional, default=0.05), Уровень значимости, интервал имеет уровень доверия 1 - alpha
+    :param ci_method: (str, optional, default='percentile'), 'percentile' или 'bca'
+    :param random_state: (int, numpy.random.Generator or None, optional, default=None), Seed генератора
+    :param block_size: (int, optional, default=2**20), см. bootstrap
+    :return: (tuple), нижняя и верхняя границы интервала
+    """
+    boot = bootstrap_diff(a, b, sample_num, statistic=statistic, relative=relative, random_state=random_state,
+                          block_size=block_size)
+
+    if ci_method != 'bca':
+        return _bootstrap_interval(boot, None, None, alpha, ci_method)
+
+    a = _as_bootstrap_data(a, statistic)
+    b = _as_bootstrap_data(b, statistic)
+    theta_a, theta_b = _point_statistic(a, statistic), _point_statistic(b, statistic)
+    jack_a, jack_b = _jackknife(a, statistic), _jackknife(b, statistic)
+
+    if relative:
+        theta_hat = (theta_b - theta_a) / theta_a
+        jack = np.concatenate([(theta_b - jack_a) / jack_a, (jack_b - theta_a) / theta_a])
+    else:
+        theta_hat = theta_b - theta_a
+        jack = np.concatenate([theta_b - jack_a, jack_b - theta_a])
+
+    return _bootstrap_interval(boot, theta_hat, jack, alpha, ci_method)
+
+
 def kruskal_wallis(*args, nan_policy='propagate', alpha=0.05, verbose=0):
     """
     Тест Краскалла-Уоллиса для проверки гипотезы равенства медиан у выборок
@@ -261,6 +657,249 @@ def kruskal_wallis(*args, nan_policy='propagate', alpha=0.05, verbose=0):
         return False
 
 
+def rank_tests(a, b):
+    """
+    Непараметрические тесты Манна-Уитни, Краскела-Уоллиса и Муда по общим рангам. Объединенная выборка
+    ранжируется один раз (средние ранги для связок), после чего из рангов и размеров связок считаются
+    все три статистики с поправками на связки, как в scipy.stats.mannwhitneyu (двусторонняя альтернатива,
+    поправка на непрерывность), scipy.stats.kruskal и scipy.stats.mood.
+    Если выборки заранее отсортированы, сортировка объединенной выборки работает за линейное время.
+
+    :param a: (array-like), First sample
+    :param b: (array-like), Second sample
+    :return: (dict), {'mannwhitneyu': (U, p_value), 'kruskal': (H, p_value), 'mood': (z, p_value)}.
+    Если в одной из выборок есть NaN, все статистики и p-value равны NaN
+    """
+    a = np.asarray(a, dtype=float)
+    b = np.asarray(b, dtype=float)
+    n1, n2 = len(a), len(b)
+    n = n1 + n2
+
+    if n1 == 0 or n2 == 0:
+        raise ValueError("Samples must be non-empty")
+    if np.isnan(a).any() or np.isnan(b).any():
+        # Как scipy с nan_policy='propagate': статистики и p-value не определены
+        return {test: (np.nan, np.nan) for test in ('mannwhitneyu', 'kruskal', 'mood')}
+
+    pooled = np.concatenate([a, b])
+    # stable sort: на двух отсортированных кусках работает за линейное время
+    order = np.argsort(pooled, kind='stable')
+    sorted_values = pooled[order]
+    from_a = order < n1
+
+    # Связки: блоки одинаковых значений в отсортированной выборке
+    starts = np.flatnonzero(np.concatenate([[True], sorted_values[1:] != sorted_values[:-1]]))
+    t = np.diff(np.append(starts, n)).astype(float)
+    block = np.repeat(np.arange(len(t)), t.astype(int))
+    # Ранги блока - с S_{j-1} + 1 по S_j
+    s_hi = np.cumsum(t)
+    s_lo = s_hi - t
+    avg_rank = (s_lo + 1 + s_hi) / 2
+    tie_term = np.sum(t ** 3 - t)
+
+    # Mann-Whitney U
+    r1 = avg_rank[block][from_a].sum()
+    u1 = r1 - n1 * (n1 + 1) / 2
+    if (n1 <= 8 or n2 <= 8) and tie_term == 0:
+        # для маленьких выборок без связок scipy использует точное распределение
+        mwu = tuple(st.mannwhitneyu(a, b))
+    else:
+        u = max(u1, n1 * n2 - u1)
+        sigma = np.sqrt(n1 * n2 / 12 * ((n + 1) - tie_term / (n * (n - 1))))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            z = (u - n1 * n2 / 2 - 0.5) / sigma
+        mwu = (u1, float(np.clip(2 * st.norm.sf(z), 0, 1)))
+
+    # Kruskal-Wallis H
+    r2 = n * (n + 1) / 2 - r1
+    h = 12 / (n * (n + 1)) * (r1 ** 2 / n1 + r2 ** 2 / n2) - 3 * (n + 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        h /= 1 - tie_term / (n ** 3 - n)
+    kruskal = (h, st.chi2.sf(h, 1))
+
+    # Mood: среднее (I - (n + 1) / 2)^2 по рангам I блока (Mielke, 1967)
+    c = (n + 1) / 2
+
+    def _sum_sq(k):
+        return k * (k + 1) * (2 * k + 1) / 6
+
+    def _sum(k):
+        return k * (k + 1) / 2
+
+    phi = ((_sum_sq(s_hi) - _sum_sq(s_lo)) - 2 * c * (_sum(s_hi) - _sum(s_lo)) + t * c ** 2) / t
+    mood_t = phi[block][from_a].sum()
+    expected = n1 * (n * n - 1) / 12
+    var_m = (n1 * n2 * (n + 1.) * (n ** 2 - 4) / 180
+             - n1 * n2 / (180 * n * (n - 1)) * np.sum(t * (t ** 2 - 1) * (t ** 2 - 4 + 15 * (n - s_hi - s_lo) ** 2)))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        z_mood = (mood_t - expected) / np.sqrt(var_m)
+    mood = (z_mood, 2 * st.norm.sf(abs(z_mood)))
+
+    return {'mannwhitneyu': mwu, 'kruskal': kruskal, 'mood': mood}
+
+
+class _FenwickTree:
+    """
+    Дерево Фенвика для количества значений по рангам: добавление и сумма на префиксе за O(log n)
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.tree = [0] * (size + 1)
+
+    def add(self, i, value=1):
+        i += 1
+        while i <= self.size:
+            self.tree[i] += value
+            i += i & -i
+
+    def prefix_sum(self, i):
+        """
+        Сумма значений с рангами < i
+        """
+        res = 0
+        while i > 0:
+            res += self.tree[i]
+            i -= i & -i
+        return res
+
+
+def _mannwhitneyu_asymptotic_p(u1, n1, n2, tie_term):
+    n = n1 + n2
+    u = np.maximum(u1, n1 * n2 - u1)
+    sigma = np.sqrt(n1 * n2 / 12 * ((n + 1) - tie_term / (n * (n - 1))))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        z = (u - n1 * n2 / 2 - 0.5) / sigma
+    return np.clip(2 * st.norm.sf(z), 0, 1)
+
+
+def mannwhitneyu_trajectory(a, b):
+    """
+    p-value двустороннего теста Манна-Уитни для всех префиксов выборок: k-й элемент результата соответствует
+    st.mannwhitneyu(a[:k + 1], b[:k + 1]). Вместо пересчета теста для каждого префикса (O(n^2 log n))
+    статистика U обновляется при добавлении каждого наблюдения: кол-во меньших и равных значений другой выборки
+    берется из деревьев Фенвика по рангам значений, а поправка на связки обновляется за O(1).
+    Итого O(n log n) на всю траекторию. В отличие от scipy, точное распределение U используется только
+    для префиксов, в которых обе выборки не больше 8 наблюдений, для остальных - нормальное приближение.
+
+    :param a: (array-like), First sample, в порядке поступления наблюдений
+    :param b: (array-like), Second sample, в порядке поступления наблюдений
+    :return: (numpy.ndarray), p-values длины max(len(a), len(b)). Начиная с первого префикса, в котором
+    есть NaN, p-value равны NaN, как у scipy с nan_policy='propagate'
+    """
+    a = np.asarray(a, dtype=float)
+    b = np.asarray(b, dtype=float)
+    length = max(len(a), len(b))
+
+    nan_a, nan_b = np.flatnonzero(np.isnan(a)), np.flatnonzero(np.isnan(b))
+    if len(nan_a) or len(nan_b):
+        cut = min(nan_a[0] if len(nan_a) else length, nan_b[0] if len(nan_b) else length)
+        p_values = np.full(length, np.nan)
+        if cut > 0:
+            p_values[:cut] = mannwhitneyu_trajectory(a[:cut], b[:cut])
+        return p_values
+
+    # Ранги значений в объединенной выборке
+    values, codes = np.unique(np.concatenate([a, b]), return_inverse=True)
+    codes_a, codes_b = codes[:len(a)].tolist(), codes[len(a):].tolist()
+
+    tree_a, tree_b = _FenwickTree(len(values)), _FenwickTree(len(values))
+    pooled = [0] * len(values)
+    n1 = n2 = 0
+    u1 = 0.
+    tie_term = 0
+
+    u1_arr, n1_arr, n2_arr, tie_arr = (np.empty(length) for _ in range(4))
+
+    for k in range(length):
+        if k < len(a):
+            c = codes_a[k]
+            # новое значение a больше всех меньших значений b и равно связкам
+            less, equal = tree_b.prefix_sum(c), tree_b.prefix_sum(c + 1) - tree_b.prefix_sum(c)
+            u1 += less + 0.5 * equal
+            tree_a.add(c)
+            tie_term += 3 * pooled[c] ** 2 + 3 * pooled[c]
+            pooled[c] += 1
+            n1 += 1
+        if k < len(b):
+            c = codes_b[k]
+            # новое значение b меньше всех больших значений a
+            not_greater = tree_a.prefix_sum(c + 1)
+            equal = not_greater - tree_a.prefix_sum(c)
+            u1 += (n1 - not_greater) + 0.5 * equal
+            tree_b.add(c)
+            tie_term += 3 * pooled[c] ** 2 + 3 * pooled[c]
+            pooled[c] += 1
+            n2 += 1
+        u1_arr[k], n1_arr[k], n2_arr[k], tie_arr[k] = u1, n1, n2, tie_term
+
+    p_values = _mannwhitneyu_asymptotic_p(u1_arr, n1_arr, n2_arr, tie_arr)
+
+    # Точное распределение, как у scipy, только для префиксов, где обе выборки маленькие и нет связок:
+    # таких префиксов не больше 8, и вызов scipy для каждого из них стоит O(1)
+    exact = (n1_arr <= 8) & (n2_arr <= 8) & (tie_arr == 0)
+    for k in np.flatnonzero(exact):
+        p_values[k] = st.mannwhitneyu(a[:k + 1], b[:k + 1])[1]
+
+    return p_values
+
+
+def _running_moments(x):
+    # Сдвиг на первое значение уменьшает потерю точности в sum(x^2) - n * mean^2
+    shift = x[0] if len(x) else 0.
+    d = x - shift
+    n = np.arange(1, len(x) + 1, dtype=float)
+    s1, s2 = np.cumsum(d), np.cumsum(d ** 2)
+    mean = s1 / n
+    with np.errstate(divide='ignore', invalid='ignore'):
+        var = (s2 - n * mean ** 2) / (n - 1)
+    return n, mean + shift, np.maximum(var, 0)
+
+
+def _extend_last(x, length):
+    return np.concatenate([x, np.repeat(x[-1:], length - len(x))])
+
+
+def welch_ttest_trajectory(a, b):
+    """
+    p-value двустороннего t-теста Уэлча для всех префиксов выборок: k-й элемент результата соответствует
+    st.ttest_ind(a[:k + 1], b[:k + 1], equal_var=False). Средние и дисперсии префиксов считаются
+    по накопленным суммам за O(n)
+
+    :param a: (array-like), First sample, в порядке поступления наблюдений
+    :param b: (array-like), Second sample, в порядке поступления наблюдений
+    :return: (numpy.ndarray), p-values длины max(len(a), len(b)), для префиксов из одного наблюдения - nan
+    """
+    a = np.asarray(a, dtype=float)
+    b = np.asarray(b, dtype=float)
+    length = max(len(a), len(b))
+
+    n1, mean1, var1 = (_extend_last(x, length) for x in _running_moments(a))
+    n2, mean2, var2 = (_extend_last(x, length) for x in _running_moments(b))
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        se1, se2 = var1 / n1, var2 / n2
+        t = (mean1 - mean2) / np.sqrt(se1 + se2)
+        df = (se1 + se2) ** 2 / (se1 ** 2 / (n1 - 1) + se2 ** 2 / (n2 - 1))
+    return 2 * st.t.sf(np.abs(t), df)
+
+
+def z_test_ratio_trajectory(successes1, successes2, trials1, trials2):
+    """
+    p-value z_test_ratio по накопленным к каждому моменту успехам и попыткам: k-й элемент результата
+    соответствует z_test_ratio(sum(successes1[:k + 1]), sum(successes2[:k + 1]), sum(trials1[:k + 1]),
+    sum(trials2[:k + 1])), например для дневных рядов транзакций и сессий
+
+    :param successes1: (array-like), successes in first group
+    :param successes2: (array-like), successes in second group
+    :param trials1: (array-like), all trials in first group
+    :param trials2: (array-like), all trials in second group
+    :return: (numpy.ndarray), p-values
+    """
+    return z_test_ratio_batch(np.cumsum(successes1), np.cumsum(successes2), np.cumsum(trials1),
+                              np.cumsum(trials2))
+
+
 def z_test_ratio(successes1, successes2, trials1, trials2, alpha=0.05, verbose=0):
     """
     Z-test for binary variable. Null hypothesis H0: ratio in two groups is equal.
@@ -297,3 +936,31 @@ def z_test_ratio(successes1, successes2, trials1, trials2, alpha=0.05, verbose=0
         if verbose > 0:
             print("Can not Reject null hypothesis, ratio in groups has no statistically significant difference")
         return p_value
+
+
+def z_test_ratio_batch(successes1, successes2, trials1, trials2):
+    """
+    Векторизованная версия z_test_ratio: считает p-value сразу для массивов успехов и попыток,
+    i-й элемент результата соответствует z_test_ratio(successes1[i], successes2[i], trials1[i], trials2[i])
+
+    :param successes1: (array-like), successes in first group
+    :param successes2: (array-like), successes in second group
+    :param trials1: (array-like), all trials in first group
+    :param trials2: (array-like), all trials in second group
+    :return: (numpy.ndarray), p-values of H0 for each element
+    """
+    successes1 = np.asarray(successes1, dtype=float)
+    successes2 = np.asarray(successes2, dtype=float)
+    trials1 = np.asarray(trials1, dtype=float)
+    trials2 = np.asarray(trials2, dtype=float)
+
+    if np.any(trials1 <= 0) or np.any(trials2 <= 0) or np.any(successes1 < 0) or np.any(successes2 < 0):
+        raise ValueError("Number of trials or successes must be positive")
+
+    p1 = successes1 / trials1
+    p2 = successes2 / trials2
+
+    p_combined = (successes1 + successes2) / (trials1 + trials2)
+    z_value = (p1 - p2) / np.sqrt(p_combined * (1 - p_combined) * (1 / trials1 + 1 / trials2))
+
+    return (1 - st.norm.cdf(np.abs(z_value))) * 2
@@ -0,0 +1,228 @@
+import json
+import numpy as np
+import pandas as pd
+
+
+class SufficientStatistics:
+    """
+    Компактное представление данных A/B теста через достаточные статистики: для каждой комбинации ключей
+    (например дата, вариант эксперимента и все столбцы срезов) хранятся кол-во, сумма и сумма квадратов каждой
+    метрики. Для z-test, t-test и Байесовского теста этого достаточно, а данные по более крупным срезам
+    получаются суммированием по лишним ключам, без повторного прохода по исходным строкам.
+
+    Куб хранится в виде датафрейма со столбцами ключей, столбцом n_rows с кол-вом исходных строк и столбцами
+    {metric}_count, {metric}_sum, {metric}_m2, где m2 - сумма квадратов отклонений от среднего комбинации.
+    В отличие от суммы квадратов, m2 не теряет точность при вычитании для метрик с большими значениями
+    (например выручки), части куба объединяются по формуле Chan et al.
+
+    :param cube: (pandas.DataFrame), Предагрегированные данные в формате, описанном выше
+    :param keys: (list), Названия столбцов с ключами
+    :param metrics: (list), Названия метрик
+    """
+
+    # Агрегации, которые можно восстановить по кол-ву, сумме и сумме квадратов
+    AGGREGATIONS = ('sum', 'count', 'mean', 'var', 'std')
+    SUFFIXES = ('count', 'sum', 'm2')
+    ROWS = 'n_rows'
+
+    def __init__(self, cube, keys, metrics):
+        self.keys = list(keys)
+        self.metrics = list(metrics)
+
+        missing = [col for col in self.keys + self.stat_columns(self.metrics) if col not in cube.columns]
+        if missing:
+            raise ValueError(f"Columns {missing} are missing in the cube")
+
+        self.cube = cube
+
+    @staticmethod
+    def stat_columns(metrics):
+        return [SufficientStatistics.ROWS] + \
+               [f'{metric}_{suffix}' for metric in metrics for suffix in SufficientStatistics.SUFFIXES]
+
+    @classmethod
+    def from_frame(cls, df, keys, metrics):
+        """
+        Строит куб по исходному датафрейму за одну группировку
+
+        :param df: (pandas.DataFrame), Исходные данные, например полученные при помощи core.get_data.query
+        :param keys: (list), Названия столбцов, по которым будет идти группировка
+        :param metrics: (list), Названия метрик
+        :return: (SufficientStatistics)
+        """
+        keys, metrics = list(keys), list(metrics)
+        frame = df[keys].copy()
+        frame[cls.ROWS] = np.int64(1)
+
+        for metric in metrics:
+            values = df[metric]
+            frame[f'{metric}_count'] = values.notna().astype(np.int64)
+            frame[f'{metric}_sum'] = values
+            frame[f'{metric}_m2'] = 0.
+
+        # dropna=False: строки с пропуском в одном из срезов должны попадать в срезы по остальным столбцам.
+        # Строки с пропуском в дате или варианте отбрасываются при свертке куба (см. rollup)
+        cube = cls.merge(frame, keys, metrics, sort=False, dropna=False)
+
+        return cls(cube, keys, metrics)
+
+    @classmethod
+    def merge(cls, cube, by, metrics, sort=True, dropna=True):
+        """
+        Объединяет строки cube с одинаковыми значениями by: кол-ва и суммы складываются, а m2 объединяются
+        как m2 = sum(m2_i) + sum(count_i * (mean_i - mean)^2), где mean - среднее объединенной комбинации
+
+        :param cube: (pandas.DataFrame), Куб или его часть
+        :param by: (list), Ключи, которые остаются в результате
+        :param metrics: (list), Названия метрик
+        :param sort: (bool, optional, default=True), См. pandas.DataFrame.groupby
+        :param dropna: (bool, optional, default=True), См. pandas.DataFrame.groupby
+        :return: (pandas.DataFrame)
+        """
+        by = list(by)
+        columns = cls.stat_columns(metrics)
+        grouped = cube.groupby(by, sort=sort, dropna=dropna, observed=True)
+
+        frame = cube[by + columns].copy()
+        totals = grouped[[f'{metric}_{suffix}' for metric in metrics for suffix in ('count', 'sum')]]\
+            .transform('sum')
+
+        for metric in metrics:
+            cnt = cube[f'{metric}_count']
+            mean = cube[f'{metric}_sum'].astype(float) / cnt.where(cnt > 0)
+            total_mean = totals[f'{metric}_sum'].astype(float) / totals[f'{metric}_count']
+            frame[f'{metric}_m2'] = cube[f'{metric}_m2'] + (cnt * (mean - total_mean) ** 2).fillna(0)
+
+        return frame.groupby(by, sort=sort, dropna=dropna, observed=True)[columns].sum().reset_index()
+
+    @classmethod
+    def from_aggregates(cls, cube, metrics=None):
+        """
+        Куб по уже агрегированным данным, например полученным при помощи core.get_data.query(aggregate=True).
+        Ключами считаются все столбцы, кроме столбцов достаточных статистик
+
+        :param cube: (pandas.DataFrame), Данные в формате куба (см. описание класса)
+        :param metrics: (list, optional, default=None), Названия метрик, по умолчанию - все метрики,
+        для которых в cube есть столбец {metric}_m2
+        :return: (SufficientStatistics)
+        """
+        if metrics is None:
+            metrics = [col[:-len('_m2')] for col in cube.columns if col.endswith('_m2')]
+
+        # Столбцы статистик метрик, не вошедших в metrics, тоже не являются ключами
+        suffixes = tuple(f'_{suffix}' for suffix in cls.SUFFIXES)
+        keys = [col for col in cube.columns if col != cls.ROWS and not col.endswith(suffixes)]
+
+        return cls(cube, keys, metrics)
+
+    def subcube(self, keys, metrics):
+        """
+        Куб по части ключей и метрик, строки суммируются по остальным ключам. Порядок комбинаций ключей -
+        порядок их появления в данных, как у from_frame
+        """
+        keys, metrics = list(keys), list(metrics)
+        missing = [col for col in keys if col not in self.keys] + [m for m in metrics if m not in self.metrics]
+        if missing:
+            raise ValueError(f"Keys or metrics {missing} are missing in the cube")
+
+        cube = self.merge(self.cube, keys, metrics, sort=False, dropna=False)
+        return SufficientStatistics(cube, keys, metrics)
+
+    @classmethod
+    def supports(cls, metric_aggregations):
+        """
+        Можно ли получить агрегации metric_aggregations (см. Pipeline.pipeline) из куба
+        """
+        return all(isinstance(agg, str) and agg in cls.AGGREGATIONS for agg in metric_aggregations.values())
+
+    def rollup(self, by, cube=None):
+        """
+        Суммирует достаточные статистики по всем ключам, кроме by
+
+        :param by: (list), Ключи, которые остаются в результате
+        :param cube: (pandas.DataFrame, optional, default=None), Часть куба, по умолчанию - весь куб
+        :return: (pandas.DataFrame), Куб меньшей размерности, отсортированный по by. Комбинации с пропуском
+        в одном из ключей by отбрасываются, как в df.groupby(by)
+        """
+        cube = self.cube if cube is None else cube
+        return self.merge(cube, by, self.metrics)
+
+    def rows(self, by):
+        """
+        Кол-во исходных строк для каждой комбинации значений by, аналог df.groupby(by).size().
+        Порядок комбинаций - порядок их появления в данных
+        """
+        return self.cube.groupby(list(by), sort=False, dropna=False, observed=True)[self.ROWS].sum()
+
+    def append(self, other, key, overwrite=False):
+        """
+        Добавляет к кубу строки другого куба с теми же ключами и метриками, например построенного по новым дням.
+        Добавляются только строки со значениями key, которых еще нет в кубе
+
+        :param other: (SufficientStatistics), Куб с новыми данными
+        :param key: (str), Ключ, по которому определяются новые данные, например столбец с датой
+        :param overwrite: (bool, optional, default=False), Если True, значения key, которые есть в other,
+        заменяют сохраненные (например, если данные за последние дни еще досчитываются)
+        :return: (SufficientStatistics), Новый куб
+        """
+        if self.keys != other.keys or self.metrics != other.metrics:
+            raise ValueError("Only cubes with the same keys and metrics can be appended")
+
+        old_values = self.cube[key]
+        new_values = other.cube[key]
+
+        if overwrite:
+            cube = self.cube[~old_values.isin(new_values.unique())]
+            new = other.cube
+        else:
+            cube = self.cube
+            new = other.cube[~new_values.isin(old_values.unique())]
+
+        cube = pd.concat([cube, new[cube.columns]], ignore_index=True)
+        return SufficientStatistics(cube, self.keys, self.metrics)
+
+    def save(self, path):
+        """
+        Сохраняет куб в Parquet-файл path, а названия ключей и метрик - в JSON-файл {path}.json рядом с ним
+        """
+        self.cube.to_parquet(path, index=False)
+        with open(f'{path}.json', 'w') as f:
+            json.dump({'keys': self.keys, 'metrics': self.metrics}, f)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Загружает куб, сохраненный методом save
+        """
+        with open(f'{path}.json') as f:
+            state = json.load(f)
+        return cls(pd.read_parquet(path), state['keys'], state['metrics'])
+
+    @staticmethod
+    def finalize(rolled, by, metric_aggregations):
+        """
+        Восстанавливает значения агрегаций из сумм: результат совпадает с
+        df.groupby(by, as_index=False).agg(metric_aggregations)
+        """
+        res = rolled[list(by)].copy()
+
+        for metric, agg in metric_aggregations.items():
+            cnt, s = rolled[f'{metric}_count'], rolled[f'{metric}_sum']
+
+            if agg == 'sum':
+                res[metric] = s
+            elif agg == 'count':
+                res[metric] = cnt
+            elif agg == 'mean':
+                res[metric] = s / cnt
+            else:
+                var = (rolled[f'{metric}_m2'] / (cnt - 1)).where(cnt > 1)
+                res[metric] = var if agg == 'var' else np.sqrt(var)
+
+        return res
+
+    def aggregate(self, by, metric_aggregations, cube=None):
+        """
+        Аналог df.groupby(by, as_index=False).agg(metric_aggregations) по кубу
+        """
+        return self.finalize(self.rollup(by, cube=cube), by, metric_aggregations)
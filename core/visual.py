@@ -2,8 +2,8 @@ from itertools import combinations
 import plotly.graph_objs as go
 import plotly.express as px
 import plotly.figure_factory as ff
-import scipy.stats as st
 import logging
+from core import stat_test, sequential
 
 
 class ShowPlots:
@@ -99,7 +99,17 @@ class ShowPlots:
         return
 
     @staticmethod
-    def p_value_dynamic(df, date_col, variant_col, metric, alpha=0.05, **kwargs):
+    def p_value_dynamic(df, date_col, variant_col, metric, alpha=0.05, test='mannwhitneyu', **kwargs):
+        """
+        График p-value теста по накопленным к каждой дате данным. p-value для всех дат считаются одним проходом
+        по данным (см. stat_test.mannwhitneyu_trajectory и stat_test.welch_ttest_trajectory)
+        :param test: (str, optional, default='mannwhitneyu'), 'mannwhitneyu' или 'welch'
+        """
+        trajectories = {'mannwhitneyu': stat_test.mannwhitneyu_trajectory,
+                        'welch': stat_test.welch_ttest_trajectory}
+        if test not in trajectories:
+            raise ValueError(f"test must be one of {list(trajectories)}")
+
         df = df.sort_values(by=date_col)
         _vars = df[variant_col].unique()
         vars_comb = combinations(df[variant_col].unique(), 2)
@@ -109,11 +119,7 @@ class ShowPlots:
         for comb in vars_comb:
             df_1 = df.query(f"{variant_col} == {comb[0]}")
             df_2 = df.query(f"{variant_col} == {comb[1]}")
-            p_values = []
-
-            for i in range(1, len(df_1)):
-                p_value = st.mannwhitneyu(df_1[metric][:i], df_2[metric][:i])[1]
-                p_values.append(p_value)
+            p_values = trajectories[test](df_1[metric].to_numpy(), df_2[metric].to_numpy())[:len(df_1) - 1]
 
             figures.append(go.Scatter(
                 x=df_1[date_col],
@@ -132,6 +138,60 @@ class ShowPlots:
 
         return
 
+    @staticmethod
+    def sequential_dynamic(df, date_col, variant_col, metric, alpha=0.05, tau=None, relative_tau=0.1, **kwargs):
+        """
+        Графики always-valid p-value и доверительной последовательности для разницы средних по mSPRT
+        (см. core.sequential.MSPRT). В отличие от p_value_dynamic, по этим графикам можно принимать решение
+        в любой день теста
+        :param tau: (float, optional, default=None), См. core.sequential.MSPRT
+        :param relative_tau: (float, optional, default=0.1), См. core.sequential.MSPRT
+        """
+        df = df.sort_values(by=date_col)
+        vars_comb = combinations(df[variant_col].unique(), 2)
+
+        p_figures = []
+        ci_figures = []
+
+        for comb in vars_comb:
+            df_1 = df.query(f"{variant_col} == {comb[0]}")
+            df_2 = df.query(f"{variant_col} == {comb[1]}")
+            res = sequential.msprt_trajectory(df_1[metric].to_numpy(), df_2[metric].to_numpy(),
+                                              alpha=alpha, tau=tau, relative_tau=relative_tau)[:len(df_1)]
+            dates = df_1[date_col].iloc[:len(res)]
+
+            p_figures.append(go.Scatter(
+                x=dates,
+                y=res['p_value'],
+                name=f'Always-valid p-values for variants {comb}'
+            ))
+            ci_figures.append(go.Scatter(
+                x=dates,
+                y=res['ci_upper'],
+                name=f'Upper bound for variants {comb}'
+            ))
+            ci_figures.append(go.Scatter(
+                x=dates,
+                y=res['ci_lower'],
+                fill='tonexty',
+                name=f'Lower bound for variants {comb}'
+            ))
+
+        fig = go.Figure(p_figures, **kwargs)
+        fig.add_trace(go.Scatter(
+            x=df[date_col].unique(),
+            y=[alpha]*len(df[date_col].unique()),
+            name=f'Alpha-value = {alpha}'
+        ))
+        fig.update_layout(title=f'Always-valid p_value dynamic for {metric}')
+        fig.show()
+
+        fig = go.Figure(ci_figures, **kwargs)
+        fig.update_layout(title=f'{1 - alpha:.0%} confidence sequence for difference in {metric}')
+        fig.show()
+
+        return
+
     @staticmethod
     def boxplots(df, variant_col, metric, autosize=False, **kwargs):
 
@@ -0,0 +1,137 @@
+import datetime
+import os
+import re
+
+import pandas as pd
+import pyarrow as pa
+import pytest
+
+pytest.importorskip('google.cloud.bigquery')
+
+from core.get_data import (ArrowTableFetcher, BigQueryDayCache, bq_to_parquet, explain_query,  # noqa: E402
+                           get_experiments_from_bq, get_from_bq, query, stream_from_bq)
+
+
+def test_aggregate_query_returns_sufficient_statistics():
+    sql = query('project.dataset', '20210101', '20210131', 'exp', events={'cart': ['add', 'Ecom']}, aggregate=True)
+
+    for metric in ['transactions', 'transactionRevenue', 'duration', 'pageviews', 'cart']:
+        for stat in ['count', 'sum', 'm2']:
+            assert f'AS {metric}_{stat}' in sql
+    assert 'AS n_rows' in sql
+    assert 'GROUP BY date, experimentVariant, device, region, visitor_type' in sql
+
+    # Агрегация не добавляет сканирований: таблица читается один раз, как и у запроса по сеансам
+    plan = explain_query(sql)
+    assert plan['tables'] == {'project.dataset.ga_sessions_*': 1} and plan['joins'] == 0
+    assert plan['columns'] == explain_query(query('project.dataset', '20210101', '20210131', 'exp',
+                                                  events={'cart': ['add', 'Ecom']}))['columns']
+
+
+def test_custom_dimensions_do_not_rescan_table():
+    cds = {'plan': [5, 'hits'], 'segment': [3, 'session']}
+    sql = query('project.dataset', '20210101', '20210131', 'exp', custom_dimensions=cds)
+
+    plan = explain_query(sql)
+    assert plan['tables'] == {'project.dataset.ga_sessions_*': 1} and plan['joins'] == 0
+    assert {'customDimensions', 'hits.customDimensions.index', 'hits.customDimensions.value'} <= set(plan['columns'])
+
+    # Подзапросы считаются один раз на сеанс в проекции, а в основном запросе берется уже готовое значение
+    for cd in cds:
+        assert sql.count(f'AS _cd_{cd}') == 1
+        assert f'MAX(_cd_{cd}) AS {cd}' in sql
+
+
+def test_multi_experiment_query_scans_once(tmp_path):
+    sql = query('project.dataset', '20210101', '20210131', ['exp_1', 'exp_2'], aggregate=True)
+    assert "experiment_ids = ['exp_1', 'exp_2']" in sql and 'experimentId IN UNNEST(experiment_ids)' in sql
+    assert 'GROUP BY experimentId, date' in sql
+    assert explain_query(sql)['scans'] == 1
+
+    table = pa.table({'experimentId': ['exp_1', 'exp_2', 'exp_1'], 'experimentVariant': ['0', '1', '1'],
+                      'transactions': [1, 2, 3]})
+    fetcher = ArrowTableFetcher({sql: table})
+    dfs = get_experiments_from_bq(None, None, sql, columns=['transactions'], fetcher=fetcher)
+    assert sorted(dfs) == ['exp_1', 'exp_2']
+    assert dfs['exp_1']['transactions'].tolist() == [1, 3] and dfs['exp_2']['transactions'].tolist() == [2]
+
+    # С output_path результат пишется в датасет, партиционированный по эксперименту
+    output_path = str(tmp_path / 'experiments')
+    assert get_experiments_from_bq(None, None, sql, output_path=output_path, fetcher=fetcher) == 3
+    assert sorted(os.listdir(output_path)) == ['_RWAB_DATASET', 'experimentId=exp_1', 'experimentId=exp_2']
+
+
+def test_stream_from_bq_yields_selected_columns_in_batches():
+    table = pa.table({'date': ['d1'] * 5 + ['d2'] * 5, 'experimentVariant': ['0', '1'] * 5, 'transactions': range(10)})
+    fetcher = ArrowTableFetcher(table, batch_size=4)
+
+    batches = list(stream_from_bq('q', columns=['date', 'transactions'], fetcher=fetcher))
+    assert [b.num_rows for b in batches] == [4, 4, 2]
+    assert all(b.schema.names == ['date', 'transactions'] for b in batches)
+
+    pd.testing.assert_frame_equal(get_from_bq(None, None, 'q', fetcher=fetcher), table.to_pandas())
+    # Пустой результат - пустая таблица с запрошенными столбцами
+    empty = get_from_bq(None, None, 'q', columns=['date'], fetcher=ArrowTableFetcher(table.slice(0, 0)))
+    assert empty.empty and list(empty.columns) == ['date']
+
+
+def test_bq_to_parquet_rewrites_own_dataset_only(tmp_path):
+    output_path = str(tmp_path / 'sessions')
+    bq_to_parquet('q', output_path, fetcher=ArrowTableFetcher(pa.table({'date': ['d1', 'd2'], 'x': [1, 2]})),
+                  partitioning=['date'])
+    # Повторный запуск без одного из дней не оставляет его старую партицию
+    assert bq_to_parquet('q', output_path, fetcher=ArrowTableFetcher(pa.table({'date': ['d1'], 'x': [3]})),
+                         partitioning=['date']) == 1
+    assert pd.read_parquet(output_path)['x'].tolist() == [3]
+
+    other = tmp_path / 'other'
+    other.mkdir()
+    (other / 'notes.txt').write_text('keep me')
+    with pytest.raises(ValueError):
+        bq_to_parquet('q', str(other), fetcher=ArrowTableFetcher(pa.table({'x': [1]})))
+    assert os.listdir(other) == ['notes.txt']
+
+
+class DayFetcher:
+    """Отдает по строке на эксперимент за день из запроса и запоминает запрошенные дни"""
+
+    def __init__(self):
+        self.days = []
+
+    def iter_batches(self, sql_query, columns=None):
+        day = re.search(r"SET start_date = '(\d+)'", sql_query).group(1)
+        self.days.append(day)
+        table = pa.table({'experimentId': ['exp_1', 'exp_2'], 'date': [day, day], 'transactions': [int(day[-2:])] * 2})
+        yield from (table if columns is None else table.select(columns)).to_batches()
+
+
+def test_bigquery_day_cache_fetches_only_missing_and_settling_days(tmp_path):
+    cache = BigQueryDayCache(str(tmp_path), settling_days=2, n_jobs=2)
+    fetcher = DayFetcher()
+    today = datetime.date(2021, 1, 6)
+
+    df = cache.get('project.dataset', '20210101', '20210105', 'exp_1', fetcher=fetcher, today=today)
+    assert sorted(fetcher.days) == ['20210101', '20210102', '20210103', '20210104', '20210105']
+    assert df.sort_values('date')['transactions'].tolist() == [1, 2, 3, 4, 5]
+    assert 'experimentId' not in df
+
+    # Повторно загружается только день, который еще может досчитываться
+    fetcher.days = []
+    pd.testing.assert_frame_equal(
+        cache.get('project.dataset', '20210101', '20210105', 'exp_1', fetcher=fetcher, today=today), df)
+    assert fetcher.days == ['20210105']
+
+    # Новый день и новый эксперимент загружаются, уже сохраненные дни exp_1 - нет
+    fetcher.days = []
+    df = cache.get('project.dataset', '20210103', '20210106', ['exp_1', 'exp_2'], fetcher=fetcher,
+                   today=datetime.date(2021, 1, 7))
+    assert sorted(fetcher.days) == ['20210103', '20210104', '20210105', '20210106']
+    assert len(df) == 8 and sorted(df['experimentId'].unique()) == ['exp_1', 'exp_2']
+
+    # Другие параметры запроса хранятся отдельно
+    assert cache.query_key('project.dataset') != cache.query_key('project.dataset', events={'cart': ['add', 'Ecom']})
+
+    cache.invalidate('exp_1')
+    fetcher.days = []
+    cache.get('project.dataset', '20210101', '20210102', 'exp_1', fetcher=fetcher, today=today)
+    assert sorted(fetcher.days) == ['20210101', '20210102']
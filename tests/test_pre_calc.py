@@ -0,0 +1,57 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from core.pre_calc import PrecalcCache, precalc, precalc_cache_key, _bisection_sample_size
+
+
+def test_formula_key_ignores_simulation_settings():
+    params = dict(baseline_mean=10., baseline_std=3., method='Students t-test formula')
+    key = precalc_cache_key(1000, **params)
+
+    assert precalc_cache_key(1000, num_simulations=10, search='bisect', random_state=42, **params) == key
+    # Generator не влияет на формулу и не должен мешать кэшированию
+    assert precalc_cache_key(1000, random_state=np.random.default_rng(0), **params) == key
+    assert precalc_cache_key(1000, **dict(params, baseline_std=4.)) != key
+
+
+def test_bisection_confirms_answer_above_noisy_dip():
+    # Оценка мощности немонотонна: N = 104 случайно "достаточно", но следующие размеры - нет
+    def is_enough(n):
+        return n == 104 or n >= 160
+
+    n = _bisection_sample_size(is_enough, 100, 400, 104, tol=0.02)
+    assert n >= 160 and all(is_enough(m) for m in range(n, 400))
+
+
+def test_monte_carlo_without_seed_is_not_cached():
+    data = np.random.default_rng(0).exponential(size=1000)
+    cache = PrecalcCache()
+    params = dict(baseline_data=data, method='Monte-Carlo t-test', num_simulations=20, max_weeks=1)
+
+    precalc(1000, random_state=None, cache=cache, **params)
+    assert cache.stats()['entries'] == 0
+    with pytest.raises(TypeError):
+        precalc_cache_key(1000, random_state=None, **params)
+
+    precalc(1000, random_state=1, cache=cache, **params)
+    assert cache.stats()['entries'] == 1
+
+
+@pytest.mark.parametrize('disk_format', ['npz', 'parquet'])
+def test_precalc_cache_round_trip(tmp_path, disk_format):
+    params = dict(baseline_cr=[0.05, 0.06], method='CR', max_lift=0.02)
+    key = precalc_cache_key([1000, 1200], **params)
+    results = precalc([1000, 1200], **params)
+
+    cache = PrecalcCache(path=str(tmp_path), disk_format=disk_format)
+    cache.put(key, results)
+    pd.testing.assert_frame_equal(cache.get(key), results)
+
+    # Новый экземпляр с той же директорией читает результат с диска
+    restored = PrecalcCache(path=str(tmp_path), disk_format=disk_format)
+    pd.testing.assert_frame_equal(restored.get(key), results, check_dtype=False)
+    assert restored.stats()['disk_hits'] == 1
+
+    pd.testing.assert_frame_equal(precalc([1000, 1200], cache=restored, **params), results, check_dtype=False)
+    assert restored.stats()['hits'] == 2
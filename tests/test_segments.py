@@ -0,0 +1,22 @@
+import itertools
+
+import numpy as np
+import pandas as pd
+
+from core.segments import SegmentIndex
+
+
+def test_take_matches_query():
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame({'device': rng.choice(['desktop', 'mobile', 'tablet'], 500),
+                       'userType': rng.choice(['New', 'Returning'], 500), 'x': rng.normal(size=500)})
+    df.loc[::11, 'device'] = np.nan
+    index = SegmentIndex(df, ['device', 'userType'])
+
+    for device, user_type in itertools.product(['desktop', 'mobile', 'tablet', 'tv'], ['New', 'Returning']):
+        expected = df.query(f"device == '{device}' and userType == '{user_type}'")
+        pd.testing.assert_frame_equal(index.take(df, [('device', device), ('userType', user_type)]), expected)
+
+    # Строки с пропуском в срезе не попадают ни в одно значение
+    assert sum(len(index.lookup([('device', val)])) for val in ['desktop', 'mobile', 'tablet']) == \
+        df['device'].notna().sum()
@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+
+from core.sequential import MSPRT, GroupSequential, msprt_trajectory
+
+
+def test_msprt_p_value_is_monotone_and_detects_effect():
+    rng = np.random.default_rng(0)
+    res = msprt_trajectory(rng.normal(1, 1, 2000), rng.normal(1.2, 1, 2000), alpha=0.05)
+
+    assert len(res) == 2000
+    assert (np.diff(res['p_value']) <= 0).all()
+    assert res['p_value'].iloc[-1] < 0.05
+    # Доверительная последовательность только сужается и накрывает истинную разницу
+    assert (np.diff(res['ci_lower'].dropna()) >= 0).all() and (np.diff(res['ci_upper'].dropna()) <= 0).all()
+    assert res['ci_lower'].iloc[-1] < 0.2 < res['ci_upper'].iloc[-1]
+
+
+def test_msprt_binary_update():
+    binary, general = MSPRT(tau=0.01), MSPRT(tau=0.01)
+    for _ in range(5):
+        binary.update_binary(100, 1000, 130, 1000)
+        general.update(1000, 100, 100, 1000, 130, 130)
+    assert binary.p_value == general.p_value and binary.conf_int == general.conf_int
+
+
+def test_group_sequential_obrien_fleming_boundaries():
+    test = GroupSequential(max_n=1000, alpha=0.05, spending='obrien-fleming')
+    # Одинаковые варианты: z = 0, гипотеза не отвергается, и на каждом из 5 просмотров считается граница
+    for _ in range(5):
+        test.update(100, 50., 100., 100, 50., 100.)
+
+    boundaries = test.to_frame()['boundary'].to_numpy()
+    np.testing.assert_allclose(boundaries, [4.877, 3.357, 2.680, 2.290, 2.031], atol=0.02)
+    assert test.spent == pytest.approx(0.05, abs=1e-3)
+    assert not test.rejected
@@ -0,0 +1,117 @@
+import numpy as np
+import pandas as pd
+import pytest
+import scipy.stats as st
+
+from ab_test_pipeline import Pipeline
+from core.stat_test import (rank_tests, bootstrap, poisson_bootstrap, PoissonBootstrap, mann_whitneyu_test,
+                            mannwhitneyu_trajectory)
+
+
+def _scipy_rank_tests(a, b):
+    return {'mannwhitneyu': tuple(st.mannwhitneyu(a, b)), 'kruskal': tuple(st.kruskal(a, b)),
+            'mood': tuple(st.mood(a, b))}
+
+
+@pytest.mark.parametrize('a, b', [
+    (np.random.default_rng(0).normal(size=40), np.random.default_rng(1).normal(0.3, size=35)),
+    (np.random.default_rng(2).integers(0, 5, 30).astype(float), np.random.default_rng(3).integers(0, 5, 25)),
+    (np.array([1., 2., 3.]), np.array([2.5, 4., 5., 6.])),
+    (np.array([1., np.nan, 3., 4.]), np.array([2., 5., 6.])),
+])
+def test_rank_tests_match_scipy(a, b):
+    res = rank_tests(a, b)
+    expected = _scipy_rank_tests(a, b)
+
+    for test, values in expected.items():
+        np.testing.assert_allclose(res[test], values, rtol=1e-10, equal_nan=True)
+
+
+def test_pipeline_nan_aggregates():
+    # std по группе из одной строки - NaN, p-value таких сравнений тоже NaN, а не ошибка
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame({'date': np.repeat(np.arange(10), 4), 'var': np.tile([0, 0, 1, 1], 10),
+                       'revenue': rng.exponential(100, 40)})
+    df = df.drop(index=[2])
+
+    res, total = Pipeline(df).pipeline('date', {'revenue': 'std'}, 'var')
+    assert res['p_value'].isna().all()
+    assert np.isfinite(res['mean_lift']).all()
+
+
+def test_poisson_bootstrap_parallel_matches_sequential():
+    x = np.random.default_rng(0).exponential(size=20000)
+    expected = poisson_bootstrap(x, 20, random_state=1, chunk_size=1000)
+
+    np.testing.assert_allclose(poisson_bootstrap(x, 20, random_state=1, chunk_size=1000, n_jobs=-1), expected)
+    assert poisson_bootstrap(x, 20, random_state=np.random.default_rng(1), chunk_size=1000).shape == (20,)
+
+
+def test_mann_whitneyu_test_is_two_sided():
+    rng = np.random.default_rng(0)
+    a, b = rng.normal(size=300), rng.normal(0.1, size=300)
+    one_sided = min(st.mannwhitneyu(a, b, alternative='less')[1], st.mannwhitneyu(a, b, alternative='greater')[1])
+
+    assert mann_whitneyu_test(a, b) == pytest.approx(2 * one_sided)
+    assert rank_tests(a, b)['mannwhitneyu'][1] == pytest.approx(mann_whitneyu_test(a, b))
+
+
+def test_mannwhitneyu_trajectory_with_nan():
+    rng = np.random.default_rng(0)
+    a, b = rng.normal(size=30), rng.normal(size=25)
+    a[12] = np.nan
+
+    p_values = mannwhitneyu_trajectory(a, b)
+    assert p_values.shape == (30,) and p_values.dtype == float
+    np.testing.assert_allclose(p_values[:12], mannwhitneyu_trajectory(a[:12], b[:12]))
+    assert np.isnan(p_values[12:]).all()
+
+
+def test_mannwhitneyu_trajectory_matches_scipy():
+    rng = np.random.default_rng(1)
+    a, b = rng.normal(size=5), rng.normal(0.5, size=40)
+
+    p_values = mannwhitneyu_trajectory(a, b)
+    for k in range(len(b)):
+        # точное распределение - только пока обе выборки маленькие
+        method = 'exact' if k < 8 else 'asymptotic'
+        assert p_values[k] == pytest.approx(st.mannwhitneyu(a[:k + 1], b[:k + 1], method=method)[1])
+
+
+@pytest.mark.parametrize('statistic', ['mean', 'median', 'sum'])
+def test_bootstrap_blocks_match_naive_resampling(statistic):
+    data = np.random.default_rng(0).exponential(size=500)
+    idx = np.random.default_rng(1).integers(0, len(data), size=(200, len(data)))
+    expected = getattr(np, statistic)(data[idx], axis=1)
+
+    # Результат не зависит от размера блока
+    for block_size in (700, 2 ** 20):
+        np.testing.assert_allclose(bootstrap(data, 200, statistic=statistic, random_state=1, block_size=block_size),
+                                   expected)
+
+
+def test_bootstrap_ratio():
+    rng = np.random.default_rng(0)
+    data = np.column_stack([rng.poisson(1, 300), rng.poisson(5, 300) + 1])
+    idx = np.random.default_rng(1).integers(0, len(data), size=(50, len(data)))
+
+    np.testing.assert_allclose(bootstrap(data, 50, statistic='ratio', random_state=1),
+                               data[idx, 0].sum(axis=1) / data[idx, 1].sum(axis=1))
+
+
+def test_poisson_bootstrap_merge_of_partial_results():
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame({'transactions': rng.poisson(1, 3000), 'sessions': rng.poisson(5, 3000) + 1})
+    chunks = [df[i:i + 1000] for i in range(0, len(df), 1000)]
+    expected = poisson_bootstrap(iter(chunks), 100, statistic='ratio', random_state=3)
+
+    # Чанки обрабатываются в разных "процессах" и объединяются через merge
+    first = PoissonBootstrap(100, statistic='ratio', random_state=3).update(chunks[0], chunk_id=0)
+    rest = PoissonBootstrap(100, statistic='ratio', random_state=3)
+    rest.update(chunks[2], chunk_id=2).update(chunks[1], chunk_id=1)
+    np.testing.assert_allclose(first.merge(rest).result(), expected)
+
+    ratio = df['transactions'].sum() / df['sessions'].sum()
+    assert abs(expected.mean() - ratio) < 3 * expected.std()
+    with pytest.raises(ValueError):
+        first.merge(PoissonBootstrap(100, statistic='ratio', random_state=4))
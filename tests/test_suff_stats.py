@@ -0,0 +1,94 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from ab_test_pipeline import Pipeline
+from core.suff_stats import SufficientStatistics
+
+
+def _frame():
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame({'date': rng.integers(0, 5, 200).astype(float), 'var': rng.integers(0, 2, 200).astype(float),
+                       'device': rng.choice(['desktop', 'mobile'], 200), 'revenue': rng.exponential(1e6, 200)})
+    df.loc[::13, 'date'] = np.nan
+    df.loc[::17, 'var'] = np.nan
+    df.loc[::19, 'device'] = np.nan
+    return df
+
+
+def test_aggregate_matches_groupby_with_nan_keys():
+    df = _frame()
+    aggs = {'revenue': 'sum'}
+    stats = SufficientStatistics.from_frame(df, ['date', 'var', 'device'], ['revenue'])
+
+    res = stats.aggregate(['date', 'var'], aggs)
+    expected = df.groupby(['date', 'var'], as_index=False).agg(aggs)
+    pd.testing.assert_frame_equal(res.reset_index(drop=True), expected, check_dtype=False)
+
+
+@pytest.mark.parametrize('agg', SufficientStatistics.AGGREGATIONS)
+def test_all_aggregations_match_groupby(agg):
+    df = _frame()
+    stats = SufficientStatistics.from_frame(df, ['date', 'var', 'device'], ['revenue'])
+
+    res = stats.aggregate(['date', 'var'], {'revenue': agg})
+    expected = df.groupby(['date', 'var'], as_index=False).agg({'revenue': agg})
+    pd.testing.assert_frame_equal(res.reset_index(drop=True), expected, check_dtype=False)
+
+
+def test_rows_keep_nan_slice_values():
+    # groupby(dropna=False) и transform по таким группам корректно работают с pandas 1.5
+    df = _frame()
+    stats = SufficientStatistics.from_frame(df, ['date', 'var', 'device'], ['revenue'])
+
+    expected = df.groupby('device', sort=False, dropna=False).size()
+    pd.testing.assert_series_equal(stats.rows(['device']), expected, check_names=False, check_dtype=False)
+
+
+def test_variance_of_large_values():
+    df = _frame()
+    # Выручка порядка 1e9 с небольшим разбросом: сумма квадратов теряет все значащие цифры дисперсии
+    df['revenue'] = 1e9 + np.random.default_rng(1).normal(0, 1, len(df))
+    aggs = {'revenue': 'std'}
+    stats = SufficientStatistics.from_frame(df, ['date', 'var', 'device'], ['revenue'])
+
+    res = stats.aggregate(['date', 'var'], aggs)
+    expected = df.groupby(['date', 'var'], as_index=False).agg(aggs)
+    np.testing.assert_allclose(res['revenue'], expected['revenue'], rtol=1e-6)
+
+
+def test_save_load(tmp_path):
+    stats = SufficientStatistics.from_frame(_frame(), ['date', 'var', 'device'], ['revenue'])
+    path = str(tmp_path / 'cube.parquet')
+    stats.save(path)
+
+    loaded = SufficientStatistics.load(path)
+    assert (loaded.keys, loaded.metrics) == (stats.keys, stats.metrics)
+    pd.testing.assert_frame_equal(loaded.cube, stats.cube)
+
+
+def test_pipeline_from_aggregates_matches_sessions():
+    rng = np.random.default_rng(0)
+    n = 4000
+    df = pd.DataFrame({'date': rng.choice(pd.date_range('2021-01-01', periods=30), n),
+                       'experimentVariant': rng.choice(['0', '1'], n), 'device': rng.choice(['mobile', 'desktop'], n),
+                       'visitor_type': rng.choice(['new_visitor', 'returning_visitor'], n),
+                       'transactions': rng.poisson(0.1, n).astype(float), 'pageviews': rng.poisson(3, n).astype(float)})
+
+    # Агрегаты в формате query(aggregate=True): n_rows, {metric}_count, {metric}_sum, {metric}_m2 (VAR_POP * COUNT)
+    grouped = df.groupby(['date', 'experimentVariant', 'device', 'visitor_type'])
+    agg = grouped.size().rename('n_rows').to_frame()
+    for metric in ['transactions', 'pageviews']:
+        agg[f'{metric}_count'] = grouped[metric].count()
+        agg[f'{metric}_sum'] = grouped[metric].sum()
+        agg[f'{metric}_m2'] = grouped[metric].var(ddof=0) * grouped[metric].count()
+
+    args = ('date', {'transactions': 'sum', 'pageviews': 'mean'}, 'experimentVariant')
+    expected = Pipeline(df).pipeline(*args, groups=['device', 'visitor_type'])
+    res = Pipeline.from_aggregates(agg.reset_index()).pipeline(*args, groups=['device', 'visitor_type'])
+
+    # Порядок срезов зависит от порядка строк во входных данных
+    for r, e in zip(res, expected):
+        by = ['group_0', 'group_1', 'metric' if 'metric' in e else 'experimentVariant']
+        pd.testing.assert_frame_equal(r.sort_values(by).reset_index(drop=True),
+                                      e.sort_values(by).reset_index(drop=True), check_dtype=False)